@@ -1,11 +1,16 @@
 # Calculate shapes of stars and the shapes of the PSFEx measurements of the stars.
 import os
+import time
+import collections
 import numpy
 import astropy.io.fits as pyfits
 import galsim
 import fitsio
 import piff
 import galsim.des
+from star_schema import psf_cat_dtype, memory_report
+from prefetch import Prefetcher
+import psf_models
 
 # Define the flag values:
 
@@ -22,10 +27,15 @@ RESERVED = 64
 #DESDM_CENTROID_SHIFT = 128
 #DESDM_FAILURE = 256
 #DESDM_FLAG_FACTOR = DESDM_BAD_MEASUREMENT / PSFEX_BAD_MEASUREMENT
+# The flags set by measure_shapes, which are cached with its results.  (cf. star_cache_key)
+MEAS_FLAGS = MEAS_BAD_MEASUREMENT | MEAS_CENTROID_SHIFT
+
 BLACK_FLAG_FACTOR = 512 # blacklist flags are this times the original exposure blacklist flag
                         # blacklist flags go up to 64, so this uses up to 1<<15
+
+# The columns of the output catalogs are psf_cat_dtype.  cf. star_schema.py
  
-def parse_args():
+def parse_args(argv=None):
     import argparse
     
     parser = argparse.ArgumentParser(description='Build PSF catalogs for a set of runs/exposures')
@@ -60,8 +70,49 @@ def parse_args():
                         help='Only do 1 ccd per exposure (used for debugging)')
     parser.add_argument('--use_piff', default=False, action='store_const', const=True,
                         help='Use Piff, not PSFEx')
-
-    args = parser.parse_args()
+    parser.add_argument('--no_exp_cat', default=False, action='store_const', const=True,
+                        help='Only write the per-ccd catalogs, not the combined exposure catalog')
+    parser.add_argument('--use_sep', default=False, action='store_const', const=True,
+                        help='Find the stars in process with sep, rather than reading the SExtractor catalog')
+    parser.add_argument('--prefetch', default=2, type=int,
+                        help='How many ccds to read ahead of the one being measured (0 = none)')
+    parser.add_argument('--prefetch_mem', default=4., type=float,
+                        help='The most memory (in GB) to use for the ccds read ahead')
+    parser.add_argument('--cache_dir', default=None,
+                        help='where to cache the star shape measurements (default: {work}/star_cache)')
+    parser.add_argument('--cache_size', default=2., type=float,
+                        help='maximum size of the star measurement cache in GB')
+    parser.add_argument('--no_cache', default=False, action='store_const', const=True,
+                        help='do not use the star measurement cache')
+    parser.add_argument('--psf_grid', default=None, type=int, nargs=2,
+                        help='Also measure the PSF model on an nx x ny grid on each ccd (cf. psf_grid.py)')
+    parser.add_argument('--star_nproc', default=1, type=int,
+                        help='Number of processes to measure the stars of dense ccds with')
+    parser.add_argument('--star_min', default=500, type=int,
+                        help='Only use star_nproc processes for ccds with at least this many stars')
+    parser.add_argument('--stamp_from', default='fixed', choices=['fixed', 'fwhm', 'psf'],
+                        help='How to choose the stamp sizes for each ccd: fixed (48 pixels for the stars, 64 for the model), from the fwhm in the exposure info file, or from the size of the PSF model')
+    parser.add_argument('--expinfo', default=None,
+                        help='the exposure info file for --stamp_from fwhm (default: {work}/exposure_info.fits)')
+    parser.add_argument('--stamp_nfwhm', default=6., type=float,
+                        help='With --stamp_from fwhm or psf, make the stamps this many times the fwhm across')
+    parser.add_argument('--stamp_min', default=16, type=int,
+                        help='The smallest stamp size for the stars in pixels (rounded up to an even number)')
+    parser.add_argument('--stamp_max', default=64, type=int,
+                        help='The largest stamp size for the stars in pixels (rounded up to an even number)')
+    parser.add_argument('--psf_moments', default='hsm', choices=['hsm', 'analytic'],
+                        help='Measure the PSFEx model shapes with HSM on drawn stamps, or analytically from the moments of the basis images (cf. psfex_moments.py)')
+    parser.add_argument('--psf_calib', default=20, type=int,
+                        help='With --psf_moments analytic, compare with the HSM shapes at this many stars per ccd')
+    parser.add_argument('--warm_start', default='none', choices=['none', 'running', 'psf'],
+                        help='How to start the adaptive moments: from the GalSim default size, the running size of the previous stars, or the PSF model size at each star (which turns off the star cache)')
+
+    args = parser.parse_args(argv)
+    if args.psf_grid is not None and min(args.psf_grid) < 2:
+        parser.error('--psf_grid needs at least 2 points in each direction')
+    # The stamp sizes are even.  (cf. stamp_sizes)
+    args.stamp_min = 2 * ((args.stamp_min + 1) // 2)
+    args.stamp_max = 2 * ((args.stamp_max + 1) // 2)
     return args
 
 
@@ -86,6 +137,21 @@ def parse_file_name(file_name):
     ccdnum = int(root.split('_')[-1])
     return dir, root, ccdnum
 
+def ccd_name(file_name):
+    """Like parse_file_name, but for file names that don't parse, use the base name as the
+    root, with ccdnum = 0 and desdm_dir = None.
+    """
+    try:
+        return parse_file_name(file_name)
+    except:
+        #print '   Unable to parse file_name %s.  Skipping this file.'%file_name
+        #continue
+        base_file = os.path.split(file_name)[1]
+        if os.path.splitext(base_file)[1] == '.fz':
+            base_file=os.path.splitext(base_file)[0]
+        root = os.path.splitext(base_file)[0]
+        return None, root, 0
+
 
 def read_used(exp_dir, root, use_piff=False):
     """Read in the .used.fits file that PSFEx generates with the list of stars that actually
@@ -238,14 +304,11 @@ def find_used_index(fs_data, used_data, suffix='_IMAGE'):
     return find_index(fs_x, fs_y, used_x, used_y)
 
 
-def measure_shapes(xlist, ylist, file_name, wcs, noweight):
-    """Given x,y positions, an image file, and the wcs, measure shapes and sizes.
-
-    We use the HSM module from GalSim to do this.
+def read_image(file_name, noweight):
+    """Read the image, and unless noweight, the bad pixel and weight images.
 
-    Returns e1, e2, size, flag.
+    Returns im, bp_im, wt_im as GalSim images.  (bp_im = wt_im = None if noweight.)
     """
-
     #im = galsim.fits.read(file_name)
     #bp_im = galsim.fits.read(file_name, hdu=2)
     #wt_im = galsim.fits.read(file_name, hdu=3)
@@ -286,7 +349,12 @@ def measure_shapes(xlist, ylist, file_name, wcs, noweight):
         # Make them 0.
         wt_im.array[wt_im.array < 0] = 0.
 
-    # Read the background image as well.
+    return im, bp_im, wt_im
+
+def subtract_background(im, file_name):
+    """Subtract the sky background from im, using the _bkg.fits.fz file if there is one,
+    or else the median BACKGROUND from the _psfcat.fits file.
+    """
     base_file = file_name
     if os.path.splitext(base_file)[1] == '.fz':
         base_file=os.path.splitext(base_file)[0]
@@ -314,23 +382,164 @@ def measure_shapes(xlist, ylist, file_name, wcs, noweight):
         else:
             print('No easy way to estimate background.  Assuming image is zero subtracted...')
 
-    stamp_size = 48
+def extract_stars(im, bp_im, wt_im):
+    """Find the objects in an image in process with sep rather than reading a SExtractor
+    catalog, and subtract the sep background from im.
+
+    Returns the objects in the same format as read_findstars, using all objects as stars
+    as read_findstars does when there is no _findstars.fits file.
+    """
+    import extract
+
+    if wt_im is None:
+        cat, back = extract.extract_sources(im.array, return_background=True)
+    else:
+        cat, back = extract.extract_sources(im.array, wt_im.array, bp_im.array,
+                                            return_background=True)
+    im.array[:,:] -= back
+    print('   sep found %d objects'%len(cat))
+
+    fs_data = numpy.empty(len(cat),
+                          dtype=[('id',int), ('x',float), ('y',float),
+                                 ('mag',float), ('star_flag',int)])
+    fs_data['id'] = cat['NUMBER']
+    fs_data['x'] = cat['X_IMAGE']
+    fs_data['y'] = cat['Y_IMAGE']
+    fs_data['mag'] = cat['MAG_AUTO']
+    fs_data['star_flag'][:] = 1
+    return fs_data
+
+def init_catalog(n):
+    """Allocate the catalog for n stars.
+
+    The measurement functions fill in their columns of this by index.  The shapes start
+    as 999 (for stars that can't be measured) and the flags as 0.
+    """
+    data = numpy.zeros(n, dtype=psf_cat_dtype)
+    for key in ['e1', 'e2', 'size', 'psf_e1', 'psf_e2', 'psf_size']:
+        data[key] = 999.
+    return data
+
+class MomentStats(object):
+    """Counts of the FindAdaptiveMom calls made by a measurement, so the effect of the initial
+    guesses (cf. --warm_start) on the speed and the failure rate can be seen.
+
+    n           The number of stars measured.
+    nfail       How many of them failed (an exception or a nonzero status).
+    niter       The total number of iterations of the ones that didn't fail.
+    time        The total time spent in FindAdaptiveMom.
+    """
+    def __init__(self):
+        self.n = 0
+        self.nfail = 0
+        self.niter = 0
+        self.time = 0.
+
+    def add(self, shape_data, time):
+        # shape_data is None if FindAdaptiveMom raised an exception.
+        self.n += 1
+        self.time += time
+        if shape_data is None or shape_data.moments_status != 0:
+            self.nfail += 1
+        else:
+            self.niter += shape_data.moments_n_iter
+
+    def __iadd__(self, other):
+        self.n += other.n
+        self.nfail += other.nfail
+        self.niter += other.niter
+        self.time += other.time
+        return self
+
+    def __str__(self):
+        if self.n == 0:
+            return 'no stars measured'
+        nok = self.n - self.nfail
+        return '%d stars, %.2f iterations per star, %.2f%% failed, %.0f stars/sec'%(
+                self.n, float(self.niter) / max(nok, 1), 100. * self.nfail / self.n,
+                self.n / max(self.time, 1.e-9))
+
+# The running guesses start again every RUNNING_BLOCK stars (counting from the first star of
+# the ccd), so they are the same however the stars are split up.  (cf. parallel_stars.py)
+RUNNING_BLOCK = 100
+
+def running_guess(recent):
+    """The initial sigma for the next star, given a deque of the sigmas of the last few stars
+    that were measured.  (None means use the GalSim default.)
+    """
+    if len(recent) == 0:
+        return None
+    return float(numpy.median(recent))
+
+def measure_shapes(xlist, ylist, file_name, wcs, noweight, images=None, out=None,
+                   guess_size=None, running=False, stats=None, stamp_size=48, start=0):
+    """Given x,y positions, an image file, and the wcs, measure shapes and sizes.
+
+    We use the HSM module from GalSim to do this.
+
+    If images is given, it should be (im, bp_im, wt_im) already read from file_name with the
+    background subtracted.  Otherwise they are read here.
+
+    The results go in the e1, e2, size, flag columns of out (cf. init_catalog), which is
+    allocated if not given.  Flags are or-ed into any already there.
+
+    By default, each FindAdaptiveMom starts from GalSim's default guess for the size, at the
+    center of the stamp.  The iteration can be started closer to the answer with:
+
+    guess_size  An array of the expected size of each star in arcsec, such as the psf_size
+                of the PSF model there.  (999 or nan means no guess for that star.)  The
+                centroid then starts at the star's x,y.
+    running     Whether to start the stars with no other guess from the median size of the
+                last few stars measured in the same block of RUNNING_BLOCK stars.
+    start       The index of the first star in the whole list for the ccd, if these are only
+                some of them.  (This sets where the blocks for running start.)
+
+    If stats is given (a MomentStats), the FindAdaptiveMom calls are counted there.
+
+    stamp_size is the size in pixels of the stamp around each star (an even number).
+
+    Returns e1, e2, size, flag (as views of the columns of out).
+    """
+
+    if images is None:
+        im, bp_im, wt_im = read_image(file_name, noweight)
+        subtract_background(im, file_name)
+    else:
+        im, bp_im, wt_im = images
 
     n_psf = len(xlist)
-    e1_list = [ 999. ] * n_psf
-    e2_list = [ 999. ] * n_psf
-    s_list = [ 999. ] * n_psf
-    flag_list = [ 0 ] * n_psf
+    if out is None:
+        out = init_catalog(n_psf)
+    e1_list = out['e1']
+    e2_list = out['e2']
+    s_list = out['size']
+    flag_list = out['flag']
     print('len(xlist) = ',len(xlist))
+    # The sigmas (in pixels) of the last few good stars, for running.
+    recent = collections.deque(maxlen=25)
 
     for i in range(n_psf):
         x = xlist[i]
         y = ylist[i]
         print('Measure shape for star at ',x,y)
-        b = galsim.BoundsI(int(x)-stamp_size/2, int(x)+stamp_size/2, 
-                           int(y)-stamp_size/2, int(y)+stamp_size/2)
+        if (start + i) % RUNNING_BLOCK == 0:
+            recent.clear()
+        b = galsim.BoundsI(int(x)-stamp_size//2, int(x)+stamp_size//2,
+                           int(y)-stamp_size//2, int(y)+stamp_size//2)
         b = b & im.bounds
+        jac = wcs.jacobian(galsim.PositionD(x,y))
 
+        # The initial guesses for FindAdaptiveMom.
+        guess = {}
+        if guess_size is not None and 0. < guess_size[i] < 999.:
+            guess['guess_sig'] = guess_size[i] / abs(numpy.linalg.det(jac.getMatrix()))**0.5
+            guess['guess_centroid'] = galsim.PositionD(x,y)
+        elif running and len(recent) > 0:
+            guess['guess_sig'] = running_guess(recent)
+            guess['guess_centroid'] = galsim.PositionD(x,y)
+
+        t0 = time.time()
+        shape_data = None
         try:
             subim = im[b]
             if noweight:
@@ -342,12 +551,15 @@ def measure_shapes(xlist, ylist, file_name, wcs, noweight):
             #print 'subwt = ',subwt.array
             #print 'subbp = ',subbp.array
             #shape_data = subim.FindAdaptiveMom(weight=subwt, badpix=subbp, strict=False)
-            shape_data = subim.FindAdaptiveMom(weight=subwt, strict=False)
+            shape_data = subim.FindAdaptiveMom(weight=subwt, strict=False, **guess)
         except Exception as e:
             print('Caught ',e)
             print(' *** Bad measurement (caught exception).  Mask this one.')
-            flag_list[i] = MEAS_BAD_MEASUREMENT
+            flag_list[i] |= MEAS_BAD_MEASUREMENT
             continue
+        finally:
+            if stats is not None:
+                stats.add(shape_data, time.time() - t0)
 
         #print 'shape_data = ',shape_data
         #print 'image_bounds = ',shape_data.image_bounds
@@ -361,7 +573,7 @@ def measure_shapes(xlist, ylist, file_name, wcs, noweight):
         if shape_data.moments_status != 0:
             print('status = ',shape_data.moments_status)
             print(' *** Bad measurement.  Mask this one.')
-            flag_list[i] = MEAS_BAD_MEASUREMENT
+            flag_list[i] |= MEAS_BAD_MEASUREMENT
             continue
 
         dx = shape_data.moments_centroid.x - x
@@ -369,19 +581,19 @@ def measure_shapes(xlist, ylist, file_name, wcs, noweight):
         #print 'dcentroid = ',dx,dy
         if dx**2 + dy**2 > MAX_CENTROID_SHIFT**2:
             print(' *** Centroid shifted by ',dx,dy,'.  Mask this one.')
-            flag_list[i] = MEAS_CENTROID_SHIFT
+            flag_list[i] |= MEAS_CENTROID_SHIFT
             continue
 
         e1 = shape_data.observed_shape.e1
         e2 = shape_data.observed_shape.e2
         s = shape_data.moments_sigma
+        recent.append(s)
         # Note: this is (det M)^1/4, not ((Ixx+Iyy)/2)^1/2.
         # For reference, the latter is size * (1-e^2)^-1/4
         # So, not all that different, especially for stars with e ~= 0.
 
         # Account for the WCS:
         #print 'wcs = ',wcs
-        jac = wcs.jacobian(galsim.PositionD(x,y))
         #print 'jac = ',jac
         # ( Iuu  Iuv ) = ( dudx  dudy ) ( Ixx  Ixy ) ( dudx  dvdx )
         # ( Iuv  Ivv )   ( dvdx  dvdy ) ( Ixy  Iyy ) ( dudy  dvdy )
@@ -405,89 +617,126 @@ def measure_shapes(xlist, ylist, file_name, wcs, noweight):
     return e1_list,e2_list,s_list,flag_list
 
 
-def measure_psf_shapes(xlist, ylist, psf_file_name, file_name, use_piff=False):
+def read_psf(psf_file_name, file_name, use_piff=False):
+    """Read the Piff or PSFEx model for the image file_name.
+
+    Raises an exception if it can't be read.
+    """
+    print('Read in PSFEx file: ',psf_file_name)
+    if use_piff:
+        return piff.read(psf_file_name)
+    try:
+        return galsim.des.DES_PSFEx(psf_file_name, file_name)
+    except Exception as e:
+        if 'CTYPE' not in str(e):
+            raise
+    # Workaround for a bug in DES_PSFEx.  It tries to read the image file using
+    # GSFitsWCS, which doesn't work if it's not a normal FITS WCS. 
+    # galsim.fits.read should work correctly in those cases.
+    psf = galsim.des.DES_PSFEx(psf_file_name)
+    im = galsim.fits.read(file_name)
+    psf.wcs = im.wcs
+    return psf
+
+def measure_psf_shapes(xlist, ylist, psf_file_name, file_name, use_piff=False, out=None,
+                       psf=None, running=False, stats=None, stamp_size=64, start=0):
     """Given x,y positions, a psf solution file, and the wcs, measure shapes and sizes
     of the PSF model.
 
     We use the HSM module from GalSim to do this.
 
-    Returns e1, e2, size, flag.
-    """
-    print('Read in PSFEx file: ',psf_file_name)
+    The results go in the psf_e1, psf_e2, psf_size, flag columns of out (cf. init_catalog),
+    which is allocated if not given.  Flags are or-ed into any already there.
 
-    n_psf = len(xlist)
-    e1_list = [ 999. ] * n_psf
-    e2_list = [ 999. ] * n_psf
-    s_list = [ 999. ] * n_psf
-    flag_list = [ 0 ] * n_psf
+    If psf is given, it is the model already read from psf_file_name (cf. read_psf).
 
-    try:
-        if use_piff:
-            psf = piff.read(psf_file_name)
-        else:
-            psf = galsim.des.DES_PSFEx(psf_file_name, file_name)
-    except Exception as e:
-        if 'CTYPE' in str(e):
-            try:
-                # Workaround for a bug in DES_PSFEx.  It tries to read the image file using
-                # GSFitsWCS, which doesn't work if it's not a normal FITS WCS. 
-                # galsim.fits.read should work correctly in those cases.
-                psf = galsim.des.DES_PSFEx(psf_file_name)
-                im = galsim.fits.read(file_name)
-                psf.wcs = im.wcs
-                e = None
-            except Exception as e:
-                pass
-        if e is not None:
+    If running is True, each FindAdaptiveMom starts from the median size of the last few
+    model stamps in the same block of RUNNING_BLOCK stars, rather than GalSim's default
+    guess.  (The model varies slowly across the ccd.)  start is the index of the first
+    position in the whole list for the ccd.  (cf. measure_shapes)  If stats is given (a
+    MomentStats), the FindAdaptiveMom calls are counted there.
+
+    stamp_size is the size of the stamps the model is drawn on, in pixels of 0.2 arcsec.
+
+    Returns e1, e2, size, flag (as views of the columns of out).
+    """
+    n_psf = len(xlist)
+    if out is None:
+        out = init_catalog(n_psf)
+    e1_list = out['psf_e1']
+    e2_list = out['psf_e2']
+    s_list = out['psf_size']
+    flag_list = out['flag']
+
+    if psf is None:
+        try:
+            psf = read_psf(psf_file_name, file_name, use_piff)
+        except Exception as e:
             print('Caught ',e)
-            flag_list = [ PSFEX_FAILURE ] * n_psf
+            flag_list |= PSFEX_FAILURE
             return e1_list,e2_list,s_list,flag_list
 
-    stamp_size = 64
     pixel_scale = 0.2
 
     im = galsim.Image(stamp_size, stamp_size, scale=pixel_scale)
 
+    if use_piff:
+        # Draw the Piff model for all the stars in batches.
+        piff_stamps = psf_models.draw_piff(psf, xlist, ylist, im)
+    # The sigmas (in stamp pixels) of the last few good stamps, for running.
+    recent = collections.deque(maxlen=25)
+
     for i in range(n_psf):
         x = xlist[i]
         y = ylist[i]
         print('Measure PSFEx model shape at ',x,y)
+        if (start + i) % RUNNING_BLOCK == 0:
+            recent.clear()
         image_pos = galsim.PositionD(x,y)
         #print 'im_pos = ',image_pos
         if use_piff:
-            im = psf.draw(x=x, y=y, image=im)
+            im.array[:,:] = next(piff_stamps)
         else:
             psf_i = psf.getPSF(image_pos)
             im = psf_i.drawImage(image=im, method='no_pixel')
         #print 'im = ',im
 
+        guess = {}
+        if running and len(recent) > 0:
+            guess['guess_sig'] = running_guess(recent)
+        t0 = time.time()
+        shape_data = None
         try:
-            shape_data = im.FindAdaptiveMom(strict=False)
+            shape_data = im.FindAdaptiveMom(strict=False, **guess)
         except:
             print(' *** Bad measurement (caught exception).  Mask this one.')
-            flag_list[i] = PSFEX_BAD_MEASUREMENT
+            flag_list[i] |= PSFEX_BAD_MEASUREMENT
             continue
+        finally:
+            if stats is not None:
+                stats.add(shape_data, time.time() - t0)
         #print 'shape_date = ',shape_data
 
         if shape_data.moments_status != 0:
             print('status = ',shape_data.moments_status)
             print(' *** Bad measurement.  Mask this one.')
-            flag_list[i] = PSFEX_BAD_MEASUREMENT
+            flag_list[i] |= PSFEX_BAD_MEASUREMENT
             continue
 
-        dx = shape_data.moments_centroid.x - im.trueCenter().x
-        dy = shape_data.moments_centroid.y - im.trueCenter().y
+        dx = shape_data.moments_centroid.x - im.true_center.x
+        dy = shape_data.moments_centroid.y - im.true_center.y
         #print 'centroid = ',shape_data.moments_centroid
-        #print 'trueCenter = ',im.trueCenter()
+        #print 'true_center = ',im.true_center
         #print 'dcentroid = ',dx,dy
         if dx**2 + dy**2 > MAX_CENTROID_SHIFT**2:
             print(' *** Centroid shifted by ',dx,dy,'.  Mask this one.')
-            flag_list[i] = PSFEX_CENTROID_SHIFT
+            flag_list[i] |= PSFEX_CENTROID_SHIFT
             continue
 
         g1 = shape_data.observed_shape.g1
         g2 = shape_data.observed_shape.g2
         s = shape_data.moments_sigma * pixel_scale
+        recent.append(shape_data.moments_sigma)
 
         #print 'g1,g2,s = ',g1,g2,s
 
@@ -498,6 +747,43 @@ def measure_psf_shapes(xlist, ylist, psf_file_name, file_name, use_piff=False):
     return e1_list,e2_list,s_list,flag_list
 
 
+def measure_stars(x, y, file_name, wcs, noweight, images, psf_file_name, psf, out,
+                  use_piff=False, do_shapes=True, do_psf=True, warm_start='none', stats=None,
+                  stamp_size=48, psf_stamp_size=64, start=0):
+    """Measure the stars at x, y with measure_shapes and the PSF model there with
+    measure_psf_shapes, filling in out.
+
+    do_shapes   Whether to measure the stars.  (False if they were already measured.)
+    do_psf      Whether to measure the PSF model.
+    warm_start  How to start the FindAdaptiveMom iterations (cf. --warm_start):
+                'none' uses GalSim's default guess, 'running' the median size of the last few
+                stars, and 'psf' the size of the PSF model at each star, so the model is
+                measured first.
+    stats       A dict of MomentStats for 'stars' and 'psf', to count the calls in.
+    stamp_size  The size of the stamps for the stars, in image pixels.
+    psf_stamp_size  The size of the stamps for the model, in pixels of 0.2 arcsec.
+    start       The index of x[0] in the whole list for the ccd.  (cf. RUNNING_BLOCK)
+    """
+    if stats is None:
+        stats = {}
+    running = warm_start != 'none'
+
+    def do_psf_shapes():
+        measure_psf_shapes(x, y, psf_file_name, file_name, use_piff=use_piff, out=out, psf=psf,
+                           running=running, stats=stats.get('psf'), stamp_size=psf_stamp_size,
+                           start=start)
+
+    if do_psf and warm_start == 'psf':
+        do_psf_shapes()
+    if do_shapes:
+        guess_size = out['psf_size'] if warm_start == 'psf' else None
+        measure_shapes(x, y, file_name, wcs, noweight, images=images, out=out,
+                       guess_size=guess_size, running=running, stats=stats.get('stars'),
+                       stamp_size=stamp_size, start=start)
+    if do_psf and warm_start != 'psf':
+        do_psf_shapes()
+    return out
+
 def apply_wcs(wcs, g1, g2, s):
 
     scale = 2./(1.+g1*g1+g2*g2)
@@ -519,7 +805,7 @@ def apply_wcs(wcs, g1, g2, s):
 
     return g1, g2, s
 
-def measure_psf_shapes_erin(xlist, ylist, psf_file_name, file_name):
+def measure_psf_shapes_erin(xlist, ylist, psf_file_name, file_name, out=None):
     """Given x,y positions, a psf solution file, and the wcs, measure shapes and sizes
     of the PSF model.
 
@@ -527,29 +813,33 @@ def measure_psf_shapes_erin(xlist, ylist, psf_file_name, file_name):
 
     Also, this uses Erin's psfex module to render the images rather than the GalSim module.
 
+    The results go in the columns of out as for measure_psf_shapes.
+
     Returns e1, e2, size, flag.
     """
     import psfex
     print('Read in PSFEx file: ',psf_file_name)
 
     n_psf = len(xlist)
-    e1_list = [ 999. ] * n_psf
-    e2_list = [ 999. ] * n_psf
-    s_list = [ 999. ] * n_psf
-    flag_list = [ 0 ] * n_psf
+    if out is None:
+        out = init_catalog(n_psf)
+    e1_list = out['psf_e1']
+    e2_list = out['psf_e2']
+    s_list = out['psf_size']
+    flag_list = out['flag']
 
     try:
         psf = psfex.PSFEx(psf_file_name)
     except Exception as e:
         print('Caught ',e)
-        flag_list = [ PSFEX_FAILURE ] * n_psf
+        flag_list |= PSFEX_FAILURE
         return e1_list,e2_list,s_list,flag_list
 
     if psf._psfex is None:
         # Erin doesn't throw an exception for errors.
         # The _psfex attribute just ends up as None, so check for that.
         print('psf._psfex is None')
-        flag_list = [ PSFEX_FAILURE ] * n_psf
+        flag_list |= PSFEX_FAILURE
         return e1_list,e2_list,s_list,flag_list
 
     wcs = galsim.fits.read(file_name).wcs
@@ -573,13 +863,13 @@ def measure_psf_shapes_erin(xlist, ylist, psf_file_name, file_name):
             shape_data = im.FindAdaptiveMom(strict=False)
         except:
             print(' *** Bad measurement (caught exception).  Mask this one.')
-            flag_list[i] = PSFEX_BAD_MEASUREMENT
+            flag_list[i] |= PSFEX_BAD_MEASUREMENT
             continue
 
         if shape_data.moments_status != 0:
             print('status = ',shape_data.moments_status)
             print(' *** Bad measurement.  Mask this one.')
-            flag_list[i] = PSFEX_BAD_MEASUREMENT
+            flag_list[i] |= PSFEX_BAD_MEASUREMENT
             continue
 
         cen = psf.get_center(y,x)
@@ -593,7 +883,7 @@ def measure_psf_shapes_erin(xlist, ylist, psf_file_name, file_name):
         max_centroid_shift = max(MAX_CENTROID_SHIFT, 0.5)
         if dx**2 + dy**2 > max_centroid_shift**2:
             print(' *** Centroid shifted by ',dx,dy,'.  Mask this one.')
-            flag_list[i] = PSFEX_CENTROID_SHIFT
+            flag_list[i] |= PSFEX_CENTROID_SHIFT
             continue
         #print 'shape = ',shape_data.observed_shape
         #print 'sigma = ',shape_data.moments_sigma * pixel_scale
@@ -681,9 +971,575 @@ def read_blacklists(tag):
     return d
 
 
-def main():
+def read_fwhm(expinfo_file, expnum):
+    """Read the FWHM (in pixels, from the FWHM keyword of the image headers) of each ccd of
+    the exposure expnum from the exposure info file.  (cf. build_exp_catalog.py)
+
+    Returns a dict ccdnum -> fwhm, which is empty if the file or the exposure isn't there.
+    """
+    if not os.path.isfile(expinfo_file):
+        print('   No exposure info file ',expinfo_file)
+        return {}
+    expinfo = fitsio.read(expinfo_file, columns=['expnum', 'ccdnum', 'fwhm'])
+    expinfo = expinfo[expinfo['expnum'] == expnum]
+    print('   read fwhm for %d ccds from %s'%(len(expinfo), expinfo_file))
+    return { int(ccdnum) : float(fwhm) for ccdnum, fwhm in zip(expinfo['ccdnum'], expinfo['fwhm']) }
+
+def stamp_sizes(fwhm, pixel_scale, nfwhm, min_size, max_size):
+    """The stamp sizes for stars with the given FWHM (in pixels) on an image with the given
+    pixel scale (in arcsec).
+
+    The stars' stamps are nfwhm * fwhm pixels across, rounded up to an even number and kept
+    within min_size <= size <= max_size.  The model stamps (in 0.2 arcsec pixels, cf.
+    measure_psf_shapes) cover the same area on the sky.
+
+    Returns stamp_size, psf_stamp_size.
+    """
+    size = 2 * int(numpy.ceil(nfwhm * fwhm / 2.))
+    size = min(max(size, min_size), max_size)
+    psf_size = 2 * int(numpy.ceil(size * pixel_scale / 0.2 / 2.))
+    return size, psf_size
+
+def ccd_stamp_sizes(args, inputs, ccdnum, psf_file_name, file_name, fwhm=None):
+    """Choose the stamp sizes for a ccd according to args.stamp_from (cf. --stamp_from).
+
+    fwhm is a dict of the FWHM of each ccd (cf. read_fwhm), for args.stamp_from = 'fwhm'.
+
+    Returns stamp_size, psf_stamp_size.
+    """
+    if args.stamp_from == 'fixed':
+        return 48, 64
+
+    b = inputs['images'][0].bounds
+    center = galsim.PositionD((b.xmin + b.xmax) / 2., (b.ymin + b.ymax) / 2.)
+    pixel_scale = abs(numpy.linalg.det(inputs['wcs'].jacobian(center).getMatrix()))**0.5
+    if args.stamp_from == 'fwhm':
+        ccd_fwhm = (fwhm or {}).get(ccdnum, -999.)
+    elif inputs['psf'] is not None:
+        # The size of the model at the center of the ccd.
+        psf_size = measure_psf_shapes([center.x], [center.y], psf_file_name, file_name,
+                                      use_piff=args.use_piff, psf=inputs['psf'])[2][0]
+        ccd_fwhm = 2.3548 * psf_size / pixel_scale if psf_size < 999. else -999.
+    else:
+        ccd_fwhm = -999.
+    if not ccd_fwhm > 0.:
+        print('   No %s for this ccd.  Use the default stamp sizes.'%args.stamp_from)
+        return 48, 64
+    sizes = stamp_sizes(ccd_fwhm, pixel_scale, args.stamp_nfwhm, args.stamp_min, args.stamp_max)
+    print('   fwhm = %.2f pixels, stamp sizes = %d, %d'%(ccd_fwhm, sizes[0], sizes[1]))
+    return sizes
+
+def star_cache_key(cache, images, wcs, x, y, noweight, warm_start='none', stamp_size=48):
+    """The key in cache (a corr_cache.CorrCache) of the measure_shapes results for the stars
+    at x, y.
+
+    This is a hash of the pixels as measured (i.e. after the background subtraction), the
+    wcs, the positions, the measurement settings and the code, but not the PSF model, so a
+    new PSF solution for the same image reuses the star measurements.  (So this is not
+    used with warm_start='psf', where the model sets where the iterations start.)
+    """
+    arrays = [ image.array for image in images if image is not None ] + [x, y]
+    config = dict(wcs=repr(wcs), noweight=noweight, max_centroid_shift=MAX_CENTROID_SHIFT,
+                  warm_start=warm_start, stamp_size=stamp_size)
+    return cache.key(arrays, config, funcs=[measure_shapes], packages=['galsim'])
+
+def load_ccd(args, file_name, exp_dir):
+    """Read the inputs measure_ccd needs for a single ccd.
+
+    This is all the file reading for the ccd, so it can be done in a background thread while
+    the previous ccd is being measured.  (cf. build_exposure)
+
+    Returns a dict with the images (already background subtracted unless args.use_sep),
+    the wcs, fs_data, used_data, reserve_data and psf.  Any that could not be read are None.
+    """
+    desdm_dir, root, ccdnum = ccd_name(file_name)
+
+    inputs = {}
+    inputs['images'] = read_image(file_name, args.noweight)
+    inputs['wcs'] = inputs['images'][0].wcs
+    if args.use_sep:
+        # extract_stars subtracts the background, and makes fs_data in measure_ccd.
+        inputs['fs_data'] = None
+    else:
+        subtract_background(inputs['images'][0], file_name)
+        try:
+            inputs['fs_data'] = read_findstars(exp_dir, root)
+        except:
+            inputs['fs_data'] = None
+
+    if args.reference_tag:
+        used_dir = exp_dir.replace(args.tag, args.reference_tag)
+    else:
+        used_dir = exp_dir
+    inputs['used_data'] = read_used(used_dir, root, use_piff=args.use_piff)
+    inputs['reserve_data'] = read_reserve(exp_dir, root)
+
+    psf_file_name = os.path.join(exp_dir, root + '_psfcat.psf')
+    try:
+        inputs['psf'] = psf_models.load_psf(psf_file_name, file_name, args.use_piff)
+    except Exception as e:
+        print('Caught ',e)
+        inputs['psf'] = None
+    return inputs
+
+def measure_ccd(args, file_name, exp_dir, expnum, inputs=None, star_cache=None,
+                hsm_stats=None, fwhm=None):
+    """Measure the stars and the PSF model for a single ccd.
+
+    inputs is the result of load_ccd for this ccd.  If it is None, it is read here.
+
+    If star_cache is given (a corr_cache.CorrCache), the star measurements are taken from
+    there if these stars on this image were measured before.  (cf. star_cache_key)
+
+    If hsm_stats is given (a dict of MomentStats for 'stars' and 'psf'), the FindAdaptiveMom
+    calls for this ccd are added to it.
+
+    fwhm is a dict of the FWHM of each ccd of the exposure, for args.stamp_from = 'fwhm'.
+    (cf. read_fwhm)
+
+    Returns root, data where data is a structured array with psf_cat_dtype,
+    or None if the ccd could not be done.
+    """
+    print('\nProcessing ', file_name)
+    if inputs is None:
+        inputs = load_ccd(args, file_name, exp_dir)
+
+    desdm_dir, root, ccdnum = ccd_name(file_name)
+    print('   root, ccdnum = ',root,ccdnum)
+    print('   desdm_dir = ',desdm_dir)
+
+    key = (expnum, ccdnum)
+    #if key in flag_dict:
+    #    black_flag = flag_dict[key]
+    #    print('   blacklist flag = ',black_flag)
+    #    if black_flag & (113 << 15):
+    #        print('   Catastrophic flag.  Skipping this file.')
+    #        if args.single_ccd:
+    #            break
+    #        continue
+    #else:
+    black_flag = 0
+
+    # The star data.  From both findstars and the PSFEx used file.
+    images = inputs['images']
+    if args.use_sep:
+        # Detect the stars in process.
+        fs_data = extract_stars(*images)
+    else:
+        fs_data = inputs['fs_data']
+    if fs_data is None:
+        print('   No _findstars.fits file found')
+        return root, None
+    n_tot = len(fs_data['id'])
+    n_fs = fs_data['star_flag'].sum()
+    print('   n_tot = ',n_tot)
+    print('   n_fs = ',n_fs)
+    mask = fs_data['star_flag'] == 1
+
+    used_data = inputs['used_data']
+    if used_data is None:
+        print('   No .used.fits file found')
+        return root, None
+    n_used = len(used_data)
+    print('   n_used = ',n_used)
+    if n_used == 0:
+        print('   No stars were used.')
+        return root, None
+
+    tot_xmin = fs_data['x'].min()
+    tot_xmax = fs_data['x'].max()
+    tot_ymin = fs_data['y'].min()
+    tot_ymax = fs_data['y'].max()
+    tot_area = (tot_xmax-tot_xmin)*(tot_ymax-tot_ymin)
+    print('   bounds from sextractor = ',tot_xmin,tot_xmax,tot_ymin,tot_ymax)
+    print('   area = ',tot_area)
+
+    fs_xmin = fs_data['x'][mask].min()
+    fs_xmax = fs_data['x'][mask].max()
+    fs_ymin = fs_data['y'][mask].min()
+    fs_ymax = fs_data['y'][mask].max()
+    print('   bounds from findstars = ',fs_xmin,fs_xmax,fs_ymin,fs_ymax)
+    fs_area = (fs_xmax-fs_xmin)*(fs_ymax-fs_ymin)
+    print('   area = ',fs_area)
+
+    used_xmin = used_data['X_IMAGE'].min()
+    used_xmax = used_data['X_IMAGE'].max()
+    used_ymin = used_data['Y_IMAGE'].min()
+    used_ymax = used_data['Y_IMAGE'].max()
+    print('   final bounds of used stars = ',used_xmin,used_xmax,used_ymin,used_ymax)
+    used_area = (used_xmax-used_xmin)*(used_ymax-used_ymin)
+    print('   area = ',used_area)
+    print('   fraction used = ',float(used_area) / tot_area)
+
+    # Figure out which fs objects go with which used objects.
+    fs_index = find_fs_index(used_data, fs_data)
+    used_index = find_used_index(fs_data[mask], used_data)
+    print('   fs_index = ',fs_index)
+    print('   used_index = ',used_index)
+
+    # Check: This should be the same as the used bounds
+    alt_used_xmin = fs_data['x'][fs_index].min()
+    alt_used_xmax = fs_data['x'][fs_index].max()
+    alt_used_ymin = fs_data['y'][fs_index].min()
+    alt_used_ymax = fs_data['y'][fs_index].max()
+    print('   bounds from findstars[fs_index] = ', end=' ')
+    print(alt_used_xmin,alt_used_xmax,alt_used_ymin,alt_used_ymax)
+
+    # Get the magnitude range for each catalog.
+    tot_magmin = fs_data['mag'].min()
+    tot_magmax = fs_data['mag'].max()
+    print('   magnitude range of full catalog = ',tot_magmin,tot_magmax)
+    fs_magmin = fs_data['mag'][mask].min()
+    fs_magmax = fs_data['mag'][mask].max()
+    print('   magnitude range of fs stars = ',fs_magmin,fs_magmax)
+    used_magmin = fs_data['mag'][fs_index].min()
+    used_magmax = fs_data['mag'][fs_index].max()
+    print('   magnitude range of used stars = ',used_magmin,used_magmax)
+
+    try:
+        # The wcs from the image file
+        wcs = inputs['wcs']
+
+        # The output catalog, which the measurements fill in.
+        data = init_catalog(n_fs)
+        data['ccdnum'] = ccdnum
+        data['x'] = fs_data['x'][mask]
+        data['y'] = fs_data['y'][mask]
+        data['mag'] = fs_data['mag'][mask]
+        x = fs_data['x'][mask]
+        y = fs_data['y'][mask]
+
+        psf_file_name = os.path.join(exp_dir, root + '_psfcat.psf')
+        stamp_size, psf_stamp_size = ccd_stamp_sizes(args, inputs, ccdnum, psf_file_name,
+                                                     file_name, fwhm)
+        data['stamp_size'] = stamp_size
+
+        # The star measurements don't depend on the PSF model, so may have been done already.
+        star_columns = ['e1', 'e2', 'size', 'flag']
+        star_data = None
+        if star_cache is not None:
+            star_key = star_cache_key(star_cache, images, wcs, x, y, args.noweight,
+                                      args.warm_start, stamp_size)
+            star_data = star_cache.get(star_key)
+        if star_data is not None:
+            for col in star_columns:
+                data[col] = star_data[col]
+        do_shapes = star_data is None
+
+        ccd_stats = { 'stars' : MomentStats(), 'psf' : MomentStats() }
+        analytic = (args.psf_moments == 'analytic' and not args.use_piff and
+                    inputs['psf'] is not None)
+        if analytic:
+            # The model shapes from the basis moments.  (These are the psf sizes for
+            # warm_start = psf too.)
+            import psfex_moments
+            psfex_moments.measure_psf_moments(x, y, inputs['psf'], data, bounds=images[0].bounds)
+        elif args.psf_moments == 'analytic':
+            print('   The analytic psf moments are only for PSFEx models.  Use HSM.')
+        if args.star_nproc > 1 and n_fs >= args.star_min:
+            # A dense ccd.  Split the stars over several processes.
+            import parallel_stars
+            parallel_stars.measure_stars(x, y, data, images, wcs, file_name, psf_file_name,
+                                         noweight=args.noweight, use_piff=args.use_piff,
+                                         do_shapes=do_shapes,
+                                         do_psf=inputs['psf'] is not None and not analytic,
+                                         warm_start=args.warm_start, stats=ccd_stats,
+                                         stamp_size=stamp_size, psf_stamp_size=psf_stamp_size,
+                                         nproc=args.star_nproc)
+            if inputs['psf'] is None:
+                measure_psf_shapes(x, y, psf_file_name, file_name, use_piff=args.use_piff,
+                                   out=data, stamp_size=psf_stamp_size)
+        else:
+            # Measure the shapes and sizes of the stars used by PSFEx and of the model there.
+            measure_stars(x, y, file_name, wcs, args.noweight, images, psf_file_name,
+                          inputs['psf'], data, use_piff=args.use_piff, do_shapes=do_shapes,
+                          do_psf=not analytic, warm_start=args.warm_start, stats=ccd_stats,
+                          stamp_size=stamp_size, psf_stamp_size=psf_stamp_size)
+        print('   star moments: ',ccd_stats['stars'])
+        print('   psf moments: ',ccd_stats['psf'])
+        if hsm_stats is not None:
+            hsm_stats['stars'] += ccd_stats['stars']
+            hsm_stats['psf'] += ccd_stats['psf']
+        if analytic and args.psf_calib > 0:
+            psfex_moments.calibrate(x, y, data, inputs['psf'], psf_file_name, file_name,
+                                    ncal=args.psf_calib, stamp_size=psf_stamp_size)
+
+        if star_cache is not None and do_shapes:
+            # Only the measure_shapes flags.  The rest are about the PSF model.
+            star_data = { col : data[col].copy() for col in star_columns }
+            star_data['flag'] &= MEAS_FLAGS
+            star_cache.put(star_key, star_data)
+    except Exception as e:
+        print('Catastrophic error trying to measure the shapes:')
+        print(e)
+        print('Skip this file')
+        raise e
+
+    if args.psf_grid is not None and inputs['psf'] is not None:
+        # Tabulate the model shapes, for interpolating to other positions.
+        import psf_grid
+        nx, ny = args.psf_grid
+        grid = psf_grid.make_grid(inputs['psf'], psf_file_name, file_name, images[0].bounds,
+                                  nx, ny, use_piff=args.use_piff)
+        grid.write(os.path.join(exp_dir, root + '_psfgrid.fits'))
+
+    # The measurements or-ed their flags together into data['flag'].
+    flag = data['flag']
+    print('flag = ',flag)
+
+    # Add in flags for bad indices
+    bad_index = numpy.where(used_index < 0)[0]
+    print('bad_index = ',bad_index)
+    flag[bad_index] |= NOT_USED
+    print('flag => ',flag)
+
+    # Add in flags for reserved stars
+    reserve_data = inputs['reserve_data']
+    if reserve_data is None:
+        print('   No _reserve.fits file found')
+    else:
+        n_reserve = len(reserve_data)
+        print('   n_reserve = ',n_reserve)
+
+        # Figure out which fs objects go with which reserved objects.
+        fs2_index = find_fs_index(reserve_data, fs_data, suffix='WIN_IMAGE')
+        res_index = find_used_index(fs_data[mask], reserve_data, suffix='WIN_IMAGE')
+        print('   fs2_index = ',fs2_index)
+        print('   res_index = ',res_index)
+
+        res_index = numpy.where(res_index >= 0)[0]
+        print('res_index = ',res_index)
+        flag[res_index] |= RESERVED
+        print('flag => ',flag)
+
+    # If the ccd is blacklisted, everything gets the blacklist flag
+    if black_flag:
+        print('black_flag = ',black_flag)
+        print('type(black_flag) = ',type(black_flag))
+        print('type(flag[0]) = ',type(flag[0]))
+        print('type(flag[0] | black_flag) = ',type(flag[0] | black_flag))
+        black_flag *= BLACK_FLAG_FACTOR
+        print('black_flag => ',black_flag)
+        flag |= black_flag
+        print('flag => ',flag)
+
+    # Compute ra,dec from the wcs:
+    coord = [ wcs.toWorld(galsim.PositionD(xx,yy)) for xx,yy in zip(x,y) ]
+    try:
+        ra = [ c.ra / galsim.degrees for c in coord ]
+        dec = [ c.dec / galsim.degrees for c in coord ]
+    except:
+        # Sims may be using simple WCS with no ra, dec.  Just take coord.x,y instead
+        ra = [ c.x * galsim.arcsec / galsim.degrees for c in coord]
+        dec = [ c.y * galsim.arcsec / galsim.degrees for c in coord]
+
+    data['ra'] = ra
+    data['dec'] = dec
+    return root, data
+
+def write_catalog(data, cat_file):
+    """Write a psf catalog to a fits file.
+
+    The file is written to a temporary name and then renamed, so cat_file is never partially
+    written.
+    """
+    tmp_file = cat_file + '.tmp'
+    fitsio.write(tmp_file, data, clobber=True)
+    os.replace(tmp_file, cat_file)
+    print('wrote cat_file = ',cat_file)
+
+
+class CatalogWriter(object):
+    """Write the catalogs for an exposure in a background thread.
+
+    Each finished ccd catalog given to add() is written to its own file, and appended to a
+    temporary exposure catalog, while the next ccd is being measured.  finish() waits for
+    the writes and renames the exposure catalog into place.  Errors in the writes are
+    collected and raised by finish(), after all the other ccds have been written.  If the
+    exposure fails part way through, close() writes the ccds already added, but not the
+    exposure catalog.
+
+    cat_dir     The directory for the catalogs.
+    exp         The exposure (only used for the temporary file name).
+    exp_cat     Whether to write the exposure catalog.
+    maxsize     The maximum number of catalogs waiting to be written.  add() blocks
+                when the queue is full.
+    """
+    def __init__(self, cat_dir, exp, exp_cat=True, maxsize=4):
+        import threading
+        import queue
+
+        self.cat_dir = cat_dir
+        self.exp_cat = exp_cat
+        self.tmp_file = os.path.join(cat_dir, exp + '_exppsf.fits.tmp')
+        self.fits = None
+        self.errors = []
+        self.exp_ok = True
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.start()
+
+    def add(self, data, root):
+        self.queue.put((data, root))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            data, root = item
+            try:
+                write_catalog(data, os.path.join(self.cat_dir, root + "_psf.fits"))
+            except Exception as e:
+                print('Error writing catalog for %s: %s'%(root, e))
+                self.errors.append((root, e))
+            if self.exp_cat:
+                try:
+                    self._append(data)
+                except Exception as e:
+                    print('Error adding %s to the exposure catalog: %s'%(root, e))
+                    self.errors.append((root, e))
+                    self.exp_ok = False
+        if self.fits is not None:
+            self.fits.close()
+
+    def _append(self, data):
+        if self.fits is None:
+            self.fits = fitsio.FITS(self.tmp_file, 'rw', clobber=True)
+            self.fits.write(data)
+        else:
+            self.fits[-1].append(data)
+
+    def _stop(self):
+        # Wait for the queued catalogs to be written and the thread to end.
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def close(self):
+        """Wait for the catalogs already added to be written, and remove the incomplete
+        exposure catalog.
+        """
+        self._stop()
+        if os.path.exists(self.tmp_file):
+            os.remove(self.tmp_file)
+
+    def finish(self, exp_root):
+        """Wait for the writes to finish, and move the exposure catalog into place as
+        {exp_root}_exppsf.fits.
+        """
+        self._stop()
+        if self.exp_cat and self.exp_ok:
+            exp_file = os.path.join(self.cat_dir, exp_root + "_exppsf.fits")
+            if self.fits is None:
+                # No ccds.  Write an empty catalog.
+                write_catalog(numpy.empty(0, dtype=psf_cat_dtype), exp_file)
+            else:
+                os.replace(self.tmp_file, exp_file)
+                print('wrote exp cat_file = ',exp_file)
+        elif self.exp_cat and os.path.exists(self.tmp_file):
+            # Don't leave an incomplete exposure catalog around.
+            os.remove(self.tmp_file)
+        if self.errors:
+            raise IOError('Failed to write catalogs for %s'%(
+                          ', '.join(root for root, e in self.errors)))
+
+def build_exposure(args, run, exp, cat_dir=None):
+    """Build the psf catalog for a single exposure.
+
+    If cat_dir is given, the catalog for each ccd is written there, as is the catalog for the
+    whole exposure (unless args.no_exp_cat).
+
+    Returns exp_root, data where data is the catalog for the exposure as a structured array.
+    """
     import glob
 
+    print('Start work on run, exp = ',run,exp)
+    try:
+        expnum = int(exp[6:])
+    except:
+        expnum = 0
+    print('expnum = ',expnum)
+
+    if args.output_dir is None:
+        exp_dir = os.path.join(os.path.expanduser(args.work),exp)
+    else:
+        exp_dir = args.output_dir
+    print('exp_dir = ',exp_dir)
+
+    input_dir = args.input_dir
+    print('input_dir = ', input_dir)
+
+    # Get the file names in that directory.
+    print('%s/%s'%(input_dir,args.exp_match))
+    files = sorted(glob.glob('%s/%s'%(input_dir,args.exp_match)))
+
+    if args.no_cache or args.warm_start == 'psf':
+        # With warm_start = psf, the star measurements depend on the PSF model.
+        star_cache = None
+    else:
+        from corr_cache import CorrCache
+        star_cache = CorrCache(args.cache_dir or
+                               os.path.join(os.path.expanduser(args.work), 'star_cache'),
+                               max_bytes=int(args.cache_size * 1024**3))
+
+    # Read the next ccds while the current one is being measured.
+    load = lambda file_name: load_ccd(args, file_name, exp_dir)
+    ccds = Prefetcher(files, load, depth=args.prefetch,
+                      max_bytes=int(args.prefetch_mem * 1024**3))
+
+    ccd_data = []
+    root = exp
+    if args.stamp_from == 'fwhm':
+        fwhm = read_fwhm(args.expinfo or
+                         os.path.join(os.path.expanduser(args.work), 'exposure_info.fits'),
+                         expnum)
+    else:
+        fwhm = None
+
+    hsm_stats = { 'stars' : MomentStats(), 'psf' : MomentStats() }
+    if cat_dir is not None:
+        # Write the catalogs while the next ccds are being measured.
+        writer = CatalogWriter(cat_dir, exp, exp_cat=not args.no_exp_cat)
+    try:
+        for file_name, inputs in ccds:
+            root, data = measure_ccd(args, file_name, exp_dir, expnum, inputs, star_cache,
+                                     hsm_stats, fwhm)
+            del inputs
+
+            if data is not None:
+                ccd_data.append(data)
+                if cat_dir is not None:
+                    writer.add(data, root)
+
+            if args.single_ccd:
+                break
+    except BaseException:
+        if cat_dir is not None:
+            # Still write the ccds that were finished.
+            writer.close()
+        raise
+
+    if ccd_data:
+        data = numpy.concatenate(ccd_data)
+    else:
+        data = numpy.empty(0, dtype=psf_cat_dtype)
+    memory_report('catalog for %s'%exp, data)
+    print('star moments for %s (warm_start = %s): %s'%(exp, args.warm_start, hsm_stats['stars']))
+    print('psf moments for %s (warm_start = %s): %s'%(exp, args.warm_start, hsm_stats['psf']))
+
+    if '_' in root:
+        exp_root = root.rsplit('_',1)[0]
+    else:
+        exp_root = root
+    print('exp_root = ',exp_root)
+    if cat_dir is not None:
+        writer.finish(exp_root)
+
+    return exp_root, data
+
+
+def main():
     args = parse_args()
 
     # Make the work directory if it does not exist yet.
@@ -721,308 +1577,7 @@ def main():
                 raise
 
     for run,exp in zip(runs,exps):
-
-        print('Start work on run, exp = ',run,exp)
-        try:
-            expnum = int(exp[6:])
-        except:
-            expnum = 0
-        print('expnum = ',expnum)
-
-        if args.output_dir is None:
-            exp_dir = os.path.join(work,exp)
-        else:
-            exp_dir = args.output_dir
-        print('exp_dir = ',exp_dir)
-
-        input_dir = args.input_dir
-        print('input_dir = ', input_dir)
-
-        # Get the file names in that directory.
-        print('%s/%s'%(input_dir,args.exp_match))
-        files = sorted(glob.glob('%s/%s'%(input_dir,args.exp_match)))
-
-        # Setup the columns for the output catalog:
-        ccdnum_col = []
-        x_col = []
-        y_col = []
-        ra_col = []
-        dec_col = []
-        mag_col = []
-        flag_col = []
-        e1_col = []
-        e2_col = []
-        size_col = []
-        psf_e1_col = []
-        psf_e2_col = []
-        psf_size_col = []
-
-        for file_name in files:
-            print('\nProcessing ', file_name)
-
-            try:
-                desdm_dir, root, ccdnum = parse_file_name(file_name)
-            except:
-                #print '   Unable to parse file_name %s.  Skipping this file.'%file_name
-                #continue
-                base_file = os.path.split(file_name)[1]
-                if os.path.splitext(base_file)[1] == '.fz':
-                    base_file=os.path.splitext(base_file)[0]
-                root = os.path.splitext(base_file)[0]
-                ccdnum = 0
-                desdm_dir = None
-            print('   root, ccdnum = ',root,ccdnum)
-            print('   desdm_dir = ',desdm_dir)
-
-            key = (expnum, ccdnum)
-            #if key in flag_dict:
-            #    black_flag = flag_dict[key]
-            #    print('   blacklist flag = ',black_flag)
-            #    if black_flag & (113 << 15):
-            #        print('   Catastrophic flag.  Skipping this file.')
-            #        if args.single_ccd:
-            #            break
-            #        continue
-            #else:
-            black_flag = 0
-
-            # Read the star data.  From both findstars and the PSFEx used file.
-            try:
-                fs_data = read_findstars(exp_dir, root)
-            except:
-                fs_data = None
-            if fs_data is None:
-                print('   No _findstars.fits file found')
-                if args.single_ccd:
-                    break
-                continue
-            n_tot = len(fs_data['id'])
-            n_fs = fs_data['star_flag'].sum()
-            print('   n_tot = ',n_tot)
-            print('   n_fs = ',n_fs)
-            mask = fs_data['star_flag'] == 1
-
-            if args.reference_tag:
-                used_dir = exp_dir.replace(args.tag, args.reference_tag)
-            else:
-                used_dir = exp_dir
-            used_data = read_used(used_dir, root, use_piff=args.use_piff)
-            if used_data is None:
-                print('   No .used.fits file found')
-                continue
-            n_used = len(used_data)
-            print('   n_used = ',n_used)
-            if n_used == 0:
-                print('   No stars were used.')
-                continue
-
-            tot_xmin = fs_data['x'].min()
-            tot_xmax = fs_data['x'].max()
-            tot_ymin = fs_data['y'].min()
-            tot_ymax = fs_data['y'].max()
-            tot_area = (tot_xmax-tot_xmin)*(tot_ymax-tot_ymin)
-            print('   bounds from sextractor = ',tot_xmin,tot_xmax,tot_ymin,tot_ymax)
-            print('   area = ',tot_area)
-
-            fs_xmin = fs_data['x'][mask].min()
-            fs_xmax = fs_data['x'][mask].max()
-            fs_ymin = fs_data['y'][mask].min()
-            fs_ymax = fs_data['y'][mask].max()
-            print('   bounds from findstars = ',fs_xmin,fs_xmax,fs_ymin,fs_ymax)
-            fs_area = (fs_xmax-fs_xmin)*(fs_ymax-fs_ymin)
-            print('   area = ',fs_area)
-
-            used_xmin = used_data['X_IMAGE'].min()
-            used_xmax = used_data['X_IMAGE'].max()
-            used_ymin = used_data['Y_IMAGE'].min()
-            used_ymax = used_data['Y_IMAGE'].max()
-            print('   final bounds of used stars = ',used_xmin,used_xmax,used_ymin,used_ymax)
-            used_area = (used_xmax-used_xmin)*(used_ymax-used_ymin)
-            print('   area = ',used_area)
-            print('   fraction used = ',float(used_area) / tot_area)
-
-            # Figure out which fs objects go with which used objects.
-            fs_index = find_fs_index(used_data, fs_data)
-            used_index = find_used_index(fs_data[mask], used_data)
-            print('   fs_index = ',fs_index)
-            print('   used_index = ',used_index)
-
-            # Check: This should be the same as the used bounds
-            alt_used_xmin = fs_data['x'][fs_index].min()
-            alt_used_xmax = fs_data['x'][fs_index].max()
-            alt_used_ymin = fs_data['y'][fs_index].min()
-            alt_used_ymax = fs_data['y'][fs_index].max()
-            print('   bounds from findstars[fs_index] = ', end=' ')
-            print(alt_used_xmin,alt_used_xmax,alt_used_ymin,alt_used_ymax)
- 
-            # Get the magnitude range for each catalog.
-            tot_magmin = fs_data['mag'].min()
-            tot_magmax = fs_data['mag'].max()
-            print('   magnitude range of full catalog = ',tot_magmin,tot_magmax)
-            fs_magmin = fs_data['mag'][mask].min()
-            fs_magmax = fs_data['mag'][mask].max()
-            print('   magnitude range of fs stars = ',fs_magmin,fs_magmax)
-            used_magmin = fs_data['mag'][fs_index].min()
-            used_magmax = fs_data['mag'][fs_index].max()
-            print('   magnitude range of used stars = ',used_magmin,used_magmax)
-
-            try:
-                # Get the wcs from the image file
-                wcs = get_wcs(file_name)
-
-                # Measure the shpes and sizes of the stars used by PSFEx.
-                x = fs_data['x'][mask]
-                y = fs_data['y'][mask]
-                mag = fs_data['mag'][mask]
-                e1, e2, size, meas_flag = measure_shapes(x, y, file_name, wcs, args.noweight)
-                # Measure the model shapes, sizes.
-                psf_file_name = os.path.join(exp_dir, root + '_psfcat.psf')
-                psf_e1, psf_e2, psf_size, psf_flag = measure_psf_shapes(
-                        x, y, psf_file_name, file_name, use_piff=args.use_piff)
-            except Exception as e:
-                print('Catastrophic error trying to measure the shapes:')
-                print(e)
-                print('Skip this file')
-                raise e
-                continue
-
-            # Put all the flags together:
-            flag = numpy.array([ m | p for m,p in zip(meas_flag,psf_flag) ])
-            print('meas_flag = ',meas_flag)
-            print('psf_flag = ',psf_flag)
-            print('flag = ',flag)
-
-            # Add in flags for bad indices
-            bad_index = numpy.where(used_index < 0)[0]
-            print('bad_index = ',bad_index)
-            flag[bad_index] |= NOT_USED
-            print('flag => ',flag)
-
-            # Add in flags for reserved stars
-            reserve_data = read_reserve(exp_dir, root)
-            if reserve_data is None:
-                print('   No _reserve.fits file found')
-            else:
-                n_reserve = len(reserve_data)
-                print('   n_reserve = ',n_reserve)
-
-                # Figure out which fs objects go with which reserved objects.
-                fs2_index = find_fs_index(reserve_data, fs_data, suffix='WIN_IMAGE')
-                res_index = find_used_index(fs_data[mask], reserve_data, suffix='WIN_IMAGE')
-                print('   fs2_index = ',fs2_index)
-                print('   res_index = ',res_index)
-
-                res_index = numpy.where(res_index >= 0)[0]
-                print('res_index = ',res_index)
-                flag[res_index] |= RESERVED
-                print('flag => ',flag)
-
-            # If the ccd is blacklisted, everything gets the blacklist flag
-            if black_flag:
-                print('black_flag = ',black_flag)
-                print('type(black_flag) = ',type(black_flag))
-                print('type(flag[0]) = ',type(flag[0]))
-                print('type(flag[0] | black_flag) = ',type(flag[0] | black_flag))
-                black_flag *= BLACK_FLAG_FACTOR
-                print('black_flag => ',black_flag)
-                flag |= black_flag
-                print('flag => ',flag)
-
-            # Compute ra,dec from the wcs:
-            coord = [ wcs.toWorld(galsim.PositionD(xx,yy)) for xx,yy in zip(x,y) ]
-            try:
-                ra = [ c.ra / galsim.degrees for c in coord ]
-                dec = [ c.dec / galsim.degrees for c in coord ]
-            except:
-                # Sims may be using simple WCS with no ra, dec.  Just take coord.x,y instead
-                ra = [ c.x * galsim.arcsec / galsim.degrees for c in coord]
-                dec = [ c.y * galsim.arcsec / galsim.degrees for c in coord]
-
-            # Extend the column arrays with this chip's data.
-            ccdnum_col.extend([ccdnum] * n_fs)
-            x_col.extend(x)
-            y_col.extend(y)
-            ra_col.extend(ra)
-            dec_col.extend(dec)
-            mag_col.extend(mag)
-            flag_col.extend(flag)
-            e1_col.extend(e1)
-            e2_col.extend(e2)
-            size_col.extend(size)
-            psf_e1_col.extend(psf_e1)
-            psf_e2_col.extend(psf_e2)
-            psf_size_col.extend(psf_size)
-            assert len(ccdnum_col) == len(x_col)
-            assert len(ccdnum_col) == len(y_col)
-            assert len(ccdnum_col) == len(ra_col)
-            assert len(ccdnum_col) == len(dec_col)
-            assert len(ccdnum_col) == len(mag_col)
-            assert len(ccdnum_col) == len(flag_col)
-            assert len(ccdnum_col) == len(e1_col)
-            assert len(ccdnum_col) == len(e2_col)
-            assert len(ccdnum_col) == len(size_col)
-            assert len(ccdnum_col) == len(psf_e1_col)
-            assert len(ccdnum_col) == len(psf_e2_col)
-            assert len(ccdnum_col) == len(psf_size_col)
-
-            cols = pyfits.ColDefs([
-                pyfits.Column(name='ccdnum', format='I', array=[ccdnum] * n_fs),
-                pyfits.Column(name='x', format='E', array=x),
-                pyfits.Column(name='y', format='E', array=y),
-                pyfits.Column(name='ra', format='E', array=ra),
-                pyfits.Column(name='dec', format='E', array=dec),
-                pyfits.Column(name='mag', format='E', array=mag),
-                pyfits.Column(name='flag', format='J', array=flag),
-                pyfits.Column(name='e1', format='E', array=e1),
-                pyfits.Column(name='e2', format='E', array=e2),
-                pyfits.Column(name='size', format='E', array=size),
-                pyfits.Column(name='psf_e1', format='E', array=psf_e1),
-                pyfits.Column(name='psf_e2', format='E', array=psf_e2),
-                pyfits.Column(name='psf_size', format='E', array=psf_size),
-                ])
-
-            # Depending on the version of pyfits, one of these should work:
-            try:
-                tbhdu = pyfits.BinTableHDU.from_columns(cols)
-            except:
-                tbhdu = pyfits.new_table(cols)
-            cat_file = os.path.join(cat_dir, root + "_psf.fits")
-            tbhdu.writeto(cat_file, clobber=True)
-            print('wrote cat_file = ',cat_file)
-
-            if args.single_ccd:
-                break
-
-
-        cols = pyfits.ColDefs([
-            pyfits.Column(name='ccdnum', format='I', array=ccdnum_col),
-            pyfits.Column(name='x', format='E', array=x_col),
-            pyfits.Column(name='y', format='E', array=y_col),
-            pyfits.Column(name='ra', format='E', array=ra_col),
-            pyfits.Column(name='dec', format='E', array=dec_col),
-            pyfits.Column(name='mag', format='E', array=mag_col),
-            pyfits.Column(name='flag', format='J', array=flag_col),
-            pyfits.Column(name='e1', format='E', array=e1_col),
-            pyfits.Column(name='e2', format='E', array=e2_col),
-            pyfits.Column(name='size', format='E', array=size_col),
-            pyfits.Column(name='psf_e1', format='E', array=psf_e1_col),
-            pyfits.Column(name='psf_e2', format='E', array=psf_e2_col),
-            pyfits.Column(name='psf_size', format='E', array=psf_size_col),
-            ])
-
-        # Depending on the version of pyfits, one of these should work:
-        try:
-            tbhdu = pyfits.BinTableHDU.from_columns(cols)
-        except:
-            tbhdu = pyfits.new_table(cols)
-        if '_' in root:
-            exp_root = root.rsplit('_',1)[0]
-        else:
-            exp_root = root
-        print('exp_root = ',exp_root)
-        cat_file = os.path.join(cat_dir, exp_root + "_exppsf.fits")
-        tbhdu.writeto(cat_file, clobber=True)
-        print('wrote cat_file = ',cat_file)
+        build_exposure(args, run, exp, cat_dir)
 
     print('\nFinished processing all exposures')
 
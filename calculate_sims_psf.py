@@ -1,36 +1,143 @@
 #/usr/bin/env python3
 # run sextractor and psfex to extract psf info from these files.
+# Chips are independent, so they are run concurrently on a bounded pool of workers.
+# Within a chip, psfex runs only after sextractor succeeds.
 import sys
 import subprocess
 import os
+import glob
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 config_dir = '.' #"/Users/adamwheeler/Dropbox/Niall"
 sims_dir = 'sims'
-nchips = 30
 prefix = "sim_DECam_00241238"
 
-files = os.listdir(sims_dir)
-
-for index in [str(i+1).zfill(2) for i in range(nchips)]:
-    if "{}_{}.fits".format(prefix,index) not in files:
-        print("WARNING: skipping chip " + index)
-        continue
-
-    sex_cmd = ("sex "\
-            + "-c {config}/psfex.sex "\
-            + "{sims}/{prefix}_{i}.fits'[0]' "\
-            + "-WEIGHT_IMAGE {sims}/{prefix}_{i}.fits'[2]' "\
-            + "-CATALOG_NAME {sims}/{prefix}_{i}_psfcat.fits "\
-            + "-PARAMETERS_NAME {config}/psfex.param "\
-            + "-FILTER_NAME {config}/default.conv"\
-            ).format(config=config_dir, i=index, sims=sims_dir, prefix=prefix)
-    print(sex_cmd)
-    subprocess.call(sex_cmd, shell=True)
-
-    psf_cmd = ("psfex "\
-            + "-c {config}/config.psfex "\
-            + "{sims}/{prefix}_{i}_psfcat.fits "\
-            + "-OUTCAT_NAME {sims}/{prefix}_{i}_psfcat.used.fits"\
-            ).format(config=config_dir, sims=sims_dir, i=index, prefix=prefix)
-    print(psf_cmd)
-    subprocess.call(psf_cmd, shell=True)
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run sextractor and psfex on the simulated chips')
+
+    parser.add_argument('--config_dir', default=config_dir,
+                        help='location of the sextractor and psfex config files')
+    parser.add_argument('--sims_dir', default=sims_dir,
+                        help='location of the simulated images')
+    parser.add_argument('--prefix', default=prefix,
+                        help='file name prefix of the simulated images')
+    parser.add_argument('--nproc', default=os.cpu_count(), type=int,
+                        help='number of chips to run at once')
+    parser.add_argument('--retries', default=1, type=int,
+                        help='number of times to retry a failed chip')
+    parser.add_argument('--log_dir', default=None,
+                        help='where to write the per-chip logs (default: {sims_dir}/logs)')
+    parser.add_argument('--clobber', default=False, action='store_const', const=True,
+                        help='rerun chips even if their psf file is up to date')
+
+    args = parser.parse_args()
+    return args
+
+
+def chip_commands(args, index):
+    """Return the sextractor and psfex commands for a chip as argument lists.
+    """
+    img = os.path.join(args.sims_dir, '{}_{}.fits'.format(args.prefix, index))
+    cat = os.path.join(args.sims_dir, '{}_{}_psfcat.fits'.format(args.prefix, index))
+    used = os.path.join(args.sims_dir, '{}_{}_psfcat.used.fits'.format(args.prefix, index))
+
+    sex_cmd = ['sex',
+               '-c', os.path.join(args.config_dir, 'psfex.sex'),
+               img + '[0]',
+               '-WEIGHT_IMAGE', img + '[2]',
+               '-CATALOG_NAME', cat,
+               '-PARAMETERS_NAME', os.path.join(args.config_dir, 'psfex.param'),
+               '-FILTER_NAME', os.path.join(args.config_dir, 'default.conv')]
+
+    psf_cmd = ['psfex',
+               '-c', os.path.join(args.config_dir, 'config.psfex'),
+               cat,
+               '-OUTCAT_NAME', used]
+
+    return sex_cmd, psf_cmd
+
+
+def up_to_date(args, index):
+    """Check whether the chip's _psfcat.psf file is newer than all of its inputs.
+    """
+    psf_file = os.path.join(args.sims_dir, '{}_{}_psfcat.psf'.format(args.prefix, index))
+    if not os.path.exists(psf_file):
+        return False
+    inputs = [ os.path.join(args.sims_dir, '{}_{}.fits'.format(args.prefix, index)) ]
+    inputs += [ os.path.join(args.config_dir, f)
+                for f in ['psfex.sex', 'psfex.param', 'default.conv', 'config.psfex'] ]
+    psf_time = os.path.getmtime(psf_file)
+    return all(psf_time > os.path.getmtime(f) for f in inputs if os.path.exists(f))
+
+
+def run_chip(args, index, log_dir):
+    """Run sextractor and then psfex for a single chip.
+
+    Output of both programs goes to {log_dir}/{prefix}_{index}.log.
+
+    Returns (index, success, message).
+    """
+    log_file = os.path.join(log_dir, '{}_{}.log'.format(args.prefix, index))
+    sex_cmd, psf_cmd = chip_commands(args, index)
+
+    for attempt in range(args.retries + 1):
+        with open(log_file, 'a' if attempt > 0 else 'w') as log:
+            status = None
+            for cmd in [sex_cmd, psf_cmd]:
+                log.write('$ ' + ' '.join(cmd) + '\n')
+                log.flush()
+                try:
+                    status = subprocess.call(cmd, stdout=log, stderr=subprocess.STDOUT)
+                except OSError as e:
+                    log.write('Caught %s\n'%e)
+                    status = -1
+                if status != 0:
+                    log.write('%s exited with status %d (attempt %d)\n'%(cmd[0], status, attempt+1))
+                    break
+        if status == 0:
+            return index, True, 'ok'
+    return index, False, '%s failed; see %s'%(cmd[0], log_file)
+
+
+def main():
+    args = parse_args()
+
+    log_dir = args.log_dir
+    if log_dir is None:
+        log_dir = os.path.join(args.sims_dir, 'logs')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    # Do every chip present in sims_dir.
+    pattern = re.compile(re.escape(args.prefix) + r'_(\d\d)\.fits$')
+    files = glob.glob(os.path.join(args.sims_dir, args.prefix + '_[0-9][0-9].fits'))
+    indices = sorted(pattern.search(f).group(1) for f in files)
+    print('Found {} chips in {}'.format(len(indices), args.sims_dir))
+
+    todo = []
+    for index in indices:
+        if not args.clobber and up_to_date(args, index):
+            print('chip {} is up to date.  Skipping.'.format(index))
+        else:
+            todo.append(index)
+
+    failures = []
+    with ThreadPoolExecutor(max_workers=max(args.nproc,1)) as executor:
+        futures = [ executor.submit(run_chip, args, index, log_dir) for index in todo ]
+        for future in as_completed(futures):
+            index, success, message = future.result()
+            print('chip {}: {}'.format(index, message))
+            if not success:
+                failures.append(index)
+
+    if failures:
+        print('FAILED chips: ', sorted(failures))
+        sys.exit(1)
+    print('Done {} chips.'.format(len(todo)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+#! /usr/bin/env python
+# A columnar store of the psf star catalogs, as a Parquet dataset partitioned by filter and
+# exposure number:
+#     {store}/filter=r/expnum=241238/part-0.parquet
+#
+# Queries on filter, exposure, tiling, flag and ccdnum are pushed down to the dataset scan,
+# so only the matching partitions and the requested columns are read.
+#
+# Build the store from the psf_cats files written by build_psf_cats.py with e.g.
+#     python catalog_store.py --work sims --exps 00241238 --runs 1
+# and then use it in run_rho2.py with --store.
+
+import os
+import numpy
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Add psf catalogs to the columnar star catalog store')
+
+    # Drectory arguments
+    parser.add_argument('--work', default='./',
+                        help='location of work directory')
+    parser.add_argument('--store', default=None,
+                        help='location of the store (default: {work}/star_store)')
+    parser.add_argument('--expinfo', default=None,
+                        help='the exposure info file (default: {work}/exposure_info.fits)')
+
+    # Exposure inputs
+    parser.add_argument('--file', default='',
+                        help='list of run/exposures (in lieu of separate exps, runs)')
+    parser.add_argument('--exps', default='', nargs='+',
+                        help='list of exposures to run')
+    parser.add_argument('--runs', default='', nargs='+',
+                        help='list of runs')
+
+    args = parser.parse_args()
+    return args
+
+
+def open_store(store_dir):
+    """Open the store as a pyarrow dataset.
+    """
+    import pyarrow.dataset as ds
+    return ds.dataset(store_dir, format='parquet', partitioning='hive')
+
+def write_exposure(store_dir, data, expnum, filter, tiling=0):
+    """Add (or replace) the catalog for one exposure in the store.
+
+    data is a structured array as written by build_psf_cats (e.g. the _exppsf.fits catalog).
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if isinstance(filter, bytes):
+        filter = filter.decode()
+    filter = filter.strip()
+    cols = { name : numpy.asarray(data[name]) for name in data.dtype.names }
+    # FITS data are big-endian, which arrow doesn't take.
+    cols = { name : col.astype(col.dtype.newbyteorder('=')) for name, col in cols.items() }
+    cols['tiling'] = numpy.full(len(data), tiling, dtype=numpy.int16)
+    table = pa.table(cols)
+
+    part_dir = os.path.join(store_dir, 'filter=%s'%filter, 'expnum=%d'%expnum)
+    if not os.path.isdir(part_dir):
+        os.makedirs(part_dir)
+    part_file = os.path.join(part_dir, 'part-0.parquet')
+    pq.write_table(table, part_file + '.tmp')
+    os.rename(part_file + '.tmp', part_file)
+    print('wrote %d stars to %s'%(len(data), part_file))
+
+def query(store_dir, columns=None, filters=None, expnums=None, max_tiling=None, flag=None,
+          ccds=None, exclude_ccds=None):
+    """Read the stars matching the given selection from the store.
+
+    columns         The columns to read (default: all).  The partition columns filter and
+                    expnum may be included.
+    filters         A list of filters to use (e.g. ['r', 'i']).
+    expnums         A list of exposure numbers to use.
+    max_tiling      Only use exposures with tiling <= max_tiling.
+    flag            Only use stars with this exact flag value (e.g. 0 for good stars).
+    ccds            Only use these ccdnums.
+    exclude_ccds    Skip these ccdnums.
+
+    Returns a numpy structured array.
+    """
+    import pyarrow.dataset as ds
+
+    dataset = open_store(store_dir)
+    expr = None
+    def add(e):
+        return e if expr is None else expr & e
+    if filters is not None:
+        filters = [ f.decode() if isinstance(f, bytes) else f for f in filters ]
+        expr = add(ds.field('filter').isin(filters))
+    if expnums is not None:
+        expr = add(ds.field('expnum').isin([ int(e) for e in expnums ]))
+    if max_tiling is not None:
+        expr = add(ds.field('tiling') <= int(max_tiling))
+    if flag is not None:
+        expr = add(ds.field('flag') == int(flag))
+    if ccds is not None:
+        expr = add(ds.field('ccdnum').isin([ int(c) for c in ccds ]))
+    if exclude_ccds is not None:
+        expr = add(~ds.field('ccdnum').isin([ int(c) for c in exclude_ccds ]))
+
+    table = dataset.to_table(columns=columns, filter=expr)
+
+    arrays = []
+    for name in table.column_names:
+        col = table.column(name).to_numpy()
+        if col.dtype == object:
+            col = col.astype(str)
+        arrays.append(col)
+    dtype = [ (name, a.dtype) for name, a in zip(table.column_names, arrays) ]
+    data = numpy.empty(table.num_rows, dtype=dtype)
+    for name, a in zip(table.column_names, arrays):
+        data[name] = a
+    return data
+
+
+def main():
+    import fitsio
+
+    args = parse_args()
+    work = os.path.expanduser(args.work)
+    store_dir = args.store or os.path.join(work, 'star_store')
+    expinfo_file = args.expinfo or os.path.join(work, 'exposure_info.fits')
+    cat_dir = os.path.join(work, 'psf_cats')
+
+    if args.file != '':
+        with open(args.file) as fin:
+            data = [ line.split() for line in fin ]
+        runs, exps = list(zip(*data))
+    else:
+        runs = args.runs
+        exps = args.exps
+
+    expinfo = fitsio.read(expinfo_file)
+
+    for run, exp in zip(runs, exps):
+        print('Start work on run, exp = ',run,exp)
+        expnum = int(exp[6:])
+        if expnum not in expinfo['expnum']:
+            print('Could not find information about this expnum.  Skipping ',run,exp)
+            continue
+        k = numpy.nonzero(expinfo['expnum'] == expnum)[0][0]
+
+        # Same file names as run_rho2.read_data looks for.
+        cat_file = os.path.join(cat_dir, "sim_DECam_" + exp + "_exppsf.fits")
+        if not os.path.exists(cat_file):
+            cat_file = os.path.join(cat_dir, exp + "_psf.fits")
+        if not os.path.exists(cat_file):
+            print('Unable to find cat_file %s.  Skipping this file.'%cat_file)
+            continue
+        data = fitsio.read(cat_file)
+        write_exposure(store_dir, data, expnum, expinfo['filter'][k], int(expinfo['tiling'][k]))
+
+
+if __name__ == "__main__":
+    main()
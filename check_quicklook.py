@@ -0,0 +1,106 @@
+#! /usr/bin/env python
+# Check the quick look rho statistics (run_rho2.py --quick) against the full calculation.
+#
+# This reads the combined psf catalog written by run_rho2.py (psf_{tag}.fits), computes the
+# rho statistics with all the stars and on subsamples with several seeds, and reports for each
+# subsample size how far the quick look values are from the full ones in units of the quick
+# look errors, and how often the significance flags agree.
+#
+#     python check_quicklook.py --work sims --tag trial --quick 10000 30000 --nseed 5
+
+import os
+import json
+import numpy
+import run_rho2
+from star_schema import filter_code
+
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Compare quick look rho stats to the full ones')
+
+    parser.add_argument('--work', default='./',
+                        help='location of work directory')
+    parser.add_argument('--tag', default='trial',
+                        help='the tag of the psf_{tag}.fits catalog to use')
+    parser.add_argument('--filter', default='r',
+                        help='which filter to use')
+    parser.add_argument('--quick', default=[10000], type=int, nargs='+',
+                        help='subsample sizes to check')
+    parser.add_argument('--nseed', default=5, type=int,
+                        help='number of random seeds to try for each size')
+    parser.add_argument('--seed', default=1234, type=int,
+                        help='first random seed')
+    parser.add_argument('--nsig', default=3., type=float,
+                        help='significance (in sigma) for the flags')
+
+    args = parser.parse_args()
+    return args
+
+
+def compare(full, quick):
+    """Compare the full and quick look rho stats.
+
+    Returns a dict with, for each of rho1..rho5, the rms of (quick-full)/sigma_quick over
+    the bins of xi+ and xi-, where sigma_quick is the quick look error.  This should be
+    about 1 if the quick look errors are right (a bit less, since the subsample is not
+    independent of the full sample).
+    """
+    result = {}
+    for i in range(5):
+        sigma = numpy.array(quick['rho%d'%(i+1)]['sigma'])
+        dp = (numpy.array(quick['rho%d'%(i+1)]['xip']) - full[i].xip) / sigma
+        dm = (numpy.array(quick['rho%d'%(i+1)]['xim']) - full[i].xim) / sigma
+        result['rho%d'%(i+1)] = float(numpy.sqrt(numpy.mean(numpy.concatenate([dp, dm])**2)))
+    return result
+
+
+def flag_agreement(full, quick, nsig):
+    """The fraction of bins where the quick look significance flag for xi+ agrees with
+    whether the full result is nonzero at nsig sigma (using the full errors).
+    """
+    agree = []
+    for i in range(5):
+        full_sig = numpy.abs(full[i].xip) > nsig * numpy.sqrt(full[i].varxi)
+        agree.append(numpy.mean(numpy.array(quick['rho%d'%(i+1)]['xip_significant']) == full_sig))
+    return float(numpy.mean(agree))
+
+
+def main():
+    import fitsio
+
+    args = parse_args()
+    work = os.path.expanduser(args.work)
+    cat_file = os.path.join(work, "psf_%s.fits"%args.tag)
+    print('reading ',cat_file)
+    data = fitsio.read(cat_file)
+    data = data[data['filter'] == filter_code(args.filter)]
+    print('n = ',len(data))
+
+    full = run_rho2.measure_rho(data, max_sep=300, tag=args.filter)
+
+    report = { 'ntot' : len(data), 'nsig' : args.nsig, 'sizes' : {} }
+    for nstar in args.quick:
+        results = []
+        for seed in range(args.seed, args.seed + args.nseed):
+            index = run_rho2.stratified_subsample(data, nstar, seed)
+            stats = run_rho2.measure_rho(data[index], max_sep=300, tag=args.filter)
+            quick = run_rho2.quicklook_summary(stats, len(index), len(data), args.nsig)
+            rms = compare(full, quick)
+            rms['flag_agreement'] = flag_agreement(full, quick, args.nsig)
+            results.append(rms)
+        report['sizes'][nstar] = results
+        print('nstar = %d:'%nstar)
+        for key in ['rho1', 'rho2', 'rho3', 'rho4', 'rho5', 'flag_agreement']:
+            print('    %s: mean = %.3f  max = %.3f'%(
+                key, numpy.mean([r[key] for r in results]), numpy.max([r[key] for r in results])))
+
+    out_file = os.path.join(work, "check_quicklook_%s.json"%args.tag)
+    with open(out_file,'w') as fp:
+        json.dump(report, fp)
+    print('Done writing ',out_file)
+
+
+if __name__ == "__main__":
+    main()
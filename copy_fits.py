@@ -1,8 +1,14 @@
 # copy weightmap and bad-pixel HDUs from real images to simulated ones.
 # (because they were used for the simulations)
 # also copy header entries!
+#
+# The HDU data are copied as raw FITS blocks straight from the input files, without being
+# loaded or converted.  Only the sim's primary header is edited (to add the transplanted
+# keywords), and the real HDU headers are only rewritten if they need fixing.
+# Chips are processed in parallel.
 
-import subprocess
+import os
+from concurrent.futures import ThreadPoolExecutor
 from astropy.io import fits
 
 #these will need to be changed
@@ -11,22 +17,127 @@ sim_fn = "/Users/adamwheeler/galsim_extra/examples/output/sim_DECam_00241238_{}.
 
 output_fn = "sims/sim_DECam_00241238_{}.fits"
 
-print( "{} + {} -> {}".format(sim_fn, real_fn, output_fn))
-print("")
-
-
-for no in [f'{n:02}' for n in range(1,30) if n != 31 and n!= 61]:
-    #copy hdus and headers
-    reals = fits.open(real_fn.format(no))
-    reals.verify('fix')
-    sims = fits.open(sim_fn.format(no))
-    sims.verify('fix')
-    for key in reals[0].header.keys():
-        if key in ['DATE-OBS', 'FILTER', 'CCDNUM', 'DETPOS', 'TELRA', 'TELDEC', 'HA']:
-            sims[0].header[key] = reals[0].header[key]
-    hdus = fits.HDUList([sims[0], reals[1], reals[2]])
-    hdus.verify('fix')
-    #save to sims dir
-    hdus.writeto(output_fn.format(no), overwrite=True)
-
-    
+# The header keywords to copy from the real image to the sim.
+header_keys = ['DATE-OBS', 'FILTER', 'CCDNUM', 'DETPOS', 'TELRA', 'TELDEC', 'HA']
+
+block_size = 16 * 1024 * 1024
+
+def parse_args():
+    import argparse
+    import toFocal
+
+    parser = argparse.ArgumentParser(description='Copy the real weight, bad pixel and header info to the sims')
+
+    parser.add_argument('--real', default=real_fn,
+                        help='format string for the real image file names')
+    parser.add_argument('--sim', default=sim_fn,
+                        help='format string for the simulated image file names')
+    parser.add_argument('--output', default=output_fn,
+                        help='format string for the output file names')
+    parser.add_argument('--ccds', default=toFocal.ccd_table['ccdnum'][1:].tolist(), type=int,
+                        nargs='+', help='which ccds to do (default: all)')
+    parser.add_argument('--nproc', default=os.cpu_count(), type=int,
+                        help='number of chips to do at once')
+
+    args = parser.parse_args()
+    return args
+
+
+def copy_bytes(fin, fout, start, length):
+    """Copy length bytes starting at start from fin to the current position of fout.
+    """
+    fin.seek(start)
+    while length > 0:
+        buf = fin.read(min(length, block_size))
+        if not buf:
+            raise IOError('Unexpected end of file in %s'%fin.name)
+        fout.write(buf)
+        length -= len(buf)
+
+def fixed_header(hdu):
+    """The fixed header of hdu, or None if it doesn't need fixing.
+    """
+    try:
+        hdu.verify('exception')
+    except fits.VerifyError:
+        hdu.verify('silentfix')
+        return hdu.header
+    return None
+
+def copy_hdu(hdus, i, fin, fout, header=None):
+    """Copy HDU i of the opened (but not loaded) hdus, whose file is fin, to fout.
+
+    If header is given, write it in place of the original header.  Otherwise the header
+    blocks are copied verbatim unless the header needs to be fixed.
+    """
+    # (fileinfo fixes the header as a side effect, so check it first.)
+    if header is None:
+        if isinstance(hdus[i], fits.CompImageHDU):
+            # The header astropy gives a compressed image is that of the decompressed image.
+            # The one that goes with the data on disk is the BINTABLE header.
+            with fits.open(fin.name, memmap=True, lazy_load_hdus=False,
+                           disable_image_compression=True) as raw:
+                header = fixed_header(raw[i])
+        else:
+            header = fixed_header(hdus[i])
+    info = hdus.fileinfo(i)
+    if header is None:
+        copy_bytes(fin, fout, info['hdrLoc'], info['datLoc'] - info['hdrLoc'])
+    else:
+        fout.write(header.tostring().encode('ascii'))
+    copy_bytes(fin, fout, info['datLoc'], info['datSpan'])
+
+def transplant_header(header, real_header):
+    """Copy the header_keys from real_header into header.
+    """
+    for key in header_keys:
+        if key in real_header:
+            header[key] = real_header[key]
+
+def copy_chip(args, no):
+    """Write the output file for one chip: the sim image with the transplanted header keys,
+    followed by the weight and bad pixel HDUs of the real image.
+    """
+    real_file = args.real.format(no)
+    sim_file = args.sim.format(no)
+    out_file = args.output.format(no)
+    for f in [real_file, sim_file]:
+        if not os.path.exists(f):
+            return "WARNING: skipping chip {}.  {} not found".format(no, f)
+
+    # Opening the files only parses the headers.  The data are never read in.
+    with open(real_file, 'rb') as real_in, open(sim_file, 'rb') as sim_in, \
+         fits.open(real_in, memmap=True, lazy_load_hdus=False) as reals, \
+         fits.open(sim_in, memmap=True, lazy_load_hdus=False) as sims:
+        sims[0].verify('silentfix')
+        header = sims[0].header
+        transplant_header(header, reals[0].header)
+
+        #save to sims dir
+        tmp_file = out_file + '.tmp'
+        with open(tmp_file, 'wb') as fout:
+            copy_hdu(sims, 0, sim_in, fout, header=header)
+            copy_hdu(reals, 1, real_in, fout)
+            copy_hdu(reals, 2, real_in, fout)
+        os.rename(tmp_file, out_file)
+    return "{} + {} -> {}".format(sim_file, real_file, out_file)
+
+
+def main():
+    args = parse_args()
+
+    print( "{} + {} -> {}".format(args.sim, args.real, args.output))
+    print("")
+
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    nos = [f'{n:02}' for n in args.ccds]
+    with ThreadPoolExecutor(max_workers=max(args.nproc,1)) as executor:
+        for message in executor.map(lambda no: copy_chip(args, no), nos):
+            print(message)
+
+
+if __name__ == "__main__":
+    main()
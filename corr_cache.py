@@ -0,0 +1,106 @@
+# A persistent cache of correlation results, so rerunning run_rho2.py on the same stars with
+# the same settings doesn't redo the correlations.  (build_psf_cats.py also uses it for the
+# star shape measurements.)
+#
+# Each job is keyed by a hash of the data it correlates (the values of the columns used, after
+# any selection, so the key also captures the mask), the settings, and the code that computes
+# it (the source of the measuring function, and the TreeCorr or other package versions).  The results are
+# pickled into {cache_dir}/{key}.pkl.  The total size is bounded by removing the least recently
+# used entries, using the file modification times, which are updated on each hit.
+
+import os
+import glob
+import json
+import hashlib
+import pickle
+import inspect
+import importlib
+import numpy
+
+
+class CorrCache(object):
+    """A directory of pickled results, bounded to max_bytes in total.
+    """
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, arrays, config, funcs=(), packages=('treecorr',)):
+        """Make the key for a job.
+
+        arrays      A list of the numpy arrays the job uses.
+        config      A json serializable dict of the settings.
+        funcs       The functions (or modules) whose source should invalidate the cache when
+                    it changes.
+        packages    The names of the packages whose versions should invalidate the cache when
+                    they change.
+        """
+        h = hashlib.sha1()
+        for a in arrays:
+            a = numpy.ascontiguousarray(a)
+            h.update(str(a.dtype.newbyteorder('=')).encode())
+            h.update(str(a.shape).encode())
+            h.update(a.astype(a.dtype.newbyteorder('=')).tobytes())
+        h.update(json.dumps(config, sort_keys=True).encode())
+        for name in packages:
+            h.update(importlib.import_module(name).__version__.encode())
+        for f in funcs:
+            h.update(inspect.getsource(f).encode())
+        return h.hexdigest()
+
+    def file_name(self, key):
+        return os.path.join(self.cache_dir, key + '.pkl')
+
+    def get(self, key):
+        """Return the cached result for key, or None.
+        """
+        file_name = self.file_name(key)
+        try:
+            with open(file_name, 'rb') as f:
+                result = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        # Mark it as recently used.  (Another process may have evicted it already, which is
+        # fine, since we have the result.)
+        try:
+            os.utime(file_name)
+        except OSError:
+            pass
+        print('Using cached result ',file_name)
+        return result
+
+    def put(self, key, result):
+        """Store result under key, and evict old entries if necessary.
+        """
+        file_name = self.file_name(key)
+        tmp_file = file_name + '.%d.tmp'%os.getpid()
+        with open(tmp_file, 'wb') as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, file_name)
+        print('Cached result in ',file_name)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the total size is under max_bytes.
+        """
+        entries = []
+        for file_name in glob.glob(os.path.join(self.cache_dir, '*.pkl')):
+            try:
+                st = os.stat(file_name)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, file_name))
+        entries.sort()
+        total = sum(e[1] for e in entries)
+        # Always keep the newest one, even if it is bigger than max_bytes by itself.
+        for mtime, size, file_name in entries[:-1]:
+            if total <= self.max_bytes:
+                break
+            print('Evicting cached result ',file_name)
+            try:
+                os.remove(file_name)
+            except OSError:
+                pass
+            total -= size
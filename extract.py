@@ -0,0 +1,162 @@
+# In-process source extraction using sep (https://github.com/kbarbary/sep).
+# This produces the SExtractor columns that build_psf_cats needs directly from an image array,
+# using the same thresholds as psfex.sex, so there is no need to run the sex binary and read
+# back its FITS_LDAC catalog.
+import os
+import numpy
+
+config_dir = os.path.dirname(os.path.abspath(__file__))
+
+# The SExtractor FLAGS values we can reproduce from sep's flags.
+SEX_NEIGHBOURS = 1      # Aperture contains neighbours or bad pixels
+SEX_BLENDED = 2         # Object was deblended
+SEX_SATURATED = 4       # At least one pixel is saturated
+SEX_TRUNCATED = 8       # Object is truncated by the image boundary
+SEX_APER_INCOMPLETE = 16  # Aperture data are incomplete or corrupted
+
+columns = [('NUMBER', 'i4'), ('X_IMAGE', 'f8'), ('Y_IMAGE', 'f8'), ('MAG_AUTO', 'f4'),
+           ('FLUX_RADIUS', 'f4'), ('BACKGROUND', 'f4'), ('FLAGS', 'i2')]
+
+
+def read_sex_config(file_name):
+    """Read a SExtractor config file into a dict of key -> value string.
+    """
+    config = {}
+    with open(file_name) as f:
+        for line in f:
+            line = line.split('#',1)[0].strip()
+            if not line:
+                continue
+            words = line.split(None,1)
+            config[words[0]] = words[1].strip() if len(words) > 1 else ''
+    return config
+
+def read_conv(file_name):
+    """Read a SExtractor convolution file (e.g. default.conv) into a kernel array.
+    """
+    with open(file_name) as f:
+        lines = [ line.split('#',1)[0].strip() for line in f ]
+    rows = [ [ float(v) for v in line.split() ] for line in lines
+             if line and not line.startswith('CONV') ]
+    return numpy.array(rows)
+
+
+def extract_sources(image, weight=None, badpix=None, sex_config=None, return_background=False):
+    """Detect and measure sources in an image array.
+
+    image is a 2d numpy array (e.g. galsim Image.array), not yet background subtracted.
+    weight is an optional inverse variance map.  Pixels with weight <= 0 or badpix != 0
+    are masked.
+
+    The detection and photometry parameters are taken from sex_config (default: psfex.sex in
+    this directory), as the sex binary would.
+
+    Returns a structured array with the columns NUMBER, X_IMAGE, Y_IMAGE, MAG_AUTO, FLUX_RADIUS,
+    BACKGROUND, FLAGS, using SExtractor's conventions (1-based pixel positions, mag = 99 for
+    non-positive flux).  If return_background=True, also return the background map.
+    """
+    import sep
+
+    if sex_config is None:
+        sex_config = os.path.join(config_dir, 'psfex.sex')
+    config = read_sex_config(sex_config)
+
+    # sep needs native byte order, which FITS data are usually not.
+    data = numpy.ascontiguousarray(image, dtype=numpy.float64)
+
+    mask = numpy.zeros(data.shape, dtype=bool)
+    var = None
+    if weight is not None:
+        weight = numpy.asarray(weight)
+        mask |= weight <= 0
+        var = numpy.zeros(data.shape, dtype=numpy.float64)
+        var[~mask] = 1. / weight[~mask]
+    if badpix is not None:
+        mask |= numpy.asarray(badpix) != 0
+
+    back_size = [ int(v) for v in config.get('BACK_SIZE','64').split(',') ]
+    back_filtersize = [ int(v) for v in config.get('BACK_FILTERSIZE','3').split(',') ]
+    bkg = sep.Background(data, mask=mask, bw=back_size[0], bh=back_size[-1],
+                         fw=back_filtersize[0], fh=back_filtersize[-1])
+    back = bkg.back()
+    data_sub = data - back
+
+    if config.get('FILTER','Y') == 'Y':
+        conv_file = config.get('FILTER_NAME','default.conv')
+        if not os.path.isabs(conv_file):
+            conv_file = os.path.join(os.path.dirname(sex_config), conv_file)
+        kernel = read_conv(conv_file)
+    else:
+        kernel = None
+
+    thresh = float(config.get('DETECT_THRESH','1.5').split(',')[0])
+    if var is None:
+        err = bkg.globalrms
+        noise = { 'err' : err }
+    else:
+        err = numpy.sqrt(var)
+        noise = { 'var' : var }
+    objs = sep.extract(data_sub, thresh, mask=mask,
+                       minarea=int(config.get('DETECT_MINAREA','5')),
+                       filter_kernel=kernel,
+                       deblend_nthresh=int(config.get('DEBLEND_NTHRESH','32')),
+                       deblend_cont=float(config.get('DEBLEND_MINCONT','0.005')),
+                       clean=config.get('CLEAN','Y') == 'Y',
+                       clean_param=float(config.get('CLEAN_PARAM','1.0')),
+                       **noise)
+    n = len(objs)
+    x = objs['x']
+    y = objs['y']
+    a = objs['a']
+    b = objs['b']
+    theta = objs['theta']
+
+    # MAG_AUTO: Kron photometry with PHOT_AUTOPARAMS = <Kron_fact>,<min_radius>
+    kron_fact, min_radius = [ float(v) for v in config.get('PHOT_AUTOPARAMS','2.5, 3.5').split(',') ]
+    kronrad, kflag = sep.kron_radius(data_sub, x, y, a, b, theta, 6.0, mask=mask)
+    kronrad = numpy.maximum(kronrad, 0.)
+    flux, fluxerr, aflag = sep.sum_ellipse(data_sub, x, y, a, b, theta, kron_fact*kronrad,
+                                           err=err, mask=mask, subpix=1)
+    aflag |= kflag
+    # Use a circular aperture of diameter min_radius when the Kron radius is too small.
+    r_min = min_radius / 2.
+    use_circle = kronrad * numpy.sqrt(a*b) < r_min
+    if numpy.any(use_circle):
+        cflux, cfluxerr, cflag = sep.sum_circle(data_sub, x[use_circle], y[use_circle], r_min,
+                                                err=err, mask=mask, subpix=1)
+        flux[use_circle] = cflux
+        aflag[use_circle] = cflag
+    mag_zp = float(config.get('MAG_ZEROPOINT','0.0'))
+    mag = numpy.full(n, 99.)
+    pos = flux > 0
+    mag[pos] = mag_zp - 2.5 * numpy.log10(flux[pos])
+
+    # FLUX_RADIUS (half light radius) relative to the MAG_AUTO flux.
+    radius, rflag = sep.flux_radius(data_sub, x, y, 6.*a, 0.5, normflux=flux, mask=mask,
+                                    subpix=5)
+
+    # Translate the flags.
+    flags = numpy.zeros(n, dtype=int)
+    flags[(objs['flag'] & sep.OBJ_MERGED) != 0] |= SEX_BLENDED
+    flags[(objs['flag'] & sep.OBJ_TRUNC) != 0] |= SEX_TRUNCATED
+    flags[((aflag | rflag) & sep.APER_HASMASKED) != 0] |= SEX_NEIGHBOURS
+    flags[((aflag | rflag) & sep.APER_TRUNC) != 0] |= SEX_APER_INCOMPLETE
+    satur = float(config.get('SATUR_LEVEL','50000.0'))
+    flags[objs['peak'] + back[numpy.clip(objs['ycpeak'],0,data.shape[0]-1),
+                              numpy.clip(objs['xcpeak'],0,data.shape[1]-1)] >= satur] |= SEX_SATURATED
+
+    cat = numpy.empty(n, dtype=columns)
+    cat['NUMBER'] = numpy.arange(1,n+1)
+    # SExtractor positions are 1-based.
+    cat['X_IMAGE'] = x + 1.
+    cat['Y_IMAGE'] = y + 1.
+    cat['MAG_AUTO'] = mag
+    cat['FLUX_RADIUS'] = radius
+    cat['BACKGROUND'] = back[numpy.clip(numpy.round(y).astype(int),0,data.shape[0]-1),
+                             numpy.clip(numpy.round(x).astype(int),0,data.shape[1]-1)]
+    cat['FLAGS'] = flags
+
+    if return_background:
+        return cat, back
+    else:
+        return cat
@@ -0,0 +1,240 @@
+# Shear and scalar two-point correlations on a grid, for the large separations of the rho
+# statistics.
+#
+# The stars are projected onto a flat tangent plane and their (weighted) values summed into
+# the cells of a grid.  The correlation of two gridded fields at every lag at once is then a
+# product of FFTs, which is binned by the length of the lag in the same log bins TreeCorr
+# uses.  This is only accurate for separations much larger than the grid cell, so it is
+# used above a switch scale, with TreeCorr's pair counting below it.  (cf. measure_rho in
+# run_rho2.py)
+#
+# The flat-sky projection is fine for the few degree fields we correlate here.  It is not
+# appropriate for a full survey footprint.
+
+import numpy
+
+
+def project(ra, dec):
+    """Project ra, dec (in degrees) onto the tangent plane at their mean position.
+
+    Returns x, y in arcmin, with x increasing to the west (decreasing ra) and y to the north,
+    which is the orientation TreeCorr uses for the shears.
+    """
+    ra = numpy.radians(ra)
+    dec = numpy.radians(dec)
+    # Use the center of the bounding box in ra, allowing for wrapping at 0.
+    ra0 = numpy.arctan2(numpy.mean(numpy.sin(ra)), numpy.mean(numpy.cos(ra)))
+    dec0 = numpy.mean(dec)
+    cosc = numpy.sin(dec0) * numpy.sin(dec) + numpy.cos(dec0) * numpy.cos(dec) * numpy.cos(ra-ra0)
+    x = -numpy.cos(dec) * numpy.sin(ra-ra0) / cosc
+    y = (numpy.cos(dec0) * numpy.sin(dec) -
+         numpy.sin(dec0) * numpy.cos(dec) * numpy.cos(ra-ra0)) / cosc
+    return numpy.degrees(x) * 60., numpy.degrees(y) * 60.
+
+
+def log_bins(min_sep, max_sep, bin_size):
+    """The bin edges TreeCorr uses for these parameters.
+
+    TreeCorr takes nbins = ceil(log(max_sep/min_sep)/bin_size) and then shrinks bin_size
+    to fit.
+    """
+    nbins = int(numpy.ceil(numpy.log(max_sep/min_sep)/bin_size))
+    return min_sep * numpy.exp(numpy.linspace(0., numpy.log(max_sep/min_sep), nbins+1))
+
+
+class Grid(object):
+    """The cells on a grid of the given pixel size (arcmin) of a set of positions x, y
+    (arcmin), padded so that lags up to max_sep don't wrap around.
+    """
+    def __init__(self, x, y, pixel, max_sep):
+        self.pixel = pixel
+        x0 = numpy.min(x)
+        y0 = numpy.min(y)
+        ix = ((x - x0) / pixel).astype(int)
+        iy = ((y - y0) / pixel).astype(int)
+        pad = int(numpy.ceil(max_sep / pixel)) + 1
+        self.shape = (self._fft_size(numpy.max(iy) + 1 + pad),
+                      self._fft_size(numpy.max(ix) + 1 + pad))
+        self.index = iy * self.shape[1] + ix
+        print('grid shape = ',self.shape,' pixel = ',pixel,' arcmin')
+
+        # The lag of each cell of the correlation in pixels.
+        ly = numpy.fft.fftfreq(self.shape[0]) * self.shape[0]
+        lx = numpy.fft.fftfreq(self.shape[1]) * self.shape[1]
+        self.lx, self.ly = numpy.meshgrid(lx, ly)
+
+    @staticmethod
+    def _fft_size(n):
+        # Round up to a product of 2s and 3s, which numpy's FFT does efficiently.
+        sizes = sorted(2**i * 3**j for i in range(32) for j in range(3))
+        return next(s for s in sizes if s >= n)
+
+    def field(self, values):
+        """Sum the values of the stars into their cells.
+        """
+        size = self.shape[0] * self.shape[1]
+        if numpy.iscomplexobj(values):
+            f = (numpy.bincount(self.index, weights=values.real, minlength=size) +
+                 1j * numpy.bincount(self.index, weights=values.imag, minlength=size))
+        else:
+            f = numpy.bincount(self.index, weights=values, minlength=size)
+        return f.reshape(self.shape)
+
+    def offsets(self, nsub=4):
+        """The offsets within a lag cell at which to evaluate the separation of its pairs.
+
+        The true separations of the pairs in a cell with lag l are l + u, where each component
+        of u is the difference of two uniform positions in a pixel, so has a triangular
+        distribution on (-1,1).  Using the nsub x nsub quantiles of this, rather than just l,
+        avoids the square lattice of lags biasing the spin-4 factor of xi- and the bin
+        boundaries at small lags.
+        """
+        p = (numpy.arange(nsub) + 0.5) / nsub
+        u = numpy.where(p < 0.5, -1. + numpy.sqrt(2.*p), 1. - numpy.sqrt(2.*(1.-p)))
+        return [ (ux, uy) for ux in u for uy in u ]
+
+    def bin(self, values, edges, spin4=False, logr=False):
+        """Sum values over the lags in each of the bins with the given edges.
+
+        If spin4, multiply by exp(-4i phi), where phi is the direction of the lag.
+        If logr, multiply by log(r) (for the mean log separation).
+        """
+        nbins = len(edges) - 1
+        values = values.ravel()
+        total = numpy.zeros(nbins, dtype=complex if spin4 or numpy.iscomplexobj(values) else float)
+        uu = self.offsets()
+        for ux, uy in uu:
+            lx = (self.lx + ux).ravel()
+            ly = (self.ly + uy).ravel()
+            r = numpy.hypot(lx, ly) * self.pixel
+            k = numpy.searchsorted(edges, r, side='right') - 1
+            # Skip the zero lag, which includes each star paired with itself.
+            use = (k >= 0) & (k < nbins) & ((self.lx.ravel() != 0) | (self.ly.ravel() != 0))
+            v = values[use]
+            if spin4:
+                v = v * numpy.exp(-4j * numpy.arctan2(ly[use], lx[use]))
+            if logr:
+                v = v * numpy.log(r[use])
+            if numpy.iscomplexobj(v):
+                total += (numpy.bincount(k[use], weights=v.real, minlength=nbins) +
+                          1j * numpy.bincount(k[use], weights=v.imag, minlength=nbins))
+            else:
+                total += numpy.bincount(k[use], weights=v, minlength=nbins)
+        return total / len(uu)
+
+
+def correlate(a, b):
+    """sum_x conj(a(x)) b(x+r) for every lag r.
+    """
+    return numpy.fft.ifft2(numpy.conj(numpy.fft.fft2(a)) * numpy.fft.fft2(b))
+
+
+class GridCorrelation(object):
+    """The result of a grid correlation, with the same attributes as the TreeCorr
+    GGCorrelation (or KKCorrelation) that write_stats uses.
+    """
+    def __init__(self, **kwargs):
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+
+def _pairs(grid, edges, auto):
+    n = numpy.ones(len(grid.index))
+    nn = correlate(grid.field(n), grid.field(n)).real
+    npairs = grid.bin(nn, edges)
+    meanlogr = grid.bin(nn, edges, logr=True)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        meanlogr = meanlogr / npairs
+    if auto:
+        # Each pair was counted in both directions.
+        npairs = npairs / 2.
+    return nn, npairs, meanlogr
+
+
+def grid_gg(grid, g1a, g2a, g1b, g2b, edges, auto=False):
+    """Compute xi+ and xi- of two shear fields on the grid.
+
+    xi+ = <g_a g_b*> and xi- = <g_a g_b exp(-4i phi)>, where phi is the direction of the
+    separation, as TreeCorr defines them.
+    """
+    nn, npairs, meanlogr = _pairs(grid, edges, auto)
+    ga = grid.field(g1a + 1j*g2a)
+    gb = grid.field(g1b + 1j*g2b)
+    xip = numpy.conj(correlate(ga, gb))
+    xim = correlate(numpy.conj(ga), gb)
+    scale = 2. if auto else 1.
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        xip = grid.bin(xip, edges) / (scale * npairs)
+        xim = grid.bin(xim, edges, spin4=True) / (scale * npairs)
+        varg_a = numpy.mean(g1a**2 + g2a**2) / 2.
+        varg_b = numpy.mean(g1b**2 + g2b**2) / 2.
+        varxi = varg_a * varg_b / npairs
+    return GridCorrelation(meanlogr=meanlogr, meanr=numpy.exp(meanlogr),
+                           xip=xip.real, xip_im=xip.imag, xim=xim.real, xim_im=xim.imag,
+                           varxi=varxi, npairs=npairs, weight=npairs)
+
+
+def grid_kk(grid, ka, kb, edges, auto=False):
+    """Compute <k_a k_b> of two scalar fields on the grid.
+    """
+    nn, npairs, meanlogr = _pairs(grid, edges, auto)
+    xi = correlate(grid.field(ka), grid.field(kb)).real
+    scale = 2. if auto else 1.
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        xi = grid.bin(xi, edges) / (scale * npairs)
+        varxi = numpy.var(ka) * numpy.var(kb) / npairs
+    return GridCorrelation(meanlogr=meanlogr, meanr=numpy.exp(meanlogr), xi=xi, varxi=varxi,
+                           npairs=npairs, weight=npairs)
+
+
+def stitch(tree, grid_corr, nsmall):
+    """Combine the first nsmall bins of the tree (TreeCorr) result with the rest of the
+    bins of the grid result.
+    """
+    keys = ['meanlogr', 'meanr', 'varxi', 'npairs', 'weight']
+    if hasattr(grid_corr, 'xip'):
+        keys += ['xip', 'xip_im', 'xim', 'xim_im']
+    else:
+        keys += ['xi']
+    return GridCorrelation(**{ key : numpy.concatenate([numpy.asarray(getattr(tree, key))[:nsmall],
+                                                         getattr(grid_corr, key)[nsmall:]])
+                               for key in keys })
+
+
+def overlap_report(name, tree, grid_corr, nsmall):
+    """Compare the tree and grid results in the bins where both were computed, i.e. from
+    nsmall to the end of the tree result.
+
+    Returns a dict with the separations and both estimates, along with the differences in
+    units of the tree errors, and as a fraction of the largest |xi| in the overlap.  (For a
+    strong signal, the shot noise can be much smaller than the accuracy of either method.)
+    """
+    ntree = len(tree.meanlogr)
+    s = slice(nsmall, ntree)
+    sigma = numpy.sqrt(numpy.asarray(tree.varxi)[s])
+    report = { 'name' : name, 'r' : numpy.exp(numpy.asarray(tree.meanlogr)[s]).tolist() }
+    keys = ['xip', 'xim'] if hasattr(grid_corr, 'xip') else ['xi']
+    for key in keys:
+        t = numpy.asarray(getattr(tree, key))[s]
+        g = getattr(grid_corr, key)[s]
+        report['tree_'+key] = t.tolist()
+        report['grid_'+key] = g.tolist()
+        report['dsig_'+key] = ((g - t) / sigma).tolist()
+        report['frac_'+key] = ((g - t) / numpy.max(numpy.abs(t))).tolist()
+        print('%s %s: overlap rms (grid-tree)/sigma = %.3f, max |grid-tree|/max|xi| = %.4f, over %d bins'%(
+              name, key, numpy.sqrt(numpy.mean(((g-t)/sigma)**2)),
+              numpy.max(numpy.abs(g-t)) / numpy.max(numpy.abs(t)), ntree-nsmall))
+    return report
+
+
+def overlap_ok(report, tol):
+    """Whether the grid agrees with the tree to within tol, as a fraction of the largest |xi|,
+    in all the bins of an overlap_report.  Prints a warning if not.
+    """
+    bad = [ key for key in ['xip', 'xim', 'xi']
+            if 'frac_'+key in report and numpy.any(numpy.abs(report['frac_'+key]) > tol) ]
+    if len(bad) > 0:
+        print('WARNING: %s: the grid %s differs from the pair counts by more than %g in the '
+              'overlap.  Using pair counts for all scales.'%(report['name'], ' and '.join(bad), tol))
+        return False
+    return True
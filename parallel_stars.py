@@ -0,0 +1,172 @@
+# Measure the stars of a single dense ccd in several processes.
+#
+# A few ccds have thousands of stars, and the rest of build_psf_cats.py waits on them while
+# measure_shapes and measure_psf_shapes do one star at a time.  Here the ccd's image, bad pixel
+# and weight arrays (with the background already subtracted from the image), the star
+# positions and the output catalog are copied into shared memory once.  Each worker process
+# attaches to them when it starts and loads its own copy of the PSF model, so a task is just a
+# range of star indices.  The workers run the same measurement functions as the serial code on
+# their range of rows of the shared catalog, so the results are identical to measuring the
+# stars in order in one process.
+
+import numpy
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor
+
+
+class SharedArrays(object):
+    """Copies of a dict of numpy arrays in shared memory.
+
+    arrays      The arrays to copy.  (Values of None are passed through as None.)
+
+    The copies are self.arrays[key].  self.spec is the small, picklable description a worker
+    process uses to attach to them.  (cf. attach)  The shared memory is freed by close, or at
+    the end of a with block.
+    """
+    def __init__(self, arrays):
+        self.shm = []
+        self.arrays = {}
+        self.spec = {}
+        for key, a in arrays.items():
+            if a is None:
+                self.arrays[key] = self.spec[key] = None
+                continue
+            a = numpy.ascontiguousarray(a)
+            shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+            self.shm.append(shm)
+            self.arrays[key] = numpy.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+            self.arrays[key][...] = a
+            self.spec[key] = (shm.name, a.shape, a.dtype)
+
+    def close(self):
+        # The views have to go before the shared memory can be closed.
+        self.arrays = {}
+        for shm in self.shm:
+            shm.close()
+            shm.unlink()
+        self.shm = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def attach(spec):
+    """Attach to the shared arrays described by spec (a SharedArrays.spec).
+
+    Returns shm, arrays, where shm is the list of SharedMemory objects, which must be kept
+    alive as long as the arrays are used.
+    """
+    shm = []
+    arrays = {}
+    for key, s in spec.items():
+        if s is None:
+            arrays[key] = None
+            continue
+        name, shape, dtype = s
+        shm.append(shared_memory.SharedMemory(name=name))
+        arrays[key] = numpy.ndarray(shape, dtype=dtype, buffer=shm[-1].buf)
+    return shm, arrays
+
+
+# The state of a worker process, set up by _init_worker.
+_worker = {}
+
+def _init_worker(spec, origins, wcs, file_name, psf_file_name, noweight, use_piff, do_shapes,
+                 do_psf, warm_start, stamp_sizes):
+    import galsim
+    import psf_models
+
+    shm, arrays = attach(spec)
+    images = []
+    for key in ['im', 'bp', 'wt']:
+        if arrays[key] is None:
+            images.append(None)
+        else:
+            xmin, ymin = origins[key]
+            images.append(galsim.Image(arrays[key], xmin=xmin, ymin=ymin))
+
+    if do_psf:
+        # With fork, this is usually already in the cache from load_ccd.
+        psf = psf_models.load_psf(psf_file_name, file_name, use_piff)
+    else:
+        psf = None
+
+    _worker.update(shm=shm, arrays=arrays, images=tuple(images), wcs=wcs, psf=psf,
+                   file_name=file_name, psf_file_name=psf_file_name, noweight=noweight,
+                   use_piff=use_piff, do_shapes=do_shapes, warm_start=warm_start,
+                   stamp_sizes=stamp_sizes)
+
+def _measure_range(start, end):
+    import build_psf_cats
+
+    w = _worker
+    x = w['arrays']['x'][start:end]
+    y = w['arrays']['y'][start:end]
+    out = w['arrays']['out'][start:end]
+    stats = { 'stars' : build_psf_cats.MomentStats(), 'psf' : build_psf_cats.MomentStats() }
+    build_psf_cats.measure_stars(x, y, w['file_name'], w['wcs'], w['noweight'], w['images'],
+                                 w['psf_file_name'], w['psf'], out, use_piff=w['use_piff'],
+                                 do_shapes=w['do_shapes'], do_psf=w['psf'] is not None,
+                                 warm_start=w['warm_start'], stats=stats,
+                                 stamp_size=w['stamp_sizes'][0],
+                                 psf_stamp_size=w['stamp_sizes'][1], start=start)
+    return start, end, stats
+
+
+def measure_stars(x, y, data, images, wcs, file_name, psf_file_name, noweight=False,
+                  use_piff=False, do_shapes=True, do_psf=True, warm_start='none', stats=None,
+                  stamp_size=48, psf_stamp_size=64, nproc=4, chunk=None):
+    """Measure the stars at x, y and the PSF model there in nproc processes.
+
+    This fills in data (cf. build_psf_cats.init_catalog) the same way as calling
+    build_psf_cats.measure_stars on all the stars.
+
+    images      (im, bp_im, wt_im) as read by read_image, with the background subtracted.
+    do_shapes   Whether to measure the stars.  (False if they were already measured, so only
+                the PSF model is needed.)
+    do_psf      Whether to measure the PSF model.  (If the model couldn't be read, the caller
+                should flag the failure with measure_psf_shapes instead.)
+    warm_start  How to start the FindAdaptiveMom iterations.  (cf. build_psf_cats.measure_stars)
+    stats       A dict of MomentStats for 'stars' and 'psf', to add the counts from the workers
+                to.
+    stamp_size, psf_stamp_size  The stamp sizes.  (cf. build_psf_cats.measure_stars)
+    chunk       The number of stars per task.  (default: enough for about 4 tasks per process,
+                to even out the stars that take longer)  With a warm_start, this is rounded up
+                to a multiple of build_psf_cats.RUNNING_BLOCK, so the running guesses are the
+                same as for the serial measurement.
+
+    Returns data.
+    """
+    n = len(x)
+    if chunk is None:
+        chunk = max(int(numpy.ceil(n / (4. * nproc))), 1)
+    if warm_start != 'none':
+        import build_psf_cats
+        block = build_psf_cats.RUNNING_BLOCK
+        chunk = block * int(numpy.ceil(chunk / float(block)))
+    im, bp_im, wt_im = images
+    arrays = { 'x' : x, 'y' : y, 'out' : data, 'im' : im.array,
+               'bp' : None if bp_im is None else bp_im.array,
+               'wt' : None if wt_im is None else wt_im.array }
+    origins = { key : (image.bounds.xmin, image.bounds.ymin)
+                for key, image in [('im', im), ('bp', bp_im), ('wt', wt_im)]
+                if image is not None }
+    print('Measure %d stars in %d processes, %d stars per task'%(n, nproc, chunk))
+
+    with SharedArrays(arrays) as shared:
+        initargs = (shared.spec, origins, wcs, file_name, psf_file_name, noweight, use_piff,
+                    do_shapes, do_psf, warm_start, (stamp_size, psf_stamp_size))
+        with ProcessPoolExecutor(max_workers=nproc, initializer=_init_worker,
+                                 initargs=initargs) as executor:
+            futures = [ executor.submit(_measure_range, start, min(start+chunk, n))
+                        for start in range(0, n, chunk) ]
+            for future in futures:
+                start, end, task_stats = future.result()
+                if stats is not None:
+                    for key in task_stats:
+                        stats[key] += task_stats[key]
+        data[...] = shared.arrays['out']
+    return data
@@ -0,0 +1,440 @@
+#! /usr/bin/env python
+# Run the rho statistics pipeline:
+#     build_exp_catalog -> build_psf_cats (per ccd) -> exposure catalogs -> run_rho2 -> plot_rho
+#
+# Each step is a node in a graph with explicit input and output files.  A node is only rerun
+# if the content of its inputs, its parameters or the code of its script changed since the
+# last successful run, or if one of its outputs has gone missing.  The record of the last runs
+# is kept in {work}/pipeline_state.json.  Nodes that don't depend on each other (e.g. different
+# ccds or exposures) are run concurrently.
+
+import os
+import sys
+import glob
+import json
+import hashlib
+import subprocess
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run the rho stats pipeline, redoing only the steps that are out of date')
+
+    # Drectory arguments
+    parser.add_argument('--work', default='./',
+                        help='location of work directory')
+    parser.add_argument('--input_dir', default=None,
+                        help='location of the input images (default: work)')
+    parser.add_argument('--output_dir', default=None,
+                        help='location of the psfex outputs (default: work)')
+    parser.add_argument('--tag', default='trial',
+                        help='A version tag for the run_rho2 outputs')
+
+    # Exposure inputs
+    parser.add_argument('--exp_match', default='*_[0-9][0-9].fits',
+                        help='regexp to search for files in input_dir')
+    parser.add_argument('--file', default='',
+                        help='list of run/exposures (in lieu of separate exps, runs)')
+    parser.add_argument('--exps', default='', nargs='+',
+                        help='list of exposures to run')
+    parser.add_argument('--runs', default='', nargs='+',
+                        help='list of runs')
+
+    # Options
+    parser.add_argument('--nproc', default=os.cpu_count(), type=int,
+                        help='maximum number of steps to run at once')
+    parser.add_argument('--psf_args', default='',
+                        help='extra arguments for build_psf_cats.py')
+    parser.add_argument('--rho_args', default='',
+                        help='extra arguments for run_rho2.py')
+    parser.add_argument('--plot_args', default='',
+                        help='extra arguments for plot_rho.py')
+    parser.add_argument('--in_memory', default=False, action='store_const', const=True,
+                        help='pass the psf catalogs directly from build_psf_cats to run_rho2 in memory')
+    parser.add_argument('--write_cats', default=False, action='store_const', const=True,
+                        help='with --in_memory, also write the psf catalogs to disk')
+    parser.add_argument('--force', default=False, action='store_const', const=True,
+                        help='rerun every step')
+    parser.add_argument('--dry_run', default=False, action='store_const', const=True,
+                        help='just list the steps that would be run')
+
+    args = parser.parse_args()
+    return args
+
+
+class FileHasher(object):
+    """Content hashes of files, remembered by (path, size, mtime) so unchanged files are only
+    read once.
+    """
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else {}
+        self.used = set()
+        self.lock = threading.Lock()
+
+    def __call__(self, file_name):
+        st = os.stat(file_name)
+        key = '%s:%d:%d'%(os.path.abspath(file_name), st.st_size, st.st_mtime_ns)
+        with self.lock:
+            self.used.add(key)
+            if key in self.cache:
+                return self.cache[key]
+        h = hashlib.sha1()
+        with open(file_name, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                h.update(block)
+        digest = h.hexdigest()
+        with self.lock:
+            self.cache[key] = digest
+        return digest
+
+    def prune(self, file_names):
+        """Forget the files that are not in file_names, and the old versions of the ones that
+        were hashed.
+        """
+        keep = set(os.path.abspath(f) for f in file_names)
+        with self.lock:
+            hashed = set(key.rsplit(':', 2)[0] for key in self.used)
+            for key in list(self.cache):
+                path = key.rsplit(':', 2)[0]
+                if path not in keep or (path in hashed and key not in self.used):
+                    del self.cache[key]
+
+
+class Node(object):
+    """A step in the pipeline.
+
+    name        A unique name for the step.
+    inputs      The input files.  Files that don't exist are ignored (as the scripts ignore
+                missing optional inputs), but will trigger a rerun once they appear.
+    outputs     The output files.
+    params      Anything else (e.g. command line options) that should trigger a rerun
+                when it changes.  Must be json serializable.
+    cmd         The command to run as an argument list, or a python function to call.
+    deps        The names of the nodes that must run first.
+    """
+    def __init__(self, name, inputs, outputs, params, cmd, deps=()):
+        self.name = name
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params
+        self.cmd = cmd
+        self.deps = list(deps)
+
+    def fingerprint(self, hasher):
+        h = hashlib.sha1()
+        h.update(json.dumps(self.params, sort_keys=True).encode())
+        if isinstance(self.cmd, list):
+            h.update(json.dumps(self.cmd).encode())
+        for file_name in sorted(self.inputs):
+            h.update(file_name.encode())
+            if os.path.exists(file_name):
+                h.update(hasher(file_name).encode())
+        return h.hexdigest()
+
+
+def script(name):
+    return os.path.join(script_dir, name)
+
+# The scripts whose code goes into the psf catalogs: build_psf_cats.py and the modules it
+# imports.  (Add new ones here, so changing them redoes the catalogs.)
+psf_scripts = ['build_psf_cats.py', 'corr_cache.py', 'extract.py', 'parallel_stars.py',
+               'prefetch.py', 'psf_grid.py', 'psf_models.py', 'psfex_moments.py',
+               'star_schema.py']
+
+def exp_cat_root(root):
+    """The root name of the exposure catalog for a ccd's root name (as in build_psf_cats).
+    """
+    return root.rsplit('_',1)[0] if '_' in root else root
+
+def write_exp_catalog(ccd_files, exp_file):
+    """Concatenate the per-ccd catalogs into the exposure catalog.
+    """
+    import numpy
+    import fitsio
+
+    data = [ fitsio.read(f) for f in ccd_files if os.path.exists(f) ]
+    data = numpy.concatenate(data) if data else numpy.empty(0)
+    tmp_file = exp_file + '.tmp'
+    fitsio.write(tmp_file, data, clobber=True)
+    os.rename(tmp_file, exp_file)
+    print('wrote cat_file = ',exp_file)
+
+
+def get_exposures(args):
+    """Return the lists of runs and exps to do.
+    """
+    if args.file != '':
+        with open(args.file) as fin:
+            data = [ line.split() for line in fin ]
+        runs, exps = list(zip(*data))
+    else:
+        runs = args.runs
+        exps = args.exps
+    return runs, exps
+
+def build_graph(args):
+    """Set up the nodes of the pipeline for the requested exposures.
+    """
+    work = os.path.expanduser(args.work)
+    input_dir = args.input_dir or work
+    output_dir = args.output_dir or work
+    cat_dir = os.path.join(work, 'psf_cats')
+
+    runs, exps = get_exposures(args)
+
+    py = sys.executable
+    nodes = []
+    images = sorted(glob.glob(os.path.join(input_dir, args.exp_match)))
+
+    expinfo_file = os.path.join(work, 'exposure_info.fits')
+    nodes.append(Node('expinfo', images + [script('build_exp_catalog.py')], [expinfo_file],
+                      { 'exps' : list(exps), 'runs' : list(runs) },
+                      [py, script('build_exp_catalog.py'), '--work', work,
+                       '--exps'] + list(exps) + ['--runs'] + list(runs) + ['--output', expinfo_file]))
+
+    # With --stamp_from fwhm, build_psf_cats reads the seeing from the exposure info file.
+    psf_argv = args.psf_args.replace('=', ' ').split()
+    if '--stamp_from' in psf_argv and 'fwhm' in psf_argv:
+        psf_inputs = [expinfo_file]
+        psf_deps = ['expinfo']
+    else:
+        psf_inputs = []
+        psf_deps = []
+
+    exp_cat_files = []
+    for run, exp in zip(runs, exps):
+        # The ccds of this exposure.
+        exp_images = [ f for f in images if exp in os.path.basename(f) ]
+        ccd_nodes = {}
+        for image in exp_images:
+            base = os.path.basename(image)
+            root = base.split('.fits')[0]
+            inputs = [ image ] + [ script(name) for name in psf_scripts ]
+            inputs += [ os.path.join(output_dir, root + suffix)
+                        for suffix in [ '_psfcat.fits', '_psfcat.used.fits', '_psfcat.psf',
+                                        '_findstars.fits', '_reserve.fits' ] ]
+            inputs += [ os.path.join(input_dir, root + '_bkg.fits.fz') ] + psf_inputs
+            cat_file = os.path.join(cat_dir, root + '_psf.fits')
+            exp_root = exp_cat_root(root)
+            ccd_nodes.setdefault(exp_root, []).append(cat_file)
+            nodes.append(Node('psf:' + root, inputs, [cat_file], { 'psf_args' : args.psf_args },
+                              [py, script('build_psf_cats.py'), '--work', work,
+                               '--exps', exp, '--runs', run,
+                               '--input_dir', input_dir, '--output_dir', output_dir,
+                               '--exp_match', base, '--no_exp_cat'] + args.psf_args.split(),
+                              deps=psf_deps))
+
+        for exp_root, cat_files in ccd_nodes.items():
+            exp_file = os.path.join(cat_dir, exp_root + '_exppsf.fits')
+            exp_cat_files.append(exp_file)
+            nodes.append(Node('exppsf:' + exp_root, cat_files, [exp_file], {},
+                              lambda cat_files=cat_files, exp_file=exp_file:
+                                  write_exp_catalog(cat_files, exp_file),
+                              deps=[ 'psf:' + os.path.basename(f)[:-len('_psf.fits')]
+                                     for f in cat_files ]))
+
+    rho_files = os.path.join(work, 'rho_*.json')
+    rho_outputs = [ os.path.join(work, 'psf_%s.fits'%args.tag) ]
+    nodes.append(Node('rho', exp_cat_files + [expinfo_file, script('run_rho2.py')], rho_outputs,
+                      { 'tag' : args.tag, 'rho_args' : args.rho_args },
+                      [py, script('run_rho2.py'), '--work', work, '--tag', args.tag,
+                       '--exps'] + list(exps) + ['--runs'] + list(runs) + args.rho_args.split(),
+                      deps=['expinfo'] + [ n.name for n in nodes if n.name.startswith('exppsf:') ]))
+    # Which rho json files are written depends on the rho_args, so take the ones it wrote.
+    nodes[-1].glob_outputs = [rho_files]
+
+    nodes.append(Node('plot', [script('plot_rho.py')], [], { 'plot_args' : args.plot_args },
+                      [py, script('plot_rho.py'), '--work', work] + args.plot_args.split(),
+                      deps=['rho']))
+    # The rho json files only exist after the rho node runs, so look for them then.
+    nodes[-1].glob_inputs = [rho_files]
+
+    return nodes
+
+
+def run_node(node, log_dir):
+    """Run a single node, sending its output to {log_dir}/{name}.log
+    """
+    log_file = os.path.join(log_dir, node.name.replace(':','_').replace('/','_') + '.log')
+    if callable(node.cmd):
+        node.cmd()
+        return True, ''
+    with open(log_file, 'w') as log:
+        log.write('$ ' + ' '.join(node.cmd) + '\n')
+        log.flush()
+        status = subprocess.call(node.cmd, stdout=log, stderr=subprocess.STDOUT)
+    if status != 0:
+        return False, '%s exited with status %d.  See %s'%(node.cmd[1], status, log_file)
+    return True, ''
+
+
+def run_graph(nodes, work, nproc=1, force=False, dry_run=False):
+    """Run the nodes that are out of date, respecting the dependencies.
+
+    Returns the list of names of nodes that failed (or were skipped because a dependency failed).
+    """
+    state_file = os.path.join(work, 'pipeline_state.json')
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            state = json.load(f)
+    else:
+        state = {}
+    state.setdefault('nodes', {})
+    hasher = FileHasher(state.setdefault('files', {}))
+    start_time = int(time.time())   # (file mtimes may be truncated to seconds)
+    log_dir = os.path.join(work, 'logs')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    by_name = { node.name : node for node in nodes }
+    done = set()
+    failed = set()
+    running = {}
+
+    def fingerprint(node):
+        for pattern in getattr(node, 'glob_inputs', []):
+            node.inputs = sorted(set(node.inputs) | set(glob.glob(pattern)))
+        return node.fingerprint(hasher)
+
+    def is_stale(node, fp):
+        if force:
+            return True
+        last = state['nodes'].get(node.name)
+        if last is None or last['fingerprint'] != fp:
+            return True
+        return any(not os.path.exists(f) for f in last['outputs'])
+
+    def save_state():
+        with open(state_file + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.rename(state_file + '.tmp', state_file)
+
+    with ThreadPoolExecutor(max_workers=max(nproc,1)) as executor:
+        while len(done) + len(failed) < len(nodes):
+            for node in nodes:
+                if node.name in done or node.name in failed or node.name in running:
+                    continue
+                if any(d in failed for d in node.deps):
+                    print('Skipping %s, since a dependency failed'%node.name)
+                    failed.add(node.name)
+                    continue
+                if not all(d in done or d not in by_name for d in node.deps):
+                    continue
+                fp = fingerprint(node)
+                if not is_stale(node, fp):
+                    done.add(node.name)
+                    continue
+                print('Running %s'%node.name)
+                if dry_run:
+                    done.add(node.name)
+                    continue
+                running[node.name] = (executor.submit(run_node, node, log_dir), fp)
+
+            if not running:
+                continue
+            finished, _ = wait([ f for f, _ in running.values() ], return_when=FIRST_COMPLETED)
+            for name in [ n for n, (f, _) in running.items() if f in finished ]:
+                future, fp = running.pop(name)
+                try:
+                    success, message = future.result()
+                except Exception as e:
+                    success, message = False, str(e)
+                if success:
+                    node = by_name[name]
+                    for pattern in getattr(node, 'glob_outputs', []):
+                        node.outputs += [ f for f in sorted(glob.glob(pattern))
+                                          if f not in node.outputs and
+                                             os.path.getmtime(f) >= start_time ]
+                    outputs = [ f for f in node.outputs if os.path.exists(f) ]
+                    state['nodes'][name] = { 'fingerprint' : fp, 'outputs' : outputs }
+                    save_state()
+                    done.add(name)
+                else:
+                    print('FAILED %s: %s'%(name, message))
+                    failed.add(name)
+
+    if not dry_run:
+        # Only remember the hashes of files that are still inputs.
+        hasher.prune([ f for node in nodes for f in node.inputs ])
+        save_state()
+    return sorted(failed)
+
+
+def build_exposure_job(psf_argv, run, exp, cat_dir):
+    """Build the psf catalog for one exposure in memory.  (Run in a worker process.)
+    """
+    import build_psf_cats
+    psf_args = build_psf_cats.parse_args(psf_argv)
+    exp_root, data = build_psf_cats.build_exposure(psf_args, run, exp, cat_dir)
+    return exp, data
+
+def run_in_memory(args, nodes):
+    """Run the pipeline with the psf catalogs kept in memory between build_psf_cats and
+    run_rho2.  The catalog files are only written if args.write_cats.
+
+    Only the exposure info and plotting steps are checked for being up to date.
+    """
+    from concurrent.futures import ProcessPoolExecutor
+    import run_rho2
+
+    work = os.path.expanduser(args.work)
+    input_dir = args.input_dir or work
+    output_dir = args.output_dir or work
+    runs, exps = get_exposures(args)
+    by_name = { node.name : node for node in nodes }
+
+    failed = run_graph([by_name['expinfo']], work, force=args.force)
+    if failed:
+        return failed
+
+    if args.write_cats:
+        cat_dir = os.path.join(work, 'psf_cats')
+        if not os.path.isdir(cat_dir):
+            os.makedirs(cat_dir)
+    else:
+        cat_dir = None
+
+    catalogs = {}
+    with ProcessPoolExecutor(max_workers=max(min(args.nproc, len(exps)),1)) as executor:
+        futures = []
+        for run, exp in zip(runs, exps):
+            psf_argv = ['--work', work, '--input_dir', input_dir, '--output_dir', output_dir,
+                        '--exp_match', '*%s%s'%(exp, args.exp_match.lstrip('*'))]
+            psf_argv += args.psf_args.split()
+            futures.append(executor.submit(build_exposure_job, psf_argv, run, exp, cat_dir))
+        for future in futures:
+            exp, data = future.result()
+            catalogs[exp] = data
+
+    rho_argv = ['--work', work, '--tag', args.tag, '--exps'] + list(exps) + ['--runs'] + list(runs)
+    rho_args = run_rho2.parse_args(rho_argv + args.rho_args.split())
+    run_rho2.run_rho(rho_args, catalogs=catalogs, write_cat=args.write_cats)
+
+    return run_graph([by_name['plot']], work, force=True)
+
+
+def main():
+    args = parse_args()
+    work = os.path.expanduser(args.work)
+    print('work dir = ',work)
+    if not os.path.isdir(work):
+        os.makedirs(work)
+
+    nodes = build_graph(args)
+    if args.in_memory:
+        failed = run_in_memory(args, nodes)
+    else:
+        failed = run_graph(nodes, work, nproc=args.nproc, force=args.force, dry_run=args.dry_run)
+    if failed:
+        print('Failed steps: ',failed)
+        sys.exit(1)
+    print('Pipeline up to date.')
+
+
+if __name__ == "__main__":
+    main()
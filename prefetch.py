@@ -0,0 +1,104 @@
+# Load the inputs for the next few items in background threads while the current one is
+# being worked on.
+#
+#     for file_name, inputs in Prefetcher(files, load, depth=2, max_bytes=4 * 1024**3):
+#         work_on(file_name, inputs)
+#
+# Up to depth items are loaded ahead of the one being worked on, but no more than fit in
+# max_bytes, as estimated from the sizes of the items loaded so far.  Until the first item
+# has been loaded, only one is loaded at a time.
+
+import collections
+import types
+from concurrent.futures import ThreadPoolExecutor
+import numpy
+
+
+def nbytes(obj, _seen=None):
+    """Estimate the memory used by the numpy arrays (or GalSim images) in obj, which may
+    be nested in dicts, lists and tuples, or in the attributes of other objects (such as
+    the PSF models).  Arrays reachable more than once are only counted once.
+    """
+    if _seen is None:
+        _seen = set()
+    if id(obj) in _seen:
+        return 0
+    _seen.add(id(obj))
+    if isinstance(obj, numpy.ndarray):
+        return obj.nbytes
+    elif hasattr(obj, 'array') and isinstance(obj.array, numpy.ndarray):
+        return nbytes(obj.array, _seen)
+    elif isinstance(obj, dict):
+        return sum(nbytes(v, _seen) for v in obj.values())
+    elif isinstance(obj, (list, tuple)):
+        return sum(nbytes(v, _seen) for v in obj)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, (type, types.ModuleType)):
+        return sum(nbytes(v, _seen) for v in vars(obj).values())
+    else:
+        return 0
+
+
+class Prefetcher(object):
+    """Iterate over (item, load(item)) for the given items, loading ahead in threads.
+
+    items       The items to load.
+    load        A function that takes an item and returns its inputs.  Exceptions are
+                raised when the corresponding item is reached.
+    depth       How many items to load ahead of the current one.  (0 means load each item
+                only when it is reached.)
+    max_bytes   The most memory to use for the loaded items, including the current one.
+                At least one item ahead is always allowed to load.  Until the size of an
+                item is known, only one is loaded at a time.
+    """
+    def __init__(self, items, load, depth=2, max_bytes=None):
+        self.items = list(items)
+        self.load = load
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.item_bytes = 0   # The largest item loaded so far.
+        self.nloaded = 0
+
+    def _load(self, item):
+        inputs = self.load(item)
+        self.item_bytes = max(self.item_bytes, nbytes(inputs))
+        self.nloaded += 1
+        return inputs
+
+    def _room(self, npending):
+        # Whether there is room in the budget for another item on top of npending of them.
+        if npending == 0:
+            return True
+        if npending > self.depth:
+            return False
+        if self.max_bytes is None:
+            return True
+        if self.nloaded == 0:
+            # No idea how big they are yet.
+            return False
+        if npending < 2:
+            return True
+        return (npending + 1) * self.item_bytes <= self.max_bytes
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for item in self.items:
+                yield item, self.load(item)
+            return
+
+        todo = collections.deque(self.items)
+        pending = collections.deque()
+        executor = ThreadPoolExecutor(max_workers=self.depth)
+        try:
+            while todo or pending:
+                while todo and self._room(len(pending)):
+                    item = todo.popleft()
+                    pending.append((item, executor.submit(self._load, item)))
+                item, future = pending.popleft()
+                inputs = future.result()
+                yield item, inputs
+                del inputs
+        finally:
+            # If we stop early (e.g. single_ccd), don't keep loading.
+            for item, future in pending:
+                future.cancel()
+            executor.shutdown(wait=True)
@@ -0,0 +1,143 @@
+# Lookup tables of the PSF model shapes on a grid of positions on each ccd.
+#
+# Measuring the model shape at a position means drawing the model and running
+# FindAdaptiveMom, as measure_psf_shapes does for the stars.  To evaluate the model at many
+# more positions than there are stars (e.g. at the galaxies, or for maps of the focal plane),
+# build_psf_cats.py --psf_grid nx ny measures the model once on an nx x ny grid covering each
+# ccd, and writes it next to the PSF file as {root}_psfgrid.fits.  Then
+#
+#     grid = PSFGrid.read(file_name)
+#     e1, e2, size = grid(x, y)
+#
+# interpolates to any positions on the ccd with a bicubic spline.  When the grid is made, the
+# spline is checked against direct measurements at some random positions, and the largest
+# differences are written in the header (MAXDE1, MAXDE2, MAXDSIZE), along with the number of
+# positions per second of each method.
+
+import os
+import time
+import numpy
+
+
+class PSFGrid(object):
+    """The PSF model e1, e2, size measured on a grid of positions on a ccd.
+
+    x, y        The grid coordinates (1-d arrays, increasing)
+    e1, e2, size    The measurements, with shape (len(y), len(x))
+    header      Any other information about the grid, such as the validation report.
+    """
+    def __init__(self, x, y, e1, e2, size, header=None):
+        from scipy.interpolate import RectBivariateSpline
+
+        self.x = numpy.asarray(x, dtype=float)
+        self.y = numpy.asarray(y, dtype=float)
+        self.e1 = e1
+        self.e2 = e2
+        self.size = size
+        self.header = header or {}
+        k = min(3, len(self.x)-1, len(self.y)-1)
+        self._splines = [ RectBivariateSpline(self.y, self.x, v, kx=k, ky=k)
+                          for v in (e1, e2, size) ]
+
+    def __call__(self, x, y):
+        """Interpolate to the positions x, y.  Returns e1, e2, size.
+        """
+        x = numpy.asarray(x, dtype=float)
+        y = numpy.asarray(y, dtype=float)
+        return tuple(s.ev(y, x) for s in self._splines)
+
+    def write(self, file_name):
+        """Write the grid to a fits file, one row per grid point.
+        """
+        import fitsio
+
+        xx, yy = numpy.meshgrid(self.x, self.y)
+        data = numpy.empty(xx.size, dtype=[('x','f8'), ('y','f8'), ('e1','f4'), ('e2','f4'),
+                                           ('size','f4')])
+        data['x'] = xx.ravel()
+        data['y'] = yy.ravel()
+        data['e1'] = self.e1.ravel()
+        data['e2'] = self.e2.ravel()
+        data['size'] = self.size.ravel()
+        header = dict(self.header, NX=len(self.x), NY=len(self.y))
+        tmp_file = file_name + '.tmp'
+        fitsio.write(tmp_file, data, header=header, clobber=True)
+        os.replace(tmp_file, file_name)
+        print('Wrote psf grid to ',file_name)
+
+    @classmethod
+    def read(cls, file_name):
+        import fitsio
+
+        data, h = fitsio.read(file_name, header=True)
+        nx = h['NX']
+        ny = h['NY']
+        shape = (ny, nx)
+        header = { key : h[key] for key in h.keys() if key.startswith(('MAX', 'RMS', 'RATE',
+                                                                        'NBAD', 'NVAL')) }
+        return cls(data['x'][:nx], data['y'][::nx],
+                   data['e1'].reshape(shape).astype(float),
+                   data['e2'].reshape(shape).astype(float),
+                   data['size'].reshape(shape).astype(float), header)
+
+
+def _measure(xlist, ylist, psf_file_name, file_name, use_piff, psf):
+    # The psf e1, e2, size measured directly at x,y, and whether each one is ok.
+    import build_psf_cats
+
+    out = build_psf_cats.init_catalog(len(xlist))
+    build_psf_cats.measure_psf_shapes(xlist, ylist, psf_file_name, file_name,
+                                      use_piff=use_piff, out=out, psf=psf)
+    return (out['psf_e1'].astype(float), out['psf_e2'].astype(float),
+            out['psf_size'].astype(float), out['flag'] == 0)
+
+def make_grid(psf, psf_file_name, file_name, bounds, nx, ny, use_piff=False, nval=100,
+              seed=1234):
+    """Measure the PSF model on an nx x ny grid covering bounds (a galsim.BoundsI) and check
+    the interpolation against direct measurements at nval random positions.
+
+    Grid points where the measurement fails get the values of the nearest good point.
+
+    Returns a PSFGrid.
+    """
+    x = numpy.linspace(bounds.xmin, bounds.xmax, nx)
+    y = numpy.linspace(bounds.ymin, bounds.ymax, ny)
+    xx, yy = numpy.meshgrid(x, y)
+    t0 = time.time()
+    e1, e2, size, ok = _measure(xx.ravel(), yy.ravel(), psf_file_name, file_name, use_piff, psf)
+    t1 = time.time()
+    if not numpy.any(ok):
+        raise RuntimeError("Could not measure the PSF model at any of the grid points")
+    nbad = int(numpy.sum(~ok))
+    if nbad > 0:
+        print('Filling %d bad grid points from their nearest neighbors'%nbad)
+        xg = xx.ravel()[ok]
+        yg = yy.ravel()[ok]
+        for i in numpy.where(~ok)[0]:
+            j = numpy.argmin((xg - xx.ravel()[i])**2 + (yg - yy.ravel()[i])**2)
+            e1[i] = e1[ok][j]
+            e2[i] = e2[ok][j]
+            size[i] = size[ok][j]
+    grid = PSFGrid(x, y, e1.reshape(xx.shape), e2.reshape(xx.shape), size.reshape(xx.shape))
+
+    # Check the spline against direct measurements.
+    rng = numpy.random.RandomState(seed)
+    xv = rng.uniform(bounds.xmin, bounds.xmax, nval)
+    yv = rng.uniform(bounds.ymin, bounds.ymax, nval)
+    ve1, ve2, vsize, vok = _measure(xv, yv, psf_file_name, file_name, use_piff, psf)
+    t2 = time.time()
+    ge1, ge2, gsize = grid(xv, yv)
+    t3 = time.time()
+
+    report = { 'NBAD' : nbad, 'NVAL' : int(numpy.sum(vok)),
+               'RATEMEAS' : nx * ny / (t1 - t0), 'RATEGRID' : nval / max(t3 - t2, 1.e-9) }
+    for name, v, g in [('E1', ve1, ge1), ('E2', ve2, ge2), ('SIZE', vsize, gsize)]:
+        d = numpy.abs(g - v)[vok]
+        report['MAXD'+name] = float(numpy.max(d)) if len(d) > 0 else -1.
+        report['RMSD'+name] = float(numpy.sqrt(numpy.mean(d**2))) if len(d) > 0 else -1.
+    grid.header = report
+    print('psf grid %d x %d: max |grid - direct| e1 = %.2e, e2 = %.2e, size = %.2e over %d positions'%(
+          nx, ny, report['MAXDE1'], report['MAXDE2'], report['MAXDSIZE'], report['NVAL']))
+    print('positions per second: direct = %.1f, grid = %.3g'%(
+          report['RATEMEAS'], report['RATEGRID']))
+    return grid
@@ -0,0 +1,142 @@
+# Load the PSF models once per process, and draw the Piff models for many stars at once.
+#
+# The models are cached by file name and modification time, so the workers of
+# parallel_stars.py and repeated runs on the same ccd don't read them again.
+#
+# Drawing a Piff model star by star re-evaluates the interpolation and builds a new
+# InterpolatedImage for each star.  For the models we use (a PixelGrid model interpolated with
+# BasisPolynomial, cf. piff_sim.yaml), draw_piff instead evaluates the polynomial for all the
+# stars with one matrix product, and renders the pixel grids onto the stamps with the
+# interpolation kernel written as a matrix in each direction, which is one batched product for
+# a block of stars.  Other models are drawn one at a time with their GalSim profiles.
+
+import os
+import functools
+import numpy
+
+
+def _read_psf(psf_file_name, mtime, file_name, use_piff):
+    import build_psf_cats
+    return build_psf_cats.read_psf(psf_file_name, file_name, use_piff)
+
+_load_psf = functools.lru_cache(maxsize=8)(_read_psf)
+
+def load_psf(psf_file_name, file_name, use_piff=False):
+    """Like build_psf_cats.read_psf, but only read each model once per process (unless the
+    file changes).
+    """
+    mtime = os.path.getmtime(psf_file_name)
+    return _load_psf(psf_file_name, mtime, file_name, use_piff)
+
+def set_max_models(max_models):
+    """Keep up to max_models of the most recently used models in memory.  (default 8)
+
+    This empties the cache.
+    """
+    global _load_psf
+    _load_psf = functools.lru_cache(maxsize=max_models)(_read_psf)
+
+def cache_info():
+    """The hits, misses (i.e. loads), maxsize and currsize of the model cache.
+    """
+    return _load_psf.cache_info()
+
+
+def _chip_psf(psf):
+    # The chip number and the (Simple)PSF for it, for a Piff model of a single chip.
+    chipnums = list(psf.wcs.keys())
+    if len(chipnums) != 1:
+        raise ValueError("Expecting a Piff model of a single chip, got chips %s"%chipnums)
+    chipnum = chipnums[0]
+    if hasattr(psf, 'psf_by_chip'):
+        return chipnum, psf.psf_by_chip[chipnum]
+    else:
+        return chipnum, psf
+
+def _polynomial_basis(interp, vals):
+    # The BasisPolynomial.basis of each row of vals (nstar x nkeys) at once.
+    pows = numpy.ones((len(vals), 1))
+    for i, o in enumerate(interp._orders):
+        p = numpy.ones((len(vals), o+1))
+        p[:,1:] = vals[:,i:i+1]
+        p = numpy.cumprod(p, axis=1)
+        pows = (pows[:,:,numpy.newaxis] * p[:,numpy.newaxis,:]).reshape(len(vals), -1)
+    return pows[:, interp._mask.ravel()]
+
+def _kernel_matrix(kernel, xout, xin, scale):
+    # K[a,k] = kernel((xout[a] - xin[k]) / scale)
+    d = (xout[:,numpy.newaxis] - xin[numpy.newaxis,:]) / scale
+    return kernel.xval(d.ravel()).reshape(d.shape)
+
+def draw_psf(psf, xlist, ylist, image, use_piff=False):
+    """Draw a Piff or PSFEx model at each position x, y, centered on image.
+
+    This yields an array with the image of the PSF at each star in turn.  (cf. draw_piff)
+    """
+    if use_piff:
+        for stamp in draw_piff(psf, xlist, ylist, image):
+            yield stamp
+    else:
+        import galsim
+        for x, y in zip(xlist, ylist):
+            psf_i = psf.getPSF(galsim.PositionD(x,y))
+            psf_i.drawImage(image=image, method='no_pixel')
+            yield image.array.copy()
+
+def draw_piff(psf, xlist, ylist, image, nbatch=256):
+    """Draw a Piff model at each position x, y, centered on image.
+
+    This yields an array with the image of the PSF at each star in turn (in the shape of
+    image.array), which is the same as drawing the profile from psf.get_profile(x, y) on image
+    with center=image.true_center.  Only nbatch stamps are held in memory at once.
+    """
+    import galsim
+    import piff
+
+    chipnum, chip_psf = _chip_psf(psf)
+    model = chip_psf.model
+    interp = chip_psf.interp
+    if not (isinstance(model, piff.PixelGrid) and isinstance(interp, piff.BasisPolynomial) and
+            set(interp.property_names) <= set(['u', 'v'])):
+        # No shortcut.  Draw each one.
+        print('Drawing %s model one star at a time'%type(model).__name__)
+        for x, y in zip(xlist, ylist):
+            prof, method = psf.get_profile(x, y)
+            prof.drawImage(image, method=method, center=image.true_center)
+            yield image.array.copy()
+        return
+
+    # The field positions of the stars, in arcsec.  (cf. piff.StarData.calculateFieldPos)
+    wcs = psf.wcs[chipnum]
+    xlist = numpy.asarray(xlist, dtype=float)
+    ylist = numpy.asarray(ylist, dtype=float)
+    if wcs.isCelestial():
+        ra, dec = wcs.toWorld(xlist, ylist, units=galsim.radians)
+        u, v = psf.pointing.project_rad(ra, dec)
+        u = u * (galsim.radians / galsim.arcsec)
+        v = v * (galsim.radians / galsim.arcsec)
+    else:
+        u, v = wcs.toWorld(xlist, ylist)
+    field_pos = { 'u' : u, 'v' : v }
+    vals = numpy.array([ field_pos[key] for key in interp.property_names ]).T
+
+    # The positions of the stamp pixels and the model grid points relative to the center of
+    # each, in arcsec.  (The InterpolatedImage of the model is centered on the middle grid
+    # point, cf. PixelGrid.getProfile.)
+    center = image.true_center
+    scale = image.scale
+    uout = (numpy.arange(image.bounds.xmin, image.bounds.xmax+1) - center.x) * scale
+    vout = (numpy.arange(image.bounds.ymin, image.bounds.ymax+1) - center.y) * scale
+    grid = (numpy.arange(model.size) - model.size//2) * model.scale
+    Ku = _kernel_matrix(model.interp, uout, grid, model.scale)
+    Kv = _kernel_matrix(model.interp, vout, grid, model.scale)
+    # A profile of unit flux, sampled at the stamp pixels (method='no_pixel').
+    norm = (scale / model.scale)**2
+
+    for start in range(0, len(vals), nbatch):
+        K = _polynomial_basis(interp, vals[start:start+nbatch])
+        params = K.dot(interp.q.T).reshape(-1, model.size, model.size)
+        params /= params.sum(axis=(1,2))[:,numpy.newaxis,numpy.newaxis]
+        stamps = numpy.matmul(Kv, numpy.matmul(params, Ku.T)) * norm
+        for stamp in stamps:
+            yield stamp
@@ -0,0 +1,330 @@
+#! /usr/bin/env python
+# A long-lived server for PSF model queries, so interactive analyses and other pipelines don't
+# have to read the PSF files (and the image wcs) again for every set of positions.
+#
+#     python psf_server.py --work sims --input_dir sims --socket psf.sock &
+#
+#     from psf_server import PSFClient
+#     with PSFClient('psf.sock') as client:
+#         result = client.query('DECam_00241238', 1, x, y, stamps=True)
+#         e1, e2, size, flag, stamps = (result[k] for k in ['e1','e2','size','flag','stamps'])
+#
+# The server listens on a unix socket, and keeps the most recently used models in memory.
+# A query is a batch of positions on one or more (exposure, ccd), and the replies are the HSM
+# shapes of the model at each position as measure_psf_shapes would find them (e1, e2, size,
+# flag), and/or the model images themselves (stamps).  Concurrent queries for the same ccd are
+# combined into one batch.
+#
+# Each message is an 8 byte header length, a json header, and then the raw bytes of the arrays
+# listed in the header.
+
+import os
+import json
+import glob
+import time
+import socket
+import struct
+import threading
+import collections
+import socketserver
+import numpy
+import psf_models
+
+
+def parse_args(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Serve PSF model shapes and images over a unix socket')
+
+    parser.add_argument('--work', default='./',
+                        help='location of work directory, where the psf files are in {work}/{exp}')
+    parser.add_argument('--input_dir', default=None,
+                        help='location of the input images (default: work)')
+    parser.add_argument('--socket', default='psf_server.sock',
+                        help='the unix socket to listen on')
+    parser.add_argument('--max_models', default=64, type=int,
+                        help='the most PSF models to keep in memory')
+    parser.add_argument('--use_piff', default=False, action='store_const', const=True,
+                        help='Use Piff, not PSFEx')
+
+    args = parser.parse_args(argv)
+    return args
+
+
+def send_message(sock, header, arrays=()):
+    """Send a json serializable header and a list of (name, array) pairs.
+    """
+    arrays = [ (name, numpy.ascontiguousarray(a)) for name, a in arrays ]
+    header = dict(header, arrays=[ (name, a.dtype.str, a.shape) for name, a in arrays ])
+    h = json.dumps(header).encode()
+    sock.sendall(struct.pack('>Q', len(h)) + h)
+    for name, a in arrays:
+        sock.sendall(a.data)
+
+def _recv_exactly(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    while n > 0:
+        k = sock.recv_into(view, n)
+        if k == 0:
+            raise EOFError("Connection closed")
+        view = view[k:]
+        n -= k
+    return buf
+
+def recv_message(sock):
+    """Receive a message sent by send_message.  Returns header, dict of arrays.
+    """
+    n, = struct.unpack('>Q', _recv_exactly(sock, 8))
+    header = json.loads(_recv_exactly(sock, n).decode())
+    arrays = {}
+    for name, dtype, shape in header.pop('arrays'):
+        dtype = numpy.dtype(dtype)
+        nbytes = int(numpy.prod(shape)) * dtype.itemsize
+        arrays[name] = numpy.frombuffer(_recv_exactly(sock, nbytes), dtype=dtype).reshape(shape)
+    return header, arrays
+
+
+class Job(object):
+    # A query for some positions on one ccd, waiting to be done as part of a batch.
+    def __init__(self, x, y, opts):
+        self.x = x
+        self.y = y
+        self.opts = opts
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class PSFService(object):
+    """Find the PSF model shapes and images at positions on a ccd, combining concurrent
+    requests for the same ccd into one batch.
+    """
+    def __init__(self, work, input_dir=None, max_models=64, use_piff=False):
+        self.work = os.path.expanduser(work)
+        self.input_dir = os.path.expanduser(input_dir) if input_dir else self.work
+        self.use_piff = use_piff
+        # The models are kept by psf_models.load_psf.
+        psf_models.set_max_models(max_models)
+        self.files = {}
+        self.queues = {}
+        self.lock = threading.Lock()
+        self.nquery = 0
+        self.nbatch = 0
+
+    def file_names(self, exp, ccd):
+        """The image and psf file names for a ccd.
+        """
+        import build_psf_cats
+
+        key = (exp, ccd)
+        with self.lock:
+            if key in self.files:
+                return self.files[key]
+        files = sorted(glob.glob(os.path.join(self.input_dir, '*%s_%02d.fits*'%(exp, ccd))))
+        if len(files) == 0:
+            raise IOError("No image found for exp %s, ccd %d in %s"%(exp, ccd, self.input_dir))
+        file_name = files[0]
+        desdm_dir, root, ccdnum = build_psf_cats.ccd_name(file_name)
+        psf_file_name = os.path.join(self.work, exp, root + '_psfcat.psf')
+        with self.lock:
+            self.files[key] = (file_name, psf_file_name)
+        return file_name, psf_file_name
+
+    def query(self, exp, ccd, x, y, shapes=True, stamps=False, stamp_size=64, pixel_scale=0.2):
+        """The shapes and/or stamps of the model for (exp, ccd) at x, y, as a dict of arrays.
+        """
+        job = Job(x, y, (shapes, stamps, stamp_size, pixel_scale))
+        with self.lock:
+            self.nquery += 1
+            queue = self.queues.setdefault((exp, ccd), { 'pending' : [], 'busy' : False })
+            queue['pending'].append(job)
+            leader = not queue['busy']
+            queue['busy'] = True
+
+        if leader:
+            # Do all the jobs for this ccd, including any that arrive while we work.
+            while True:
+                with self.lock:
+                    jobs = queue['pending']
+                    queue['pending'] = []
+                    if not jobs:
+                        queue['busy'] = False
+                        break
+                    self.nbatch += 1
+                self._run(exp, ccd, jobs)
+
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.result
+
+    def _run(self, exp, ccd, jobs):
+        import galsim
+        import build_psf_cats
+
+        try:
+            file_name, psf_file_name = self.file_names(exp, ccd)
+            psf = psf_models.load_psf(psf_file_name, file_name, self.use_piff)
+        except Exception as e:
+            for job in jobs:
+                job.error = e
+                job.done.set()
+            return
+
+        by_opts = collections.defaultdict(list)
+        for job in jobs:
+            by_opts[job.opts].append(job)
+        for (shapes, stamps, stamp_size, pixel_scale), group in by_opts.items():
+            try:
+                x = numpy.concatenate([ job.x for job in group ])
+                y = numpy.concatenate([ job.y for job in group ])
+                print('%s ccd %d: %d positions from %d queries'%(exp, ccd, len(x), len(group)))
+                result = {}
+                if shapes:
+                    out = build_psf_cats.init_catalog(len(x))
+                    build_psf_cats.measure_psf_shapes(x, y, psf_file_name, file_name,
+                                                      use_piff=self.use_piff, out=out, psf=psf)
+                    result['e1'] = out['psf_e1']
+                    result['e2'] = out['psf_e2']
+                    result['size'] = out['psf_size']
+                    result['flag'] = out['flag']
+                if stamps:
+                    im = galsim.Image(stamp_size, stamp_size, scale=pixel_scale)
+                    cube = numpy.empty((len(x), stamp_size, stamp_size), dtype=numpy.float32)
+                    for i, stamp in enumerate(psf_models.draw_psf(psf, x, y, im, self.use_piff)):
+                        cube[i] = stamp
+                    result['stamps'] = cube
+                start = 0
+                for job in group:
+                    end = start + len(job.x)
+                    job.result = { key : result[key][start:end] for key in result }
+                    start = end
+            except Exception as e:
+                for job in group:
+                    job.error = e
+            for job in group:
+                job.done.set()
+
+    def stats(self):
+        info = psf_models.cache_info()
+        return { 'queries' : self.nquery, 'batches' : self.nbatch,
+                 'models' : info.currsize, 'model_loads' : info.misses,
+                 'model_hits' : info.hits }
+
+
+class Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        service = self.server.service
+        while True:
+            try:
+                header, arrays = recv_message(self.request)
+            except EOFError:
+                return
+            t0 = time.time()
+            try:
+                if header['op'] == 'stats':
+                    send_message(self.request, dict(status='ok', stats=service.stats()))
+                    continue
+                # The positions are in groups, one per ccd.
+                results = []
+                start = 0
+                for exp, ccd, n in header['ccds']:
+                    x = arrays['x'][start:start+n]
+                    y = arrays['y'][start:start+n]
+                    results.append(service.query(exp, ccd, x, y, shapes=header['shapes'],
+                                                 stamps=header['stamps'],
+                                                 stamp_size=header['stamp_size'],
+                                                 pixel_scale=header['pixel_scale']))
+                    start += n
+                out = [ (key, numpy.concatenate([ r[key] for r in results ]))
+                        for key in sorted(results[0]) ] if results else []
+                send_message(self.request, dict(status='ok', time=time.time()-t0), out)
+            except Exception as e:
+                send_message(self.request, dict(status='error', error='%s: %s'%(
+                             type(e).__name__, e)))
+
+
+class PSFServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, socket_file, service):
+        self.service = service
+        socketserver.UnixStreamServer.__init__(self, socket_file, Handler)
+
+
+class PSFClient(object):
+    """A connection to a psf_server.py.
+    """
+    def __init__(self, socket_file='psf_server.sock'):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(socket_file)
+
+    def query(self, exp, ccd, x, y, shapes=True, stamps=False, stamp_size=64, pixel_scale=0.2):
+        """Get the PSF model shapes and/or images at positions x, y.
+
+        exp, ccd may be single values for all the positions, or arrays with one value per
+        position.
+
+        Returns a dict with e1, e2, size, flag (as measure_psf_shapes would give for the PSF
+        model) if shapes, and stamps (an array of shape (n, stamp_size, stamp_size)) if stamps.
+        """
+        x = numpy.atleast_1d(numpy.asarray(x, dtype=float))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype=float))
+        exp = numpy.broadcast_to(numpy.asarray(exp, dtype=str), x.shape)
+        ccd = numpy.broadcast_to(numpy.asarray(ccd, dtype=int), x.shape)
+
+        # Send the positions grouped by ccd.
+        keys = numpy.char.add(numpy.char.add(exp, '_'), numpy.char.mod('%02d', ccd))
+        order = numpy.argsort(keys, kind='stable')
+        _, first, counts = numpy.unique(keys[order], return_index=True, return_counts=True)
+        ccds = [ (str(exp[order[i]]), int(ccd[order[i]]), int(n)) for i, n in zip(first, counts) ]
+        header = dict(op='query', ccds=ccds, shapes=shapes, stamps=stamps,
+                      stamp_size=stamp_size, pixel_scale=pixel_scale)
+        send_message(self.sock, header, [('x', x[order]), ('y', y[order])])
+        header, arrays = recv_message(self.sock)
+        if header['status'] != 'ok':
+            raise RuntimeError(header['error'])
+
+        # Put them back in the original order.
+        result = {}
+        for key, a in arrays.items():
+            result[key] = numpy.empty_like(a)
+            result[key][order] = a
+        return result
+
+    def stats(self):
+        send_message(self.sock, dict(op='stats'))
+        header, arrays = recv_message(self.sock)
+        return header['stats']
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main():
+    args = parse_args()
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    service = PSFService(args.work, args.input_dir, max_models=args.max_models,
+                         use_piff=args.use_piff)
+    server = PSFServer(args.socket, service)
+    print('Serving PSF models on ',args.socket)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(args.socket)
+
+
+if __name__ == "__main__":
+    main()
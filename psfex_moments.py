@@ -0,0 +1,183 @@
+# The shapes of a PSFEx model from the moments of its basis images, without drawing it.
+#
+# A PSFEx model at a position is sum_k P_k(x,y) B_k, where the B_k are the basis images (in
+# psfex pixels) and the P_k are the polynomial terms in x,y.  So any moment of the model
+# image with a fixed weight is sum_k P_k(x,y) m_k, where m_k is the same moment of B_k.
+# BasisMoments measures the Gaussian weighted moments m_k of each basis image once per ccd.
+# Then the moments of the model at all the stars are one matrix product.
+#
+# The weight is a round Gaussian with the adaptive moments size of the model at the center of
+# the ccd.  The weighted second moments are corrected for the weight as for a Gaussian profile
+# ((M_w^-1 - W^-1)^-1), which is the answer the adaptive moments of measure_psf_shapes give for
+# a Gaussian.  Then they are put through the local wcs, as getPSF does.  The model is not a
+# Gaussian, so the result is not quite the same as the rendered HSM measurement.  calibrate
+# compares the two on some of the stars, to show how far off they are for quick-look and
+# monitoring runs.  (cf. build_psf_cats.py --psf_moments analytic)
+
+import numpy
+import galsim
+
+
+class BasisMoments(object):
+    """The Gaussian weighted moments of the basis images of a PSFEx model (a
+    galsim.des.DES_PSFEx).
+
+    sigma_w     The size of the weight, in psfex pixels.  (default: the adaptive moments size
+                of the model at center)
+    center      The position to measure sigma_w at.  (default: the polynomial zero point)
+    """
+    def __init__(self, psf, sigma_w=None, center=None):
+        self.psf = psf
+        basis = numpy.asarray(psf.basis, dtype=float)
+        nb, ny, nx = basis.shape
+
+        if sigma_w is None:
+            if center is None:
+                center = galsim.PositionD(psf.x_zero, psf.y_zero)
+            sigma_w = self._model_sigma(psf, center)
+        self.sigma_w = sigma_w
+
+        # Pixel positions relative to the center of the basis images (which is where
+        # InterpolatedImage puts the center of the profile).
+        x = numpy.arange(nx) - (nx-1) / 2.
+        y = numpy.arange(ny) - (ny-1) / 2.
+        xx, yy = numpy.meshgrid(x, y)
+        w = numpy.exp(-0.5 * (xx**2 + yy**2) / sigma_w**2)
+        terms = numpy.array([ w, w*xx, w*yy, w*xx*xx, w*xx*yy, w*yy*yy ])
+        # moments[k,j] = sum(terms[j] * basis[k])
+        self.moments = basis.reshape(nb, -1).dot(terms.reshape(6, -1).T)
+
+    @staticmethod
+    def _model_sigma(psf, pos):
+        # The adaptive moments size of the model image at pos, in psfex pixels.
+        im = galsim.Image(numpy.ascontiguousarray(psf.getPSFArray(pos), dtype=float))
+        shape_data = im.FindAdaptiveMom(strict=False)
+        if shape_data.moments_status == 0:
+            return shape_data.moments_sigma
+        # Fall back to the unweighted size of the constant term.
+        b = psf.basis[0]
+        y, x = numpy.indices(b.shape)
+        x = x - (b.shape[1]-1) / 2.
+        y = y - (b.shape[0]-1) / 2.
+        return (numpy.sum(b * (x**2 + y**2)) / (2. * numpy.sum(b)))**0.5
+
+    def poly_terms(self, xlist, ylist):
+        """The polynomial terms P_k of the model at each x,y.  (cf. DES_PSFEx.getPSFArray)
+        """
+        psf = self.psf
+        xt = (numpy.asarray(xlist, dtype=float) - psf.x_zero) / psf.x_scale
+        yt = (numpy.asarray(ylist, dtype=float) - psf.y_zero) / psf.y_scale
+        order = psf.fit_order
+        return numpy.array([ xt**nx * yt**ny for ny in range(order+1)
+                             for nx in range(order+1-ny) ]).T
+
+    def __call__(self, xlist, ylist, wcs=None):
+        """The shapes of the model at each x,y.
+
+        wcs is the wcs of the image, for the shapes in world coordinates.  (default: psf.wcs,
+        or the image coordinates if that is None)
+
+        Returns g1, g2, size, centroid, ok, where size is in arcsec, centroid is the offset of
+        the centroid in arcsec, and ok is False where the moments are not positive definite.
+        """
+        if wcs is None:
+            wcs = self.psf.wcs
+        n = len(xlist)
+        m = self.poly_terms(xlist, ylist).dot(self.moments)
+        m00 = m[:,0]
+        xc = m[:,1] / m00
+        yc = m[:,2] / m00
+        Mw = numpy.empty((n, 2, 2))
+        Mw[:,0,0] = m[:,3] / m00 - xc**2
+        Mw[:,0,1] = Mw[:,1,0] = m[:,4] / m00 - xc*yc
+        Mw[:,1,1] = m[:,5] / m00 - yc**2
+
+        # Remove the weight.
+        Minv = numpy.linalg.inv(Mw) - numpy.eye(2) / self.sigma_w**2
+        det = Minv[:,0,0] * Minv[:,1,1] - Minv[:,0,1]**2
+        ok = (m00 > 0) & (Minv[:,0,0] > 0) & (det > 0)
+        Minv[~ok] = numpy.eye(2)
+        M = numpy.linalg.inv(Minv)
+
+        # To image pixels, then to world coordinates with the local jacobian at each star.
+        samp = self.psf.sample_scale
+        M *= samp**2
+        cen = numpy.array([xc, yc]).T * samp
+        if wcs is not None:
+            jac = numpy.array([ wcs.jacobian(galsim.PositionD(x,y)).getMatrix()
+                                for x, y in zip(xlist, ylist) ])
+            M = numpy.matmul(numpy.matmul(jac, M), jac.transpose(0,2,1))
+            cen = numpy.matmul(jac, cen[:,:,numpy.newaxis])[:,:,0]
+
+        # Distortion -> shear, and size = det(M)^1/4, as the adaptive moments report them.
+        tr = M[:,0,0] + M[:,1,1]
+        e1 = (M[:,0,0] - M[:,1,1]) / tr
+        e2 = 2. * M[:,0,1] / tr
+        esq = e1**2 + e2**2
+        ok &= esq < 1.
+        factor = 1. / (1. + numpy.sqrt(numpy.clip(1. - esq, 0., None)))
+        size = numpy.abs(M[:,0,0] * M[:,1,1] - M[:,0,1]**2)**0.25
+        return e1 * factor, e2 * factor, size, numpy.sqrt(numpy.sum(cen**2, axis=1)), ok
+
+
+def measure_psf_moments(xlist, ylist, psf, out, bounds=None):
+    """Fill in the psf_e1, psf_e2, psf_size, flag columns of out (cf.
+    build_psf_cats.init_catalog) from the basis moments of the PSFEx model psf, in place of
+    build_psf_cats.measure_psf_shapes.
+
+    bounds is the bounds of the image, to measure the weight size at its center.
+
+    Returns the BasisMoments.
+    """
+    import build_psf_cats
+
+    if bounds is not None:
+        center = galsim.PositionD((bounds.xmin + bounds.xmax) / 2., (bounds.ymin + bounds.ymax) / 2.)
+    else:
+        center = None
+    moments = BasisMoments(psf, center=center)
+    print('Analytic PSFEx moments with sigma_w = %.3f psfex pixels'%moments.sigma_w)
+    g1, g2, size, centroid, ok = moments(xlist, ylist)
+    shift = ok & (centroid > build_psf_cats.MAX_CENTROID_SHIFT * 0.2)
+    good = ok & ~shift
+    out['flag'][~ok] |= build_psf_cats.PSFEX_BAD_MEASUREMENT
+    out['flag'][shift] |= build_psf_cats.PSFEX_CENTROID_SHIFT
+    out['psf_e1'][good] = g1[good]
+    out['psf_e2'][good] = g2[good]
+    out['psf_size'][good] = size[good]
+    print('   %d stars, %d bad moments, %d centroid shifts'%(len(xlist), numpy.sum(~ok),
+                                                             numpy.sum(shift)))
+    return moments
+
+def calibrate(xlist, ylist, out, psf, psf_file_name, file_name, ncal=20, stamp_size=64):
+    """Compare the analytic model shapes in out with measure_psf_shapes at ncal of the stars,
+    spread evenly through the list.
+
+    Returns a dict with the number of stars compared (NCAL) and the mean (MEAND*), rms
+    (RMSD*) and maximum (MAXD*) of analytic - rendered for E1, E2 and SIZE, and the mean ratio
+    of the sizes (SIZERAT).
+    """
+    import build_psf_cats
+
+    n = len(xlist)
+    index = numpy.unique(numpy.linspace(0, n-1, min(ncal, n)).astype(int))
+    ref = build_psf_cats.init_catalog(len(index))
+    build_psf_cats.measure_psf_shapes(numpy.asarray(xlist)[index], numpy.asarray(ylist)[index],
+                                      psf_file_name, file_name, out=ref, psf=psf,
+                                      stamp_size=stamp_size)
+    good = (ref['flag'] == 0) & (out['flag'][index] & build_psf_cats.PSFEX_BAD_MEASUREMENT == 0)
+    good &= (out['psf_size'][index] < 999.)
+    report = { 'NCAL' : int(numpy.sum(good)) }
+    for name, col in [('E1', 'psf_e1'), ('E2', 'psf_e2'), ('SIZE', 'psf_size')]:
+        d = (out[col][index] - ref[col]).astype(float)[good]
+        report['MEAND'+name] = float(numpy.mean(d)) if len(d) > 0 else -1.
+        report['RMSD'+name] = float(numpy.sqrt(numpy.mean(d**2))) if len(d) > 0 else -1.
+        report['MAXD'+name] = float(numpy.max(numpy.abs(d))) if len(d) > 0 else -1.
+    ratio = (out['psf_size'][index] / ref['psf_size'])[good]
+    report['SIZERAT'] = float(numpy.mean(ratio)) if len(ratio) > 0 else -1.
+    print('analytic - rendered psf shapes at %d stars:'%report['NCAL'])
+    for name in ['E1', 'E2', 'SIZE']:
+        print('   %s: mean = %.2e, rms = %.2e, max = %.2e'%(
+              name.lower(), report['MEAND'+name], report['RMSD'+name], report['MAXD'+name]))
+    print('   size ratio = %.4f'%report['SIZERAT'])
+    return report
@@ -7,8 +7,12 @@
 import os
 import numpy
 from toFocal import toFocal
+from star_schema import star_dtype, filter_code, filter_codes, memory_report, max_rss
 
-def parse_args():
+RESERVED = 64
+BAD_CCDS = [2, 31, 61]
+
+def parse_args(argv=None):
     import argparse
     
     parser = argparse.ArgumentParser(description='Run PSFEx on a set of runs/exposures')
@@ -32,6 +36,32 @@ def parse_args():
                         help='maximum tiling to use')
     parser.add_argument('--use_reserved', default=False, action='store_const', const=True,
                         help='just use the objects with the RESERVED flag')
+    parser.add_argument('--nside', default=1024, type=int,
+                        help='HEALPix nside of the sky index written with the star catalog')
+    parser.add_argument('--npatch', default=0, type=int,
+                        help='number of sky patches to use for the covariance (0 = shot noise only)')
+    parser.add_argument('--var_method', default='jackknife',
+                        help='how to estimate the covariance from the patches (jackknife, bootstrap, ...)')
+    parser.add_argument('--switch_sep', default=None, type=float,
+                        help='use a grid estimator for separations above this (arcmin)')
+    parser.add_argument('--grid_pixel', default=None, type=float,
+                        help='cell size of the grid estimator (arcmin, default: switch_sep/20)')
+    parser.add_argument('--switch_tol', default=0.02, type=float,
+                        help='only use the grid if it is within this fraction of the largest |xi| of the pair counts where they overlap')
+    parser.add_argument('--quick', default=0, type=int,
+                        help='quick look: only use a random subsample of about this many stars')
+    parser.add_argument('--seed', default=1234, type=int,
+                        help='random seed for the quick look subsample')
+    parser.add_argument('--nsig', default=3., type=float,
+                        help='significance (in sigma) required to flag a quick look bin as detected')
+    parser.add_argument('--cache_dir', default=None,
+                        help='where to cache the correlation results (default: {work}/corr_cache)')
+    parser.add_argument('--cache_size', default=2., type=float,
+                        help='maximum size of the correlation cache in GB')
+    parser.add_argument('--no_cache', default=False, action='store_const', const=True,
+                        help='always recompute the correlations')
+    parser.add_argument('--store', default=None,
+                        help='read the stars from this catalog store (cf. catalog_store.py) rather than the psf_cats files')
 
     # Options
     parser.add_argument('--single_ccd', default=False, action='store_const', const=True,
@@ -39,17 +69,24 @@ def parse_args():
     parser.add_argument('--oldkeys', default=False, action='store_const', const=True,
                         help='Use old psfex_* keys in the cats files')
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
     return args
 
 
-def read_data(args, work, limit_filters=None, subtract_mean=True, reserved=False):
+def read_data(args, work, limit_filters=None, subtract_mean=True, reserved=False, catalogs=None):
+    """Read the psf catalogs for the exposures and select the stars to use.
+
+    If catalogs is given, it should be a dict mapping exp to the psf catalog for that exposure
+    (e.g. as returned by build_psf_cats.build_exposure), which is used rather than reading
+    the catalog files.
+    """
     import astropy.io.fits as pyfits
 
     datadir = '/astro/u/astrodat/data/DES'
 
-    RESERVED = 64
-    BAD_CCDS = [2, 31, 61]
+    if args.store is not None and catalogs is None:
+        return read_store(args, args.store, limit_filters=limit_filters,
+                          subtract_mean=subtract_mean)
 
     if args.file != '':
         print('Read file ',args.file)
@@ -91,7 +128,7 @@ def read_data(args, work, limit_filters=None, subtract_mean=True, reserved=False
     else:
         inkeys = keys
 
-    all_filters = []  # This keeps track of the filter for each record
+    all_filters = []  # This keeps track of the filter code for each record
     all_tilings = []  # This keeps track of the tiling for each record
     filters = set()   # This is the set of all filters being used
     tilings = set()   # This is the set of all tilings being used
@@ -135,16 +172,22 @@ def read_data(args, work, limit_filters=None, subtract_mean=True, reserved=False
             print('tiling is > %d.  Skip this exposure.'%args.max_tiling)
             continue
 
-        cat_file = os.path.join(cat_dir, "sim_DECam_" + exp + "_exppsf.fits")
-        if not os.path.exists(cat_file):
-            cat_file = os.path.join(cat_dir, exp + "_psf.fits")
-        print('cat_file = ',cat_file)
-        try:
-            with pyfits.open(cat_file) as pyf:
-                data = pyf[1].data
-        except:
-            print('Unable to open cat_file %s.  Skipping this file.'%cat_file)
-            continue
+        if catalogs is not None:
+            if exp not in catalogs:
+                print('No catalog for exp %s.  Skipping this exposure.'%exp)
+                continue
+            data = catalogs[exp]
+        else:
+            cat_file = os.path.join(cat_dir, "sim_DECam_" + exp + "_exppsf.fits")
+            if not os.path.exists(cat_file):
+                cat_file = os.path.join(cat_dir, exp + "_psf.fits")
+            print('cat_file = ',cat_file)
+            try:
+                with pyfits.open(cat_file) as pyf:
+                    data = pyf[1].data
+            except:
+                print('Unable to open cat_file %s.  Skipping this file.'%cat_file)
+                continue
 
         #ccdnums = numpy.unique(data['ccdnum'])
         #print 'ccdnums = ',ccdnums
@@ -175,48 +218,22 @@ def read_data(args, work, limit_filters=None, subtract_mean=True, reserved=False
         for key, inkey in zip(keys, inkeys):
             all_data[key].append(data[inkey][mask])
 
-        all_data['exp'].append([expnum] * ngood)
+        all_data['exp'].append(numpy.full(ngood, expnum, dtype='i4'))
         all_data['ccd'].append(data['ccdnum'][mask])
 
         if subtract_mean:
-            e1 = data['e1'][mask]
-            e2 = data['e2'][mask]
-            s = data['size'][mask]
-            p_e1 = data['psf_e1'][mask]
-            p_e2 = data['psf_e2'][mask]
-            p_s = data['psf_size'][mask]
-            de1 = numpy.mean(e1-p_e1)
-            de2 = numpy.mean(e2-p_e2)
-            # Really want <(s^2 - p_s^2)/s^2> => 0  after subtracting ds
-            # <1 - p_s^2/(s-ds)^2> = 0
-            # <1 - p_s^2/s^2 (1 + 2ds/s + 3ds^2/s^2 + ...)  > = 0
-            # 1 - <p_s^2/s^2> - 2ds<p_s^2/s^3> - 3ds^2<p_s^2/s^4> = 0
-            a1 = numpy.mean(p_s**2/s**2)
-            a2 = numpy.mean(p_s**2/s**3)
-            a3 = numpy.mean(p_s**2/s**4)
-            ds = (1. - a1) / (2.*a2)
-            # Iterate once to refine
-            ds = (1. - a1 - 3.*ds**2*a3) / (2.*a2)
-            print('de = ',de1,de2, 'mean e = ',numpy.mean(e1),numpy.mean(e2), end=' ')
-            print(' -> ',numpy.mean(e1-de1), numpy.mean(e2-de2))
-            print('ds = ',ds, 'mean s = ',numpy.mean(s),' -> ',numpy.mean(s-ds))
-            print('mean dt = ',numpy.mean( (s**2 - p_s**2) / s**2 ), end=' ')
-            print(' -> ',numpy.mean( ((s-ds)**2 - p_s**2) / (s-ds)**2 ))
-            all_data['alt_e1'].append(e1 - de1)
-            all_data['alt_e2'].append(e2 - de2)
-            all_data['alt_size'].append(s - ds)
+            alt_e1, alt_e2, alt_size = subtract_mean_shifts(data[mask])
+            all_data['alt_e1'].append(alt_e1)
+            all_data['alt_e2'].append(alt_e2)
+            all_data['alt_size'].append(alt_size)
 
         if 'x' in keys:
-            # Convert to focal position.
-            x,y = toFocal(data['ccdnum'][mask], data['x'][mask], data['y'][mask])
-            # This comes back in units of mm.  Convert to arcsec.
-            # 1 pixel = 15e-3 mm = 0.263 arcsec
-            x *= 0.263/15e-3
-            y *= 0.263/15e-3
+            # Convert to focal position in arcsec.
+            x,y = toFocal(data['ccdnum'][mask], data['x'][mask], data['y'][mask], arcsec=True)
             all_data['fov_x'].append(x)
             all_data['fov_y'].append(y)
 
-        all_filters.extend( ([filter] * ngood) )
+        all_filters.append(numpy.full(ngood, filter_code(filter), dtype='i1'))
         #all_tilings.extend( ([tiling] * ngood) )
         filters.add(filter)
         #tilings.add(tiling)
@@ -226,16 +243,18 @@ def read_data(args, work, limit_filters=None, subtract_mean=True, reserved=False
 
     # Turn the data into a recarray
     #print('all_data.keys = ',list(all_data.keys()))
-    formats = ['f8'] * len(all_keys) + ['a1', 'i2']
     names = all_keys + ['filter', 'tiling']
-    data = numpy.recarray(shape = (len(all_filters),),
-                          formats = formats, names = names)
+    nstar = sum(len(f) for f in all_filters)
+    data = numpy.recarray(shape = (nstar,), dtype = star_dtype(names))
     #print('data.dtype = ',data.dtype)
     for key in all_keys:
-        data[key] = numpy.concatenate(all_data[key])
-    data['filter'] = all_filters
+        data[key] = numpy.concatenate(all_data[key]) if nstar > 0 else []
+        # Free the inputs as we go, so we don't hold two copies of everything.
+        del all_data[key]
+    data['filter'] = numpy.concatenate(all_filters) if nstar > 0 else []
     #data['tiling'] = all_tilings
     print('made recarray')
+    memory_report('star data', data)
 
     print('ntot = ',ntot)
     print('nused = ',nused)
@@ -245,11 +264,155 @@ def read_data(args, work, limit_filters=None, subtract_mean=True, reserved=False
     return data, filters, tilings
 
 
-def measure_rho(data, max_sep, tag=None, prefix='', use_xy=False, alt_tt=False):
+def subtract_mean_shifts(data):
+    """Remove the mean difference between the star and psf shapes and sizes.
+
+    Returns the adjusted e1, e2, size.
+    """
+    e1 = data['e1']
+    e2 = data['e2']
+    s = data['size']
+    p_e1 = data['psf_e1']
+    p_e2 = data['psf_e2']
+    p_s = data['psf_size']
+    de1 = numpy.mean(e1-p_e1)
+    de2 = numpy.mean(e2-p_e2)
+    # Really want <(s^2 - p_s^2)/s^2> => 0  after subtracting ds
+    # <1 - p_s^2/(s-ds)^2> = 0
+    # <1 - p_s^2/s^2 (1 + 2ds/s + 3ds^2/s^2 + ...)  > = 0
+    # 1 - <p_s^2/s^2> - 2ds<p_s^2/s^3> - 3ds^2<p_s^2/s^4> = 0
+    a1 = numpy.mean(p_s**2/s**2)
+    a2 = numpy.mean(p_s**2/s**3)
+    a3 = numpy.mean(p_s**2/s**4)
+    ds = (1. - a1) / (2.*a2)
+    # Iterate once to refine
+    ds = (1. - a1 - 3.*ds**2*a3) / (2.*a2)
+    print('de = ',de1,de2, 'mean e = ',numpy.mean(e1),numpy.mean(e2), end=' ')
+    print(' -> ',numpy.mean(e1-de1), numpy.mean(e2-de2))
+    print('ds = ',ds, 'mean s = ',numpy.mean(s),' -> ',numpy.mean(s-ds))
+    print('mean dt = ',numpy.mean( (s**2 - p_s**2) / s**2 ), end=' ')
+    print(' -> ',numpy.mean( ((s-ds)**2 - p_s**2) / (s-ds)**2 ))
+    return e1 - de1, e2 - de2, s - ds
+
+
+def read_store(args, store, limit_filters=None, subtract_mean=True):
+    """Read the stars from a catalog store (cf. catalog_store.py).
+
+    This makes the same selection as read_data, but as a single scan of the store that only
+    reads the matching exposures and the needed columns.
+
+    Returns data, filters, tilings as read_data does.
+    """
+    import catalog_store
+
+    if args.file != '':
+        print('Read file ',args.file)
+        with open(args.file) as fin:
+            exps = [ line.split()[1] for line in fin ]
+    else:
+        exps = args.exps
+    expnums = [ int(exp[6:]) for exp in exps ]
+
+    keys = ['ra', 'dec', 'x', 'y', 'e1', 'e2', 'size', 'psf_e1', 'psf_e2', 'psf_size']
+    if args.oldkeys:
+        inkeys =  [ k.replace('psf_','psfex_') for k in keys ]
+    else:
+        inkeys = keys
+
+    flag = RESERVED if args.use_reserved else 0
+    print('reading store: ',store)
+    sdata = catalog_store.query(store, columns=inkeys + ['ccdnum', 'expnum', 'filter', 'tiling'],
+                                filters=limit_filters, expnums=expnums,
+                                max_tiling=args.max_tiling, flag=flag, exclude_ccds=BAD_CCDS)
+    if args.oldkeys:
+        sdata.dtype.names = [ keys[inkeys.index(n)] if n in inkeys else n
+                              for n in sdata.dtype.names ]
+    print('ngood = ',len(sdata))
+
+    all_keys = keys + ['exp', 'ccd']
+    if subtract_mean:
+        all_keys = all_keys + ['alt_e1', 'alt_e2', 'alt_size']
+    all_keys = all_keys + ['fov_x', 'fov_y']
+
+    names = all_keys + ['filter', 'tiling']
+    data = numpy.recarray(shape = (len(sdata),), dtype = star_dtype(names))
+    for key in keys:
+        data[key] = sdata[key]
+    data['exp'] = sdata['expnum']
+    data['ccd'] = sdata['ccdnum']
+    data['filter'] = filter_codes(sdata['filter'])
+    data['tiling'] = sdata['tiling']
+    data['fov_x'], data['fov_y'] = toFocal(sdata['ccdnum'], sdata['x'], sdata['y'], arcsec=True)
+    if subtract_mean:
+        # The mean shifts are per exposure.
+        for expnum in numpy.unique(sdata['expnum']):
+            k = sdata['expnum'] == expnum
+            data['alt_e1'][k], data['alt_e2'][k], data['alt_size'][k] = \
+                    subtract_mean_shifts(sdata[k])
+
+    filters = set(str(f) for f in numpy.unique(sdata['filter']))
+    tilings = set(numpy.unique(sdata['tiling']).tolist())
+    print('filters = ',filters)
+    print('tilings = ',tilings)
+    print('made recarray')
+    memory_report('star data', data)
+    return data, filters, tilings
+
+
+def measure_rho(data, max_sep, tag=None, prefix='', use_xy=False, alt_tt=False, patch=None,
+                var_method='jackknife', switch_sep=None, grid_pixel=None, switch_tol=0.02,
+                cache=None):
     """Compute the rho statistics
+
+    If patch is given, it is the sky patch number of each star (e.g. from
+    SkyIndex.patches).  Then TreeCorr keeps the pair sums for each pair of patches while
+    doing the correlations, and the covariance is estimated from these with var_method.
+    (cf. write_cov)  Otherwise the variance is just the shot noise.
+
+    If switch_sep is given (in arcmin), only the bins below switch_sep are computed by
+    pair counting, and the larger separations are done with FFTs on a grid with cells of
+    size grid_pixel (default switch_sep/20).  (cf. grid_corr.py)  The pair counting goes
+    up to 2*switch_sep so the two can be compared there, and the comparison is attached to
+    each result as rho.overlap.  (cf. write_overlap)  If the two differ anywhere in the
+    overlap by more than switch_tol times the largest |xi| there, the grid is not used for
+    that correlation, and the pair counting is redone for all the bins.
+
+    If cache is given (a corr_cache.CorrCache), the results are looked up there first, and
+    saved there if they had to be computed.
     """
     import treecorr
 
+    if cache is not None:
+        config = dict(max_sep=max_sep, prefix=prefix, use_xy=use_xy, alt_tt=alt_tt,
+                      var_method=var_method if patch is not None else 'shot',
+                      switch_sep=switch_sep, grid_pixel=grid_pixel, switch_tol=switch_tol)
+        cols = ['fov_x', 'fov_y'] if use_xy else ['ra', 'dec']
+        cols += [prefix+'e1', prefix+'e2', prefix+'size', 'psf_e1', 'psf_e2', 'psf_size']
+        if prefix != '':
+            cols.append('size')
+        arrays = [ data[col] for col in cols ]
+        if patch is not None:
+            arrays.append(patch)
+        funcs = [measure_rho]
+        if switch_sep is not None:
+            import grid_corr
+            funcs.append(grid_corr)
+        key = cache.key(arrays, config, funcs)
+        results = cache.get(key)
+        if results is None:
+            results = measure_rho(data, max_sep, tag=tag, prefix=prefix, use_xy=use_xy,
+                                  alt_tt=alt_tt, patch=patch, var_method=var_method,
+                                  switch_sep=switch_sep, grid_pixel=grid_pixel,
+                                  switch_tol=switch_tol)
+            cache.put(key, results)
+        return results
+
+    if patch is None:
+        var_method = 'shot'
+    elif switch_sep is not None:
+        print('The grid estimator does not do patches.  Using pair counts for all scales.')
+        switch_sep = None
+
     e1 = data[prefix+'e1']
     e2 = data[prefix+'e2']
     s = data[prefix+'size']
@@ -269,20 +432,24 @@ def measure_rho(data, max_sep, tag=None, prefix='', use_xy=False, alt_tt=False):
         print('x = ',x)
         print('y = ',y)
 
-        ecat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec', g1=e1, g2=e2)
-        decat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec', g1=de1, g2=de2)
+        ecat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec', g1=e1, g2=e2,
+                                patch=patch)
+        decat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec', g1=de1, g2=de2,
+                                 patch=patch)
         dtcat = treecorr.Catalog(x=x, y=y, x_units='arcsec', y_units='arcsec',
-                                 k=dt, g1=dt*e1, g2=dt*e2)
+                                 k=dt, g1=dt*e1, g2=dt*e2, patch=patch)
     else:
         ra = data['ra']
         dec = data['dec']
         print('ra = ',ra)
         print('dec = ',dec)
 
-        ecat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=e1, g2=e2)
-        decat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=de1, g2=de2)
+        ecat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=e1, g2=e2,
+                                patch=patch)
+        decat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', g1=de1, g2=de2,
+                                 patch=patch)
         dtcat = treecorr.Catalog(ra=ra, dec=dec, ra_units='deg', dec_units='deg', 
-                                 k=dt, g1=dt*e1, g2=dt*e2)
+                                 k=dt, g1=dt*e1, g2=dt*e2, patch=patch)
     ecat.name = 'ecat'
     decat.name = 'decat'
     dtcat.name = 'dtcat'
@@ -294,6 +461,26 @@ def measure_rho(data, max_sep, tag=None, prefix='', use_xy=False, alt_tt=False):
     bin_size = 0.2
     bin_slop = 0.1
 
+    all_bins = bins = dict(min_sep=min_sep, max_sep=max_sep, bin_size=bin_size)
+    if switch_sep is not None:
+        import grid_corr
+
+        edges = grid_corr.log_bins(min_sep, max_sep, bin_size)
+        # nsmall bins are entirely below switch_sep.  The tree does ntree >= nsmall bins.
+        nsmall = numpy.searchsorted(edges[1:], switch_sep, side='right')
+        ntree = max(numpy.searchsorted(edges[1:], 2.*switch_sep, side='right'), nsmall, 1)
+        print('Using pair counts for %d bins, and a grid for %d bins'%(nsmall, len(edges)-1-nsmall))
+        bins = dict(min_sep=min_sep, max_sep=edges[ntree], nbins=ntree)
+
+        if grid_pixel is None:
+            grid_pixel = switch_sep / 20.
+        if use_xy:
+            grid = grid_corr.Grid(data['fov_x']/60., data['fov_y']/60., grid_pixel, max_sep)
+        else:
+            grid = grid_corr.Grid(*grid_corr.project(data['ra'], data['dec']), grid_pixel,
+                                  max_sep)
+        fields = { ecat.name : (e1, e2), decat.name : (de1, de2), dtcat.name : (dt*e1, dt*e2) }
+
     results = []
     for (cat1, cat2) in [ (decat, decat),
                           (ecat, decat),
@@ -302,21 +489,48 @@ def measure_rho(data, max_sep, tag=None, prefix='', use_xy=False, alt_tt=False):
                           (ecat, dtcat) ]:
         print('Doing correlation of %s vs %s'%(cat1.name, cat2.name))
 
-        rho = treecorr.GGCorrelation(min_sep=min_sep, max_sep=max_sep, sep_units='arcmin',
-                                     bin_size=bin_size, bin_slop=bin_slop, verbose=2)
+        rho = treecorr.GGCorrelation(sep_units='arcmin', bin_slop=bin_slop, verbose=2,
+                                     var_method=var_method, **bins)
 
         if cat1 is cat2:
             rho.process(cat1)
         else:
             rho.process(cat1, cat2)
+
+        if switch_sep is not None:
+            print('Doing grid correlation of %s vs %s'%(cat1.name, cat2.name))
+            grho = grid_corr.grid_gg(grid, *fields[cat1.name], *fields[cat2.name], edges,
+                                     auto=cat1 is cat2)
+            overlap = grid_corr.overlap_report(cat1.name + ' x ' + cat2.name, rho, grho, nsmall)
+            if grid_corr.overlap_ok(overlap, switch_tol):
+                rho = grid_corr.stitch(rho, grho, nsmall)
+            else:
+                rho = treecorr.GGCorrelation(sep_units='arcmin', bin_slop=bin_slop, verbose=2,
+                                             var_method=var_method, **all_bins)
+                if cat1 is cat2:
+                    rho.process(cat1)
+                else:
+                    rho.process(cat1, cat2)
+            rho.overlap = overlap
         results.append(rho)
 
     if alt_tt:
         print('Doing alt correlation of %s vs %s'%(dtcat.name, dtcat.name))
 
-        rho = treecorr.KKCorrelation(min_sep=min_sep, max_sep=max_sep, sep_units='arcmin',
-                                     bin_size=bin_size, bin_slop=bin_slop, verbose=2)
+        rho = treecorr.KKCorrelation(sep_units='arcmin', bin_slop=bin_slop, verbose=2,
+                                     var_method=var_method, **bins)
         rho.process(dtcat)
+
+        if switch_sep is not None:
+            grho = grid_corr.grid_kk(grid, dt, dt, edges, auto=True)
+            overlap = grid_corr.overlap_report(dtcat.name + ' x ' + dtcat.name, rho, grho, nsmall)
+            if grid_corr.overlap_ok(overlap, switch_tol):
+                rho = grid_corr.stitch(rho, grho, nsmall)
+            else:
+                rho = treecorr.KKCorrelation(sep_units='arcmin', bin_slop=bin_slop, verbose=2,
+                                             var_method=var_method, **all_bins)
+                rho.process(dtcat)
+            rho.overlap = overlap
         results.append(rho)
 
     return results
@@ -427,6 +641,79 @@ def write_stats(stat_file, rho1, rho2, rho3, rho4, rho5, corr_tt=None):
     print('Done writing ',stat_file)
 
 
+def stratified_subsample(data, nstar, seed):
+    """Pick about nstar of the stars in data at random, keeping the same fraction of the
+    stars from each exposure and ccd.
+
+    The selection only depends on the seed and the data, so it is reproducible.
+    Returns the (sorted) indices of the selected stars.
+    """
+    rng = numpy.random.RandomState(seed)
+    frac = min(float(nstar) / len(data), 1.)
+    groups = data['exp'].astype(numpy.int64) * 100 + data['ccd'].astype(numpy.int64)
+    order = numpy.argsort(groups, kind='stable')
+    ugroups, start, counts = numpy.unique(groups[order], return_index=True, return_counts=True)
+    # Round the number to take from each group randomly, so the total is right on average.
+    ntake = numpy.floor(counts * frac + rng.uniform(size=len(counts))).astype(int)
+    ntake = numpy.minimum(ntake, counts)
+    index = [ order[s + rng.choice(c, n, replace=False)]
+              for s, c, n in zip(start, counts, ntake) if n > 0 ]
+    if len(index) == 0:
+        return numpy.empty(0, dtype=int)
+    return numpy.sort(numpy.concatenate(index))
+
+def quicklook_summary(stats, nsub, ntot, nsig):
+    """Summarize the rho statistics measured on a subsample of nsub out of ntot stars.
+
+    sigma is the error of the subsample estimate.  Since the shot noise goes as the number
+    of pairs, the expected error with all the stars is about sigma * nsub/ntot, which is
+    given as full_sigma.  A bin is flagged as significant if |xi| > nsig * sigma.
+    """
+    summary = { 'nsub' : int(nsub), 'ntot' : int(ntot), 'nsig' : nsig }
+    for i, rho in enumerate(stats[:5]):
+        sigma = numpy.sqrt(rho.varxi)
+        summary['rho%d'%(i+1)] = {
+            'meanr' : rho.meanr.tolist(),
+            'xip' : rho.xip.tolist(),
+            'xim' : rho.xim.tolist(),
+            'sigma' : sigma.tolist(),
+            'full_sigma' : (sigma * nsub / ntot).tolist(),
+            'xip_significant' : (numpy.abs(rho.xip) > nsig * sigma).tolist(),
+            'xim_significant' : (numpy.abs(rho.xim) > nsig * sigma).tolist(),
+        }
+    return summary
+
+def write_overlap(overlap_file, stats):
+    """Write the comparison of the pair count and grid estimates where they overlap
+    (cf. measure_rho with switch_sep).
+    """
+    import json
+
+    print('overlap_file = ',overlap_file)
+    with open(overlap_file,'w') as fp:
+        json.dump([ rho.overlap for rho in stats ], fp)
+    print('Done writing ',overlap_file)
+
+def write_cov(cov_file, stats, var_method='jackknife'):
+    """Write the joint covariance of the rho statistics computed with patches.
+
+    The data vector is xip, xim for each of rho1..rho5 (and xi for the alt tt correlation
+    if present), in that order, and the covariance is written as a json list of rows.
+    The patch pair sums were accumulated when the correlations were done, so this just
+    combines them.
+    """
+    import json
+    import treecorr
+
+    cov = treecorr.estimate_multi_cov(stats, var_method)
+    print('cov_file = ',cov_file)
+    with open(cov_file,'w') as fp:
+        json.dump({ 'var_method' : var_method,
+                    'nbins' : [ len(s.getStat()) for s in stats ],
+                    'cov' : cov.tolist() }, fp)
+    print('Done writing ',cov_file)
+
+
 def filter_combinations(filters, single=True, combo=True):
 
     if single:
@@ -447,7 +734,9 @@ def filter_combinations(filters, single=True, combo=True):
     return use_filters
 
 
-def do_canonical_stats(data, filters, tilings, work, prefix='', name='all', alt_tt=False):
+def do_canonical_stats(data, filters, tilings, work, prefix='', name='all', alt_tt=False,
+                       patch=None, var_method='jackknife', switch_sep=None, grid_pixel=None,
+                       switch_tol=0.02, cache=None):
     print('Start CANONICAL: ',prefix,name)
     # Measure the canonical rho stats using all pairs:
     use_filters = filter_combinations(filters)
@@ -455,13 +744,22 @@ def do_canonical_stats(data, filters, tilings, work, prefix='', name='all', alt_
     #for filt in use_filters:
     filt = [b'r']
     print('filter ',filt)
-    mask = numpy.in1d(data['filter'],filt)
+    mask = numpy.in1d(data['filter'],filter_codes(filt))
     print('sum(mask) = ',numpy.sum(mask))
     print('len(data[mask]) = ',len(data[mask]))
     tag = ''.join(str(filt))
-    stats = measure_rho(data[mask], max_sep=300, tag=tag, prefix=prefix, alt_tt=alt_tt)
+    stats = measure_rho(data[mask], max_sep=300, tag=tag, prefix=prefix, alt_tt=alt_tt,
+                        patch=None if patch is None else patch[mask], var_method=var_method,
+                        switch_sep=switch_sep, grid_pixel=grid_pixel, switch_tol=switch_tol,
+                        cache=cache)
     stat_file = os.path.join(work, "rho_%s_%s.json"%(name,tag))
     write_stats(stat_file,*stats)
+    if hasattr(stats[0], 'overlap'):
+        overlap_file = os.path.join(work, "rho_%s_%s_overlap.json"%(name,tag))
+        write_overlap(overlap_file, stats)
+    if patch is not None:
+        cov_file = os.path.join(work, "rho_%s_%s_cov.json"%(name,tag))
+        write_cov(cov_file, stats, var_method)
 
 def do_cross_tiling_stats(data, filters, tilings, work, prefix='', name='cross'):
     print('Start CROSS_TILING: ',prefix,name)
@@ -471,7 +769,7 @@ def do_cross_tiling_stats(data, filters, tilings, work, prefix='', name='cross')
         tile_data = []
         for til in tilings:
             print('til = ',til)
-            mask = numpy.in1d(data['filter'],filt) & (data['tiling'] == til)
+            mask = numpy.in1d(data['filter'],filter_codes(filt)) & (data['tiling'] == til)
             print('sum(mask) = ',numpy.sum(mask))
             print('len(data[mask]) = ',len(data[mask]))
             tile_data.append(data[mask])
@@ -491,7 +789,7 @@ def do_cross_band_stats(data, filters, tilings, work, prefix='', name='crossband
         print('cross filters ',filt)
         filt_data = []
         for f in filt:
-            mask = data['filter'] == f
+            mask = data['filter'] == filter_code(f)
             filt_data.append(data[mask])
         stats = measure_cross_rho(filt_data, max_sep=300, tags=filt, prefix=prefix)
         tag = ''.join(filt)
@@ -506,8 +804,8 @@ def do_odd_even_stats(data, filters, tilings, work, prefix='', name='oddeven'):
 
     for filt in use_filters:
         print('odd/even ',filt)
-        odd = numpy.in1d(data['filter'], filt) & (data['tiling'] % 2 == 1)
-        even = numpy.in1d(data['filter'], filt) & (data['tiling'] % 2 == 0)
+        odd = numpy.in1d(data['filter'], filter_codes(filt)) & (data['tiling'] % 2 == 1)
+        even = numpy.in1d(data['filter'], filter_codes(filt)) & (data['tiling'] % 2 == 0)
         cats = [ data[odd], data[even] ]
         tag = ''.join(filt)
         tags = [ tag + ":odd", tag + ":even" ]
@@ -516,20 +814,59 @@ def do_odd_even_stats(data, filters, tilings, work, prefix='', name='oddeven'):
         write_stats(stat_file,*stats)
 
 
-def do_fov_stats(data, filters, tilings, work, prefix='', name='fov'):
+def do_quicklook_stats(data, filters, tilings, work, nstar, seed, nsig=3., prefix='',
+                       name='quick', cache=None):
+    print('Start QUICKLOOK: ',prefix,name)
+    # Measure the rho stats on a random subsample of the stars in each filter.
+    import json
+    use_filters = filter_combinations(filters, combo=False)
+    for filt in use_filters:
+        print('filter ',filt)
+        mask = numpy.in1d(data['filter'], filter_codes(filt))
+        fdata = data[mask]
+        index = stratified_subsample(fdata, nstar, seed)
+        print('using %d of %d stars'%(len(index), len(fdata)))
+        tag = ''.join(filt)
+        stats = measure_rho(fdata[index], max_sep=300, tag=tag, prefix=prefix, cache=cache)
+        stat_file = os.path.join(work, "rho_%s_%s.json"%(name,tag))
+        write_stats(stat_file,*stats)
+
+        summary = quicklook_summary(stats, len(index), len(fdata), nsig)
+        summary['seed'] = seed
+        for i in range(1,6):
+            r = summary['rho%d'%i]
+            print('rho%d: %d of %d bins significant'%(i, sum(r['xip_significant']), len(r['xip'])))
+        summary_file = os.path.join(work, "quicklook_%s_%s.json"%(name,tag))
+        with open(summary_file,'w') as fp:
+            json.dump(summary, fp)
+        print('Done writing ',summary_file)
+
+
+def do_fov_stats(data, filters, tilings, work, prefix='', name='fov', patch=None,
+                 var_method='jackknife', switch_sep=None, grid_pixel=None, switch_tol=0.02,
+                 cache=None):
     print('Start FOV: ',prefix,name)
     # Measure the rho stats using the field-of-view positions.
     use_filters = filter_combinations(filters)
     for filt in use_filters:
         print('filter ',filt)
-        mask = numpy.in1d(data['filter'],filt)
+        mask = numpy.in1d(data['filter'],filter_codes(filt))
         print('sum(mask) = ',numpy.sum(mask))
         print('len(data[mask]) = ',len(data[mask]))
         tag = ''.join(filt)
         stats = measure_rho(data[mask], max_sep=300, tag=tag,
-                                                   prefix=prefix, use_xy=True)
+                                                   prefix=prefix, use_xy=True,
+                            patch=None if patch is None else patch[mask], var_method=var_method,
+                            switch_sep=switch_sep, grid_pixel=grid_pixel, switch_tol=switch_tol,
+                            cache=cache)
         stat_file = os.path.join(work, "rho_%s_%s.json"%(name,tag))
         write_stats(stat_file,*stats)
+        if hasattr(stats[0], 'overlap'):
+            overlap_file = os.path.join(work, "rho_%s_%s_overlap.json"%(name,tag))
+            write_overlap(overlap_file, stats)
+        if patch is not None:
+            cov_file = os.path.join(work, "rho_%s_%s_cov.json"%(name,tag))
+            write_cov(cov_file, stats, var_method)
 
 
 def set_args(**kwargs):
@@ -552,6 +889,18 @@ def set_args(**kwargs):
                       max_tiling=10,
                       runs='',
                       single_ccd=False,
+                      nside=1024,
+                      npatch=0,
+                      switch_sep=None,
+                      grid_pixel=None,
+                      switch_tol=0.02,
+                      quick=0,
+                      seed=1234,
+                      nsig=3.,
+                      cache_dir=None,
+                      cache_size=2.,
+                      no_cache=False,
+                      var_method='jackknife',
                       oldkeys=False,
                       tag='v1',
                       work='~/work/psfex_rerun/v1')
@@ -559,14 +908,34 @@ def set_args(**kwargs):
         setattr(args, key, kwargs[key])
     return args
 
+def build_sky_index(data, nside):
+    """Build a HEALPix index of the stars in data.  (cf. sky_index.py)
+    """
+    from sky_index import SkyIndex
+    print('Building sky index with nside = ',nside)
+    return SkyIndex.build(data['ra'], data['dec'], nside)
+
 def write_data(data, file_name):
     import fitsio
+    import star_schema
     print("Writing data to ",file_name)
-    fitsio.write(file_name, data, clobber=True)
+    # The filter column has the star_schema codes, so record what they mean.
+    header = [ { 'name' : 'FILT%d'%code, 'value' : name, 'comment' : 'filter with code %d'%code }
+               for code, name in enumerate(star_schema.filters) ]
+    header.append({ 'name' : 'FILTUNK', 'value' : star_schema.unknown_filter,
+                    'comment' : 'code of any other filter' })
+    fitsio.write(file_name, data, header=header, clobber=True)
 
 def main():
-
     args = parse_args()
+    run_rho(args)
+
+def run_rho(args, catalogs=None, write_cat=True):
+    """Compute and write the rho statistics.
+
+    If catalogs is given, use these rather than reading the psf catalogs from disk.
+    (cf. read_data)  If write_cat is False, don't write the combined psf_{tag}.fits catalog.
+    """
     print('args = ',args)
 
     # Make the work directory if it does not exist yet.
@@ -584,23 +953,35 @@ def main():
     #filters = ['r']
     #filters = ['r', 'i']
     #filters = ['r', 'i', 'z']
-    data, filters, tilings = read_data(args, work, limit_filters=filters, subtract_mean=False)
+    data, filters, tilings = read_data(args, work, limit_filters=filters, subtract_mean=False,
+                                       catalogs=catalogs)
     print('all filters = ',filters)
     print('all tilings = ',tilings)
 
-    out_file_name = os.path.join(work, "psf_%s.fits"%args.tag)
-    write_data(data, out_file_name)
+    # Index the catalog on the sky for region queries and jackknife patches.  cf. sky_index.py
+    index = build_sky_index(data, args.nside)
+
+    if write_cat:
+        out_file_name = os.path.join(work, "psf_%s.fits"%args.tag)
+        write_data(data, out_file_name)
+        index.save(os.path.join(work, "sky_index_%s.npz"%args.tag))
+
+    if args.npatch > 0:
+        # Assign the patches once for all the correlations.
+        patch = index.patches(args.npatch)
+        print('Using %d patches for the covariance'%(numpy.max(patch)+1))
+    else:
+        patch = None
 
     for filt in filters:
-        print('n for filter %s = '%filt, numpy.sum(data['filter'] == filt))
-        print('n for filter %s = '%filt, sum([f.decode() == filt for f in data['filter']]))
+        print('n for filter %s = '%filt, numpy.sum(data['filter'] == filter_code(filt)))
     for til in tilings:
         print('n for tiling %d = '%til, numpy.sum(data['tiling'] == til))
 
-    gdata = numpy.where(data['filter'] == b'g')[0]
-    rdata = numpy.where(data['filter'] == b'r')[0]
-    idata = numpy.where(data['filter'] == b'i')[0]
-    zdata = numpy.where(data['filter'] == b'z')[0]
+    gdata = numpy.where(data['filter'] == filter_code('g'))[0]
+    rdata = numpy.where(data['filter'] == filter_code('r'))[0]
+    idata = numpy.where(data['filter'] == filter_code('i'))[0]
+    zdata = numpy.where(data['filter'] == filter_code('z'))[0]
     odddata = numpy.where(data['tiling']%2 == 1)[0]
     evendata = numpy.where(data['tiling']%2 == 0)[0]
 
@@ -611,8 +992,24 @@ def main():
     print('len(odddata) = ',len(odddata))
     print('len(evendata) = ',len(evendata))
 
+    if args.no_cache:
+        cache = None
+    else:
+        from corr_cache import CorrCache
+        cache = CorrCache(args.cache_dir or os.path.join(work, 'corr_cache'),
+                          max_bytes=int(args.cache_size * 1024**3))
+
+    if args.quick > 0:
+        # Quick look for monitoring.  Skip the full calculation.
+        do_quicklook_stats(data, filters, tilings, work, args.quick, args.seed, args.nsig,
+                           cache=cache)
+        max_rss()
+        return
+
     #filters = ['r', 'i']
-    do_canonical_stats(data, filters, tilings, work, alt_tt=True)
+    do_canonical_stats(data, filters, tilings, work, alt_tt=True, patch=patch,
+                       var_method=args.var_method, switch_sep=args.switch_sep,
+                       grid_pixel=args.grid_pixel, switch_tol=args.switch_tol, cache=cache)
     
     #do_cross_tiling_stats(data, filters, tilings, work)
 
@@ -620,13 +1017,17 @@ def main():
 
     #do_odd_even_stats(data, filters, tilings, work)
 
-    #do_fov_stats(data, filters, tilings, work)
+    #do_fov_stats(data, filters, tilings, work, patch=patch, var_method=args.var_method,
+    #             switch_sep=args.switch_sep, grid_pixel=args.grid_pixel,
+    #             switch_tol=args.switch_tol, cache=cache)
 
     # Use subtract_mean=True to do these:
     #do_canonical_stats(data, filters, tilings, work, prefix='alt_', name='alt')
 
     #do_odd_even_stats(data, filters, tilings, work, prefix='alt_', name='altoddeven')
 
+    max_rss()
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,130 @@
+#/usr/bin/env python3
+# Simulate the chip images with GalSim, writing them directly into the sims directory.
+#
+# This replaces running `galsim realistic.yaml` followed by copy_fits.py.  The simulated image
+# for each chip is written along with the weight and bad pixel HDUs of its real counterpart and
+# the relevant header keywords from the real image, so there is no second copy pass.
+# The files are split over a pool of processes.
+#
+# The output type is also registered with GalSim, so a config file can use it directly with
+#     modules: [simulate]
+#     output: { type: DESSim, real_file_format: ..., sim_file_format: ... }
+
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+import galsim
+import copy_fits
+
+config_file = "realistic.yaml"
+
+def parse_args():
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Simulate the DECam chips for the sims workflow')
+
+    parser.add_argument('config_file', nargs='?', default=config_file,
+                        help='the GalSim config file (e.g. galsim_extra/examples/realistic.yaml)')
+    parser.add_argument('--real', default=copy_fits.real_fn,
+                        help='format string for the real image file names')
+    parser.add_argument('--output', default=copy_fits.output_fn,
+                        help='format string for the output file names')
+    parser.add_argument('--nproc', default=os.cpu_count(), type=int,
+                        help='number of processes to use')
+    parser.add_argument('--verbose', default=1, type=int,
+                        help='GalSim verbosity level')
+
+    args = parser.parse_args()
+    return args
+
+
+class DESSimBuilder(galsim.config.OutputBuilder):
+    """An OutputBuilder that writes the simulated image in the format copy_fits.py produces:
+    the image with header keys from the real image, followed by the real weight and bad pixel
+    HDUs.
+
+    The output field takes two extra (plain string) parameters:
+
+        real_file_format    A format string for the real image file names, which is
+                            formatted with the 2-digit ccdnum, taken to be file_num+1.
+        sim_file_format     (optional) A format string for the output file names.
+                            Otherwise the normal file_name, dir parameters are used.
+    """
+    def getFilename(self, config, base, logger):
+        if 'sim_file_format' in config:
+            no = '%02d'%(base['file_num']+1)
+            return config['sim_file_format'].format(no)
+        else:
+            return super(DESSimBuilder, self).getFilename(config, base, logger)
+
+    def canAddHdus(self):
+        # The weight and bad pixel HDUs come from the real image.
+        return False
+
+    def writeFile(self, data, file_name, config, base, logger):
+        from astropy.io import fits
+
+        no = '%02d'%(base['file_num']+1)
+        real_file = config['real_file_format'].format(no)
+
+        hdus = fits.HDUList()
+        galsim.fits.write(data[0], hdu_list=hdus)
+
+        # Read compressed HDUs as the BINTABLEs they are on disk, so any header fix done
+        # by copy_hdu goes with the compressed data that it copies.
+        with open(real_file, 'rb') as real_in, \
+             fits.open(real_in, memmap=True, lazy_load_hdus=False,
+                       disable_image_compression=True) as reals:
+            copy_fits.transplant_header(hdus[0].header, reals[0].header)
+
+            tmp_file = file_name + '.tmp'
+            with open(tmp_file, 'wb') as fout:
+                hdus.writeto(fout)
+                copy_fits.copy_hdu(reals, 1, real_in, fout)
+                copy_fits.copy_hdu(reals, 2, real_in, fout)
+            os.rename(tmp_file, file_name)
+        logger.warning('Wrote %s with weight and bad pixel HDUs from %s', file_name, real_file)
+
+galsim.config.RegisterOutputType('DESSim', DESSimBuilder())
+
+
+def run_job(config, njobs, job, verbose):
+    """Run one of njobs parts of the config processing.  (job is 1-based as in GalSim.)
+    """
+    import logging
+    logging.basicConfig(format="%(message)s", stream=sys.stdout,
+                        level=[logging.WARNING, logging.INFO, logging.DEBUG][min(verbose,2)])
+    logger = logging.getLogger('simulate.%d'%job)
+    galsim.config.Process(config, logger=logger, njobs=njobs, job=job)
+    return job
+
+
+def main():
+    args = parse_args()
+
+    out_dir = os.path.dirname(args.output)
+    if out_dir and not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    for config in galsim.config.ReadConfig(args.config_file):
+        output = config.setdefault('output', {})
+        output['type'] = 'DESSim'
+        output['real_file_format'] = args.real
+        output['sim_file_format'] = args.output
+        output.pop('dir', None)
+        # We parallelize over files here, so don't also let GalSim do it.
+        output['nproc'] = 1
+
+        galsim.config.ImportModules(config)
+        nfiles = galsim.config.GetNFiles(config)
+        njobs = max(min(args.nproc, nfiles), 1)
+        print('Simulating {} files in {} jobs'.format(nfiles, njobs))
+        with ProcessPoolExecutor(max_workers=njobs) as executor:
+            futures = [ executor.submit(run_job, config, njobs, job, args.verbose)
+                        for job in range(1, njobs+1) ]
+            for future in futures:
+                print('Finished job {}'.format(future.result()))
+
+
+if __name__ == "__main__":
+    main()
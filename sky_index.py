@@ -0,0 +1,122 @@
+# A HEALPix index of the star catalog, to answer sky region questions without scanning
+# every star.
+#
+# The stars are sorted by their (nested) HEALPix pixel, and the index keeps the sort order and
+# the offset of each occupied pixel.  A region query finds the pixels that overlap the region
+# with healpy and returns the corresponding row ranges in the sorted order.  Because the nested
+# scheme is hierarchical, coarser pixels are contiguous blocks of the same order, which is
+# also used to split the stars into spatially compact patches for jackknife estimates.
+
+import numpy
+
+
+class SkyIndex(object):
+    """A HEALPix index of a catalog of ra, dec positions (in degrees).
+
+    order       The row indices of the catalog sorted by pixel.
+    pixels      The occupied pixels (nested ordering), sorted.
+    offsets     The stars in pixels[i] are order[offsets[i]:offsets[i+1]].
+    """
+    def __init__(self, nside, order, pixels, offsets):
+        self.nside = nside
+        self.order = order
+        self.pixels = pixels
+        self.offsets = offsets
+
+    @classmethod
+    def build(cls, ra, dec, nside=1024):
+        import healpy
+
+        pix = healpy.ang2pix(nside, numpy.asarray(ra), numpy.asarray(dec), nest=True, lonlat=True)
+        order = numpy.argsort(pix, kind='stable')
+        pixels, offsets = numpy.unique(pix[order], return_index=True)
+        offsets = numpy.append(offsets, len(order))
+        return cls(nside, order, pixels, offsets)
+
+    @classmethod
+    def load(cls, file_name):
+        with numpy.load(file_name) as d:
+            return cls(int(d['nside']), d['order'], d['pixels'], d['offsets'])
+
+    def save(self, file_name):
+        numpy.savez(file_name, nside=self.nside, order=self.order, pixels=self.pixels,
+                    offsets=self.offsets)
+        print('wrote sky index to ',file_name)
+
+    def ranges(self, pixels):
+        """Return the (start, end) ranges in self.order of the stars in the given pixels.
+        """
+        pixels = numpy.unique(pixels)
+        if len(self.pixels) == 0:
+            return numpy.empty((0,2), dtype=int)
+        k = numpy.searchsorted(self.pixels, pixels)
+        k = numpy.clip(k, 0, len(self.pixels)-1)
+        k = k[self.pixels[k] == pixels]
+        return numpy.column_stack([self.offsets[k], self.offsets[k+1]])
+
+    def rows(self, pixels):
+        """Return the catalog rows of the stars in the given pixels.
+        """
+        r = self.ranges(pixels)
+        if len(r) == 0:
+            return numpy.empty(0, dtype=int)
+        return numpy.concatenate([ self.order[start:end] for start, end in r ])
+
+    def query_disc(self, ra, dec, radius):
+        """Return the rows of the stars in pixels overlapping the circle of the given radius
+        (in degrees) around (ra, dec).
+
+        This is inclusive, so some stars just outside the circle may be returned.
+        """
+        import healpy
+        vec = healpy.ang2vec(ra, dec, lonlat=True)
+        pix = healpy.query_disc(self.nside, vec, numpy.radians(radius), inclusive=True, nest=True)
+        return self.rows(pix)
+
+    def query_polygon(self, ra, dec):
+        """Return the rows of the stars in pixels overlapping the convex polygon with the given
+        vertices (in degrees, in order around the polygon).
+        """
+        import healpy
+        vertices = healpy.ang2vec(numpy.asarray(ra), numpy.asarray(dec), lonlat=True)
+        pix = healpy.query_polygon(self.nside, vertices, inclusive=True, nest=True)
+        return self.rows(pix)
+
+    def query_ccd(self, expinfo_row):
+        """Return the rows of the stars in the footprint of a ccd, as given by the corner*_ra,
+        corner*_dec columns of a row of exposure_info.fits.
+        """
+        # The corners are at (0,0), (2048,0), (0,4096), (2048,4096), so go around as 0,1,3,2.
+        ra = [ expinfo_row['corner%d_ra'%i] for i in (0,1,3,2) ]
+        dec = [ expinfo_row['corner%d_dec'%i] for i in (0,1,3,2) ]
+        return self.query_polygon(ra, dec)
+
+    def query_bumps(self, expinfo_row, radius):
+        """Return the rows of the stars within radius (degrees) of the tape bumps of a ccd,
+        as given by the bump*_ra, bump*_dec columns of a row of exposure_info.fits.
+        """
+        rows = [ self.query_disc(expinfo_row['bump%d_ra'%i], expinfo_row['bump%d_dec'%i], radius)
+                 for i in range(6) ]
+        return numpy.unique(numpy.concatenate(rows))
+
+    def patches(self, npatch):
+        """Assign each star to one of npatch spatially compact patches.
+
+        The patches are runs of consecutive pixels in the nested ordering with roughly equal
+        numbers of stars.  Returns the patch number for each row of the catalog.
+
+        A pixel with more than one patch's worth of stars can swallow a split point, so there
+        may be fewer than npatch patches.  They are numbered 0..n-1 without gaps.
+        """
+        counts = numpy.diff(self.offsets)
+        # Split points in the cumulative star count, snapped to pixel boundaries.
+        cum = numpy.cumsum(counts)
+        targets = numpy.arange(1, npatch) * cum[-1] / npatch
+        pix_patch = numpy.searchsorted(targets, cum - counts/2.)
+        # Renumber to skip the patches that got no pixels.
+        _, pix_patch = numpy.unique(pix_patch, return_inverse=True)
+        if pix_patch[-1] + 1 < npatch:
+            print('Only %d of the %d patches have any stars'%(pix_patch[-1]+1, npatch))
+        patch = numpy.empty(len(self.order), dtype=int)
+        patch[self.order] = numpy.repeat(pix_patch, counts)
+        return patch
@@ -0,0 +1,76 @@
+# The data types of the star catalogs, both the files written by build_psf_cats.py and the
+# combined arrays run_rho2.py correlates.
+#
+# Only ra, dec need double precision.  Shapes, sizes, positions on the chip and magnitudes
+# are float32, ccdnum and stamp_size are int16 and flags are int32.  In memory, the filter is stored as an
+# int8 code (an index into filters, or -1 for any other filter) rather than a string per star.
+
+import numpy
+
+# The columns of the psf catalogs.
+psf_cat_dtype = [('ccdnum','i2'), ('x','f4'), ('y','f4'), ('ra','f8'), ('dec','f8'),
+                 ('mag','f4'), ('flag','i4'), ('e1','f4'), ('e2','f4'), ('size','f4'),
+                 ('psf_e1','f4'), ('psf_e2','f4'), ('psf_size','f4'), ('stamp_size','i2')]
+
+# The filter codes.
+filters = ['u', 'g', 'r', 'i', 'z', 'Y']
+# The code for any other filter (e.g. VR or N964).
+unknown_filter = -1
+_unknown_filters = set()
+
+# The types of the columns of the combined star arrays that aren't float32.
+star_types = { 'ra' : 'f8', 'dec' : 'f8', 'exp' : 'i4', 'ccd' : 'i2', 'filter' : 'i1',
+               'tiling' : 'i2' }
+
+
+def filter_code(filter):
+    """The int8 code for a filter name (str or bytes).
+
+    Filters that aren't in filters all get the code unknown_filter.
+    """
+    if isinstance(filter, bytes):
+        filter = filter.decode()
+    filter = filter.strip()
+    if filter not in filters:
+        if filter not in _unknown_filters:
+            print('WARNING: unknown filter %r.  Using code %d for it.'%(filter, unknown_filter))
+            _unknown_filters.add(filter)
+        return numpy.int8(unknown_filter)
+    return numpy.int8(filters.index(filter))
+
+def filter_codes(filter_list):
+    """The codes for a list of filter names, as an int8 array.
+    """
+    return numpy.array([ filter_code(f) for f in filter_list ], dtype='i1')
+
+def filter_name(code):
+    """The filter name for a code.  (None for unknown_filter.)
+    """
+    if int(code) == unknown_filter:
+        return None
+    return filters[int(code)]
+
+def star_dtype(names):
+    """The dtype of a combined star array with the given columns.
+    """
+    return [ (name, star_types.get(name, 'f4')) for name in names ]
+
+
+def memory_report(name, data):
+    """Print the memory used by a structured array.
+    """
+    nbytes = data.nbytes
+    print('%s: %d rows x %d bytes = %.1f MB'%(name, len(data), data.dtype.itemsize,
+                                               nbytes / 1024.**2))
+    return nbytes
+
+def max_rss():
+    """Print (and return) the peak resident memory of this process in MB.
+    """
+    import resource
+    import sys
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kB, macOS reports bytes.
+    rss = rss / 1024.**2 if sys.platform == 'darwin' else rss / 1024.
+    print('peak memory = %.1f MB'%rss)
+    return rss
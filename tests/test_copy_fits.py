@@ -0,0 +1,44 @@
+import os
+import sys
+
+import numpy
+import pytest
+from astropy.io import fits
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import copy_fits
+
+
+@pytest.mark.parametrize('disable_image_compression', [False, True])
+def test_copy_compressed_hdu_with_bad_card(tmp_path, disable_image_compression):
+    # A tile-compressed image whose (BINTABLE) header has a card that needs fixing.
+    data = numpy.arange(100*120, dtype=numpy.float32).reshape(100, 120)
+    header = fits.Header()
+    header['TESTKEY'] = 7
+    in_file = str(tmp_path / 'in.fits.fz')
+    fits.HDUList([fits.PrimaryHDU(),
+                  fits.CompImageHDU(data, header=header, quantize_level=0),
+                  fits.CompImageHDU(data.astype(numpy.int32))]).writeto(in_file)
+    with open(in_file, 'rb') as f:
+        raw = bytearray(f.read())
+    k = raw.find(b'TESTKEY =')
+    raw[k:k+8] = b'testkey '
+    with open(in_file, 'wb') as f:
+        f.write(raw)
+
+    out_file = str(tmp_path / 'out.fits.fz')
+    with open(in_file, 'rb') as fin, \
+         fits.open(fin, memmap=True, lazy_load_hdus=False,
+                   disable_image_compression=disable_image_compression) as hdus, \
+         open(out_file, 'wb') as fout:
+        fits.PrimaryHDU().writeto(fout)
+        copy_fits.copy_hdu(hdus, 1, fin, fout)
+        copy_fits.copy_hdu(hdus, 2, fin, fout)
+
+    with fits.open(out_file) as hdus:
+        hdus.verify('exception')
+        assert isinstance(hdus[1], fits.CompImageHDU)
+        assert isinstance(hdus[2], fits.CompImageHDU)
+        assert hdus[1].header['TESTKEY'] == 7
+        numpy.testing.assert_array_equal(hdus[1].data, data)
+        numpy.testing.assert_array_equal(hdus[2].data, data.astype(numpy.int32))
@@ -1,94 +1,177 @@
+# Conversions between CCD pixel coordinates and DECam focal plane coordinates.
 import numpy
 
-# Centers of chips in focal plane coordinates
-N7=["N7",16.908,191.670]
-N6=["N6",16.908,127.780]
-N5=["N5",16.908,63.890]
-N4=["N4",16.908,0.]
-N3=["N3",16.908,-63.890]
-N2=["N2",16.908,-127.780]
-N1=["N1",16.908,-191.670]
-
-N13=["N13",50.724,159.725]
-N12=["N12",50.724,95.835]
-N11=["N11",50.724,31.945]
-N10=["N10",50.724,-31.945]
-N9=["N9",50.724,-95.835]
-N8=["N8",50.724,-159.725]
-
-N19=["N19",84.540,159.725]
-N18=["N18",84.540,95.835]
-N17=["N17",84.540,31.945]
-N16=["N16",84.540,-31.945]
-N15=["N15",84.540,-95.835]
-N14=["N14",84.540,-159.725]
-
-N24=["N24",118.356,127.780]
-N23=["N23",118.356,63.890]
-N22=["N22",118.356,0.]
-N21=["N21",118.356,-63.890]
-N20=["N20",118.356,-127.780]
-
-N28=["N28",152.172,95.835]
-N27=["N27",152.172,31.945]
-N26=["N26",152.172,-31.945]
-N25=["N25",152.172,-95.835]
-
-N31=["N31",185.988,63.890]
-N30=["N30",185.988,0.]
-N29=["N29",185.988,-63.890]
-
-S7=["S7",-16.908,191.670]
-S6=["S6",-16.908,127.780]
-S5=["S5",-16.908,63.890]
-S4=["S4",-16.908,0.]
-S3=["S3",-16.908,-63.890]
-S2=["S2",-16.908,-127.780]
-S1=["S1",-16.908,-191.670]
-
-S13=["S13",-50.724,159.725]
-S12=["S12",-50.724,95.835]
-S11=["S11",-50.724,31.945]
-S10=["S10",-50.724,-31.945]
-S9=["S9",-50.724,-95.835]
-S8=["S8",-50.724,-159.725]
-
-S19=["S19",-84.540,159.725]
-S18=["S18",-84.540,95.835]
-S17=["S17",-84.540,31.945]
-S16=["S16",-84.540,-31.945]
-S15=["S15",-84.540,-95.835]
-S14=["S14",-84.540,-159.725]
-
-S24=["S24",-118.356,127.780]
-S23=["S23",-118.356,63.890]
-S22=["S22",-118.356,0.]
-S21=["S21",-118.356,-63.890]
-S20=["S20",-118.356,-127.780]
-
-S28=["S28",-152.172,95.835]
-S27=["S27",-152.172,31.945]
-S26=["S26",-152.172,-31.945]
-S25=["S25",-152.172,-95.835]
-
-S31=["S31",-185.988,63.890]
-S30=["S30",-185.988,0.]
-S29=["S29",-185.988,-63.890]
-
-# order of chips when using numeric label
-ccdid = [S29,S30,S31,S25,S26,S27,S28,S20,S21,S22,S23,S24,S14,S15,S16,S17,S18,S19,S8,S9,S10,S11,S12,S13,S1,S2,S3,S4,S5,S6,S7,N1,N2,N3,N4,N5,N6,N7,N8,N9,N10,N11,N12,N13,N14,N15,N16,N17,N18,N19,N20,N21,N22,N23,N24,N25,N26,N27,N28,N29,N30,N31]
-
-# defines the size of a chip in mm.  One pixel=15 microns
-xsize=2048*15e-6*1000
-ysize=4096*15e-6*1000
-
-# xc, yc are the (x,y) position of the lower left corner of each chip
-xc = numpy.empty(len(ccdid)+1)
-yc = numpy.empty(len(ccdid)+1)
-for i,ext in enumerate(ccdid):
-    xc[i+1] = ext[1]-xsize/2
-    yc[i+1] = ext[2]-ysize/2
-
-def toFocal(ccd,x,y):
-    return x*15e-6*1000+xc[ccd],y*15e-6*1000+yc[ccd]
-
+# One pixel = 15 microns = 0.263 arcsec.
+pixel_size = 15e-3      # mm
+pixel_scale = 0.263     # arcsec
+mm_to_arcsec = pixel_scale / pixel_size
+
+# Defines the size of a chip in pixels and in mm.
+nx = 2048
+ny = 4096
+xsize = nx * pixel_size
+ysize = ny * pixel_size
+
+# Centers of chips in focal plane coordinates (mm), in order of numeric label (CCDNUM).
+_centers = [
+    ( 1, 'S29', -185.988,  -63.890),
+    ( 2, 'S30', -185.988,    0.000),
+    ( 3, 'S31', -185.988,   63.890),
+    ( 4, 'S25', -152.172,  -95.835),
+    ( 5, 'S26', -152.172,  -31.945),
+    ( 6, 'S27', -152.172,   31.945),
+    ( 7, 'S28', -152.172,   95.835),
+    ( 8, 'S20', -118.356, -127.780),
+    ( 9, 'S21', -118.356,  -63.890),
+    (10, 'S22', -118.356,    0.000),
+    (11, 'S23', -118.356,   63.890),
+    (12, 'S24', -118.356,  127.780),
+    (13, 'S14',  -84.540, -159.725),
+    (14, 'S15',  -84.540,  -95.835),
+    (15, 'S16',  -84.540,  -31.945),
+    (16, 'S17',  -84.540,   31.945),
+    (17, 'S18',  -84.540,   95.835),
+    (18, 'S19',  -84.540,  159.725),
+    (19, 'S8',   -50.724, -159.725),
+    (20, 'S9',   -50.724,  -95.835),
+    (21, 'S10',  -50.724,  -31.945),
+    (22, 'S11',  -50.724,   31.945),
+    (23, 'S12',  -50.724,   95.835),
+    (24, 'S13',  -50.724,  159.725),
+    (25, 'S1',   -16.908, -191.670),
+    (26, 'S2',   -16.908, -127.780),
+    (27, 'S3',   -16.908,  -63.890),
+    (28, 'S4',   -16.908,    0.000),
+    (29, 'S5',   -16.908,   63.890),
+    (30, 'S6',   -16.908,  127.780),
+    (31, 'S7',   -16.908,  191.670),
+    (32, 'N1',    16.908, -191.670),
+    (33, 'N2',    16.908, -127.780),
+    (34, 'N3',    16.908,  -63.890),
+    (35, 'N4',    16.908,    0.000),
+    (36, 'N5',    16.908,   63.890),
+    (37, 'N6',    16.908,  127.780),
+    (38, 'N7',    16.908,  191.670),
+    (39, 'N8',    50.724, -159.725),
+    (40, 'N9',    50.724,  -95.835),
+    (41, 'N10',   50.724,  -31.945),
+    (42, 'N11',   50.724,   31.945),
+    (43, 'N12',   50.724,   95.835),
+    (44, 'N13',   50.724,  159.725),
+    (45, 'N14',   84.540, -159.725),
+    (46, 'N15',   84.540,  -95.835),
+    (47, 'N16',   84.540,  -31.945),
+    (48, 'N17',   84.540,   31.945),
+    (49, 'N18',   84.540,   95.835),
+    (50, 'N19',   84.540,  159.725),
+    (51, 'N20',  118.356, -127.780),
+    (52, 'N21',  118.356,  -63.890),
+    (53, 'N22',  118.356,    0.000),
+    (54, 'N23',  118.356,   63.890),
+    (55, 'N24',  118.356,  127.780),
+    (56, 'N25',  152.172,  -95.835),
+    (57, 'N26',  152.172,  -31.945),
+    (58, 'N27',  152.172,   31.945),
+    (59, 'N28',  152.172,   95.835),
+    (60, 'N29',  185.988,  -63.890),
+    (61, 'N30',  185.988,    0.000),
+    (62, 'N31',  185.988,   63.890),
+]
+
+# The geometry table.  Row i describes ccdnum i.  Row 0 is a placeholder (ccdnum = 0 is not a
+# valid chip), which lets the table be indexed directly by ccdnum.
+# xc, yc are the (x,y) position of the lower left corner of each chip.
+ccd_table = numpy.zeros(len(_centers)+1, dtype=[('ccdnum','i2'), ('detpos','U3'),
+                                                 ('xcen','f8'), ('ycen','f8'),
+                                                 ('xc','f8'), ('yc','f8')])
+ccd_table['xcen'][0] = ccd_table['ycen'][0] = numpy.nan
+ccd_table['xc'][0] = ccd_table['yc'][0] = numpy.nan
+for _ccdnum, _detpos, _xcen, _ycen in _centers:
+    ccd_table[_ccdnum] = (_ccdnum, _detpos, _xcen, _ycen, _xcen-xsize/2, _ycen-ysize/2)
+
+xc = ccd_table['xc']
+yc = ccd_table['yc']
+
+# Sorted detpos values for vectorized lookups of ccdnum from DETPOS strings.
+_detpos_order = numpy.argsort(ccd_table['detpos'][1:]) + 1
+_detpos_sorted = ccd_table['detpos'][_detpos_order]
+
+
+def get_ccdnum(ccd):
+    """Convert a ccd specification to the numeric CCDNUM.
+
+    ccd may be a single value or an array, with each entry either a CCDNUM (1-62) or a DETPOS
+    string such as 'S29' (str or bytes, possibly padded with whitespace as in the FITS headers).
+    Mixed arrays of chips are fine.
+
+    Returns ccdnum as an int or an int array.
+    """
+    a = numpy.asarray(ccd)
+    if a.dtype.kind in 'iu':
+        ccdnum = a.astype(int)
+        if numpy.any((ccdnum < 1) | (ccdnum >= len(ccd_table))):
+            raise ValueError("Invalid ccdnum in %s"%ccd)
+    else:
+        if a.dtype.kind == 'S':
+            a = numpy.char.decode(a, 'ascii')
+        a = numpy.char.strip(a.astype('U'))
+        k = numpy.searchsorted(_detpos_sorted, a)
+        k = numpy.clip(k, 0, len(_detpos_sorted)-1)
+        bad = _detpos_sorted[k] != a
+        if numpy.any(bad):
+            raise ValueError("Invalid detpos in %s"%numpy.unique(a[bad]))
+        ccdnum = _detpos_order[k]
+    if ccdnum.ndim == 0:
+        return int(ccdnum)
+    return ccdnum
+
+def get_detpos(ccdnum):
+    """Convert a CCDNUM (or array of them) to the DETPOS string(s).
+    """
+    return ccd_table['detpos'][get_ccdnum(ccdnum)]
+
+def toFocal(ccd, x, y, arcsec=False):
+    """Convert pixel coordinates on a chip to focal plane coordinates.
+
+    ccd may be a CCDNUM or DETPOS (see get_ccdnum) or an array of them matching x and y.
+
+    Returns the focal plane position in mm, or in arcsec if arcsec=True.
+    """
+    ccdnum = get_ccdnum(ccd)
+    fx = numpy.asarray(x) * pixel_size + xc[ccdnum]
+    fy = numpy.asarray(y) * pixel_size + yc[ccdnum]
+    if arcsec:
+        fx *= mm_to_arcsec
+        fy *= mm_to_arcsec
+    return fx, fy
+
+def fromFocal(fx, fy, ccd=None, arcsec=False):
+    """Convert focal plane coordinates to pixel coordinates on a chip.
+
+    If ccd is given, the pixel coordinates are relative to that chip (or chips), even if the
+    position is not actually on it.  Otherwise, the chip containing each position is found.
+    Positions that do not land on any chip get ccdnum = 0 and x,y = nan.
+
+    fx, fy are in mm, or in arcsec if arcsec=True.
+
+    Returns ccdnum, x, y.
+    """
+    fx = numpy.asarray(fx, dtype=float)
+    fy = numpy.asarray(fy, dtype=float)
+    if arcsec:
+        fx = fx / mm_to_arcsec
+        fy = fy / mm_to_arcsec
+    if ccd is None:
+        # Check every chip at once: shape is (nchip, npos).
+        dx = fx.reshape(1,-1) - xc[1:,numpy.newaxis]
+        dy = fy.reshape(1,-1) - yc[1:,numpy.newaxis]
+        on_chip = (dx >= 0) & (dx < xsize) & (dy >= 0) & (dy < ysize)
+        ccdnum = numpy.where(on_chip.any(axis=0), on_chip.argmax(axis=0) + 1, 0)
+        ccdnum = ccdnum.reshape(fx.shape)
+    else:
+        ccdnum = numpy.broadcast_to(get_ccdnum(ccd), fx.shape)
+    x = (fx - xc[ccdnum]) / pixel_size
+    y = (fy - yc[ccdnum]) / pixel_size
+    if ccdnum.ndim == 0:
+        ccdnum = int(ccdnum)
+    return ccdnum, x, y